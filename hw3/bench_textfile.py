@@ -0,0 +1,96 @@
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import textfile
+
+"""
+Read throughput of textfile.readlinesInPartition() on a generated file of
+the given size in GB, split into each number of partitions in PARTITIONS.
+The partitions are read one after the other, in this process rather than
+through Spark, so the MB/s are those of a single core: the partitions of an
+RDD are read in parallel, up to one per core. The file is written just
+before, so it is usually in the page cache.
+
+For comparison, the character at a time reader that textFile used before
+reads the first OLD_SIZE bytes of the file.
+
+Lines are LINE_WORDS random words, separated by '\\n'.
+
+    $ python bench_textfile.py [GB]
+"""
+
+PARTITIONS = [1, 2, 4, 8, 16, 64]
+OLD_SIZE = 16 << 20
+LINE_WORDS = 12
+DELIMITER = '\n'
+
+WORDS = ['rosalind', 'orlando', 'celia', 'touchstone', 'jaques', 'forest', 'of', 'arden', 'the', 'a']
+
+def write_file(path, size):
+    rng = random.Random(186)
+    lines = [' '.join(rng.choice(WORDS) for _ in range(LINE_WORDS)) for _ in range(4096)]
+    block = (DELIMITER.join(lines) + DELIMITER).encode('ascii')
+    with open(path, 'wb') as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.write(block[:size % len(block)])
+
+def old_readToDelimiter(fHandle, delimiter):
+    s = ""
+    while True:
+        c = fHandle.read(1)
+        if c == "" or c == delimiter:
+            return s
+        s += c
+
+def old_read(path, size):
+    """
+    Reads lines from the start of path, with the reader textFile used before,
+    until size bytes are read.
+    """
+    done = 0
+    with open(path, 'r') as fHandle:
+        while done < size:
+            done += len(old_readToDelimiter(fHandle, DELIMITER)) + 1
+    return done
+
+def read(path, totalPartitions):
+    lines = 0
+    for partitionId in range(totalPartitions):
+        for _ in textfile.readlinesInPartition(totalPartitions, partitionId, path, DELIMITER):
+            lines += 1
+    return lines
+
+def main():
+    size = int(float(sys.argv[1]) * 2 ** 30) if len(sys.argv) > 1 else 2 << 30
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'text')
+        write_file(path, size)
+        megabytes = size / 2.0 ** 20
+        print('%.2f GB file' % (size / 2.0 ** 30))
+        print('%-12s %10s %10s %12s' % ('partitions', 'seconds', 'MB/s', 'lines'))
+        lines = None
+        for totalPartitions in PARTITIONS:
+            start = time.time()
+            count = read(path, totalPartitions)
+            elapsed = time.time() - start
+            if lines is not None and count != lines:
+                raise AssertionError('%d partitions read %d lines instead of %d' % (totalPartitions, count, lines))
+            lines = count
+            print('%-12d %10.2f %10.0f %12d' % (totalPartitions, elapsed, megabytes / elapsed, count))
+        start = time.time()
+        done = old_read(path, min(OLD_SIZE, size))
+        elapsed = time.time() - start
+        print('character at a time, first %.0f MB: %.0f MB/s' % (done / 2.0 ** 20, done / 2.0 ** 20 / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
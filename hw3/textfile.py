@@ -0,0 +1,229 @@
+import bz2
+import glob
+import gzip
+import heapq
+import math
+import mmap
+import multiprocessing
+import os
+
+"""
+A fast reader for the textFile of HW3_I. Each partition of a file of
+filesize bytes covers partitionSize = ceil(filesize / totalPartitions) bytes,
+and owns the lines whose preceding delimiter falls in its bytes; the first
+partition also owns the first line. So a partition skips the end of a line
+that started before it, and reads its last line to the end, past its bytes
+if need be.
+
+Rather than reading one character at a time, a partition memory-maps the
+file from the start of its bytes, finds its first and last lines with
+find(), and splits the bytes in between with split(), a block of BLOCK_SIZE
+bytes at a time. Only the pages it reads are loaded, and the cost per line
+is that of copying it out of the mapping.
+
+textFile can also read a directory or a glob of files, some of them
+compressed with gzip or bzip2. planPartitions() assigns each partition
+splits: whole compressed files, which can only be read from the start, and
+byte ranges of uncompressed files, read as above.
+"""
+
+# Bytes split at a time by readlinesInPartition()
+BLOCK_SIZE = 1 << 20
+
+# First read of readToDelimiter(), doubled until the delimiter is found
+FIRST_READ = 128
+
+# Input read by each partition when planPartitions() chooses their number
+PARTITION_SIZE = 64 << 20
+
+# Extensions of the files read whole and decompressed, and how to open them
+COMPRESSED = [('.gz', gzip.open), ('.bz2', bz2.BZ2File)]
+
+if str is bytes:
+    toBytes = toText = lambda s: s
+else:
+    toBytes = lambda s: s.encode('utf-8')
+    toText = lambda b: b.decode('utf-8')
+
+def readToDelimiter(fHandle, delimiter):
+    """
+    Returns the characters from the current position of fHandle up to, but
+    not including, the next delimiter or the end of the file, and leaves
+    fHandle just past the delimiter. Reads blocks, of twice the size each
+    time, and seeks back to the delimiter, so fHandle must be seekable and
+    its positions must count characters (a binary file, or ASCII text).
+    """
+    start = fHandle.tell()
+    pieces = []
+    size = FIRST_READ
+    while True:
+        block = fHandle.read(size)
+        end = block.find(delimiter)
+        if end >= 0:
+            pieces.append(block[:end])
+            fHandle.seek(start + sum(len(piece) for piece in pieces) + 1)
+            return block[:0].join(pieces)
+        pieces.append(block)
+        if len(block) < size:
+            return block[:0].join(pieces)
+        size *= 2
+
+def partitionBounds(filesize, totalPartitions, partitionId):
+    """
+    Returns the first byte of the partition and the first byte past it.
+    """
+    partitionSize = int(math.ceil(filesize / float(totalPartitions)))
+    begin = min(partitionId * partitionSize, filesize)
+    return begin, min(begin + partitionSize, filesize)
+
+def readlinesInPartition(totalPartitions, partitionId, filename, delimiter):
+    """
+    Return an *iterator* over the "valid" lines in this partition of the file.
+
+    :param totalPartitions: Total number of partitions in the RDD
+    :param partitionId: The index of this current partition - (0 indexed)
+    :param filename: The path to the file.
+    :param delimiter: Character used to signal stop of element chunk.
+    """
+    filesize = os.path.getsize(filename)
+    begin, end = partitionBounds(filesize, totalPartitions, partitionId)
+    if begin >= filesize:
+        # Nothing to map: the partition starts at the end of the file, so it
+        # holds no delimiter, unless the file is empty and holds a single
+        # empty line
+        if partitionId == 0:
+            yield ''
+        return
+    with open(filename, 'rb') as fHandle:
+        # Map from the start of the partition, rounded down to a multiple of
+        # the allocation granularity, to the end of the file
+        offset = begin - begin % mmap.ALLOCATIONGRANULARITY
+        mapped = mmap.mmap(fHandle.fileno(), filesize - offset, offset=offset, access=mmap.ACCESS_READ)
+    try:
+        sep = toBytes(delimiter)
+        if partitionId == 0:
+            first = 0
+        else:
+            found = mapped.find(sep, begin - offset, end - offset)
+            if found < 0:
+                return
+            first = found + 1
+        # The last line ends at the first delimiter of the next partition
+        last = mapped.find(sep, end - offset) if end < filesize else -1
+        stop = last if last >= 0 else filesize - offset
+        tail = b''
+        for blockStart in range(first, stop, BLOCK_SIZE):
+            lines = (tail + mapped[blockStart:min(blockStart + BLOCK_SIZE, stop)]).split(sep)
+            tail = lines.pop()
+            for line in lines:
+                yield toText(line)
+        yield toText(tail)
+    finally:
+        mapped.close()
+
+def isCompressed(filename):
+    return any(filename.endswith(extension) for extension, _ in COMPRESSED)
+
+def openCompressed(filename):
+    """
+    Returns a binary file object over the decompressed contents of filename,
+    whose name ends in one of COMPRESSED.
+    """
+    for extension, opener in COMPRESSED:
+        if filename.endswith(extension):
+            return opener(filename)
+    raise ValueError('%s is not compressed' % (filename))
+
+def readlinesInFile(filename, delimiter):
+    """
+    Return an iterator over the lines of the whole of a compressed file,
+    decompressed a block of BLOCK_SIZE bytes at a time.
+    """
+    sep = toBytes(delimiter)
+    with openCompressed(filename) as fHandle:
+        tail = b''
+        while True:
+            block = fHandle.read(BLOCK_SIZE)
+            if not block:
+                break
+            lines = (tail + block).split(sep)
+            tail = lines.pop()
+            for line in lines:
+                yield toText(line)
+        yield toText(tail)
+
+def inputFiles(path):
+    """
+    Returns the sorted list of the files path names: path itself, the files of
+    a directory, or the matches of a glob, whose directories are expanded in
+    turn. Like Spark, skips the files of a directory whose names start with
+    '.' or '_', such as _SUCCESS.
+    """
+    filenames = []
+    for match in sorted(glob.glob(path)):
+        if os.path.isdir(match):
+            filenames += [os.path.join(match, name) for name in sorted(os.listdir(match))
+                          if name[0] not in '._' and os.path.isfile(os.path.join(match, name))]
+        else:
+            filenames.append(match)
+    if not filenames:
+        raise IOError('Input path does not exist: %s' % (path))
+    return filenames
+
+def planPartitions(filenames, numPartitions=None, cores=None):
+    """
+    Splits the files among partitions and returns, for each partition, the list
+    of the splits it reads, in order: a split is a (filename, totalPartitions,
+    partitionId) tuple, read by readlinesInSplits().
+
+    A compressed file cannot be read from the middle, so it is one split. An
+    uncompressed file larger than the share of a partition is split by byte
+    range, into pieces of at most that share. The splits are then assigned,
+    largest first, to the partition with the fewest bytes so far. The size of
+    a compressed file is its compressed size, so the partitions are only
+    balanced as far as the files compress alike. Lines keep their order
+    within a file, but not across files.
+
+    :param numPartitions: Number of partitions, or None to have one per core
+        and at least one per PARTITION_SIZE bytes of input, but no more than
+        there are splits.
+    :param cores: Number of cores, multiprocessing.cpu_count() if None.
+    """
+    sizes = [os.path.getsize(filename) for filename in filenames]
+    total = sum(sizes)
+    chooseCount = numPartitions is None
+    if chooseCount:
+        cores = cores or multiprocessing.cpu_count()
+        numPartitions = max(cores, int(math.ceil(total / float(PARTITION_SIZE))), 1)
+    share = max(int(math.ceil(total / float(numPartitions))), 1)
+    splits = []
+    splitSizes = []
+    for filename, size in zip(filenames, sizes):
+        pieces = 1 if isCompressed(filename) else max(int(math.ceil(size / float(share))), 1)
+        for piece in range(pieces):
+            begin, end = partitionBounds(size, pieces, piece)
+            splits.append((filename, pieces, piece))
+            splitSizes.append(end - begin)
+    if chooseCount:
+        numPartitions = min(numPartitions, len(splits))
+    loads = [(0, partition) for partition in range(numPartitions)]
+    partitions = [[] for _ in range(numPartitions)]
+    # Stable, so that the equal pieces of a file go to partitions in order
+    for index in sorted(range(len(splits)), key=lambda index: -splitSizes[index]):
+        load, partition = heapq.heappop(loads)
+        partitions[partition].append(index)
+        heapq.heappush(loads, (load + splitSizes[index], partition))
+    return [[splits[index] for index in sorted(indexes)] for indexes in partitions]
+
+def readlinesInSplits(splits, delimiter):
+    """
+    Return an iterator over the lines of a partition planned by
+    planPartitions().
+    """
+    for filename, totalPartitions, partitionId in splits:
+        if isCompressed(filename):
+            lines = readlinesInFile(filename, delimiter)
+        else:
+            lines = readlinesInPartition(totalPartitions, partitionId, filename, delimiter)
+        for line in lines:
+            yield line
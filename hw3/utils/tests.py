@@ -1,9 +1,13 @@
+import bz2
 import commands
 import csv
+import gzip
+import mmap
 import os
 import pyspark
 import random
-from tempfile import NamedTemporaryFile
+import shutil
+from tempfile import NamedTemporaryFile, mkdtemp
 from CleanRDD import *
 
 try:
@@ -73,6 +77,73 @@ def test2TextFile(textFile):
     commands.getstatusoutput("mv " + t.name + "/part-00000 " + your_output + "task2TextFile.txt")
     diff_against_reference("task2TextFile.txt", 2)
 
+def test2TextFileBoundaries(readlinesInPartition, trials=200):
+    """
+    Every line of a file must be read by exactly one partition, in order, for
+    any number of partitions: the lines of all partitions put together must be
+    those of split(). Tries random files of a few delimiters, with empty lines,
+    a delimiter at either end and partitions that hold no delimiter at all,
+    then files around the mmap allocation granularity, with partitions that
+    start on a multiple of it, at the end of the file or past it.
+    """
+    rng = random.Random(186)
+    cases = []
+    for _ in range(trials):
+        data = "".join(rng.choice("ab.\n") for _ in range(rng.randrange(40)))
+        cases.append((data, range(1, 12)))
+    granularity = mmap.ALLOCATIONGRANULARITY
+    for size in [granularity - 1, granularity, granularity + 1, 2 * granularity, 3 * granularity + 7]:
+        data = "".join(rng.choice("ab.\n") for _ in range(size))
+        cases.append((data, [1, 2, 3, 4, 65, size // 2 + 1, size, size + 1]))
+    cases.append((("x" * 63 + "\n") * (granularity // 64), [64, 65, granularity + 1]))
+    t = NamedTemporaryFile(delete=False)
+    t.close()
+    try:
+        for data, partitionCounts in cases:
+            with open(t.name, "w") as f:
+                f.write(data)
+            for totalPartitions in partitionCounts:
+                for delimiter in ".\n":
+                    lines = [line for partitionId in range(totalPartitions)
+                             for line in readlinesInPartition(totalPartitions, partitionId, t.name, delimiter)]
+                    if lines != data.split(delimiter):
+                        print "Task 2: FAIL - {!r} ({} bytes) in {} partitions split on {!r} gave {!r}.".format(
+                            data[:40], len(data), totalPartitions, delimiter, lines[:10])
+                        return False
+    finally:
+        os.remove(t.name)
+    print "Task 2: PASS - partitions split {} files like split().".format(len(cases))
+    return True
+
+def test2TextFileShards(textFile):
+    """
+    textFile of a directory of plain, gzip and bzip2 shards, and of a glob of
+    some of them, must read every line of the matched shards exactly once.
+    """
+    rng = random.Random(186)
+    d = mkdtemp()
+    try:
+        shards = {}
+        for i in range(9):
+            extension, opener = [("", open), (".gz", gzip.open), (".bz2", bz2.BZ2File)][i % 3]
+            data = "".join(rng.choice("ab\n") for _ in range(rng.randrange(2000 * (i + 1))))
+            name = os.path.join(d, "part-{}.log{}".format(i, extension))
+            f = opener(name, "wb")
+            f.write(data)
+            f.close()
+            shards[name] = data.split("\n")
+        for path, names in [(d, shards.keys()), (os.path.join(d, "*.gz"), [n for n in shards if n.endswith(".gz")])]:
+            for numPartitions in [None, 2, 5]:
+                lines = sorted(textFile(path, "\n", numPartitions).collect())
+                if lines != sorted(line for name in names for line in shards[name]):
+                    print "Task 2: FAIL - textFile({!r}) in {} partitions did not read every line once.".format(
+                        path, numPartitions)
+                    return False
+    finally:
+        shutil.rmtree(d)
+    print "Task 2: PASS - textFile read directories and globs of compressed shards."
+    return True
+
 def test2Filter(CS186RDD):
     check_dir()
     t = NamedTemporaryFile(delete=True)
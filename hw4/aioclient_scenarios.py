@@ -0,0 +1,96 @@
+import asyncio
+import random
+
+from infra.aioclient import AsyncKVStoreClient
+from infra.utils import KVStoreError
+
+"""
+Scenarios for infra/aioclient.py, run by infratest.AsyncClientTest. Python 3
+only, like the client, so infratest imports this module only on Python 3.
+"""
+
+async def deadlock_retry(address):
+    """
+    Runs a transaction with AsyncKVStoreClient.run() that is aborted by a
+    deadlock on its first attempt, and retried.
+
+    @return: the xids of the attempts, the result of run(), the responses of
+    the other transaction of the deadlock, and the final values of x and y.
+    """
+    # The younger transaction, the client's, is the one aborted
+    other = await AsyncKVStoreClient.connect(address, timeout=10)
+    client = await AsyncKVStoreClient.connect(address, timeout=10)
+    await other.put('y', 'other')
+    attempts = []
+    blocked = []
+
+    async def other_writes():
+        return [await other.put('x', 'other'), await other.commit()]
+
+    async def body(client):
+        attempts.append(client._xid)
+        await client.put('x', 'client')
+        if len(attempts) == 1:
+            # Waits for x, while the client waits for y
+            blocked.append(asyncio.ensure_future(other_writes()))
+        await client.put('y', 'client')
+        return await client.commit()
+
+    result = await client.run(body, backoff=0.01, rng=random.Random(0))
+    other_responses = await blocked[0]
+    client.close()
+    reader = await AsyncKVStoreClient.connect(address, timeout=10)
+    values = await reader.get_many(['x', 'y'])
+    await reader.commit()
+    reader.close()
+    other.close()
+    return attempts, result, other_responses, values
+
+async def failing_body(address):
+    """
+    Runs a transaction whose body raises ValueError, which run() must not
+    retry, then checks that its write was aborted.
+
+    @return: the number of attempts, and the value of x afterwards.
+    """
+    client = await AsyncKVStoreClient.connect(address, timeout=10)
+    attempts = []
+
+    async def body(client):
+        attempts.append(client._xid)
+        await client.put('x', '1')
+        raise ValueError('Not a server error')
+
+    try:
+        await client.run(body)
+    except ValueError:
+        pass
+    await client.begin()
+    value = await client.get('x')
+    await client.commit()
+    client.close()
+    return len(attempts), value
+
+async def failing_abort(address):
+    """
+    Runs a transaction whose body raises ValueError, and whose abort then
+    fails, as it would if the connection were lost.
+
+    @return: the exception raised by run().
+    """
+    client = await AsyncKVStoreClient.connect(address, timeout=10)
+
+    async def abort():
+        raise KVStoreError('Connection lost')
+
+    async def body(client):
+        await client.put('x', '1')
+        client.abort = abort
+        raise ValueError('Not a server error')
+
+    try:
+        await client.run(body)
+    except Exception as e:
+        error = e
+    client.close()
+    return error
@@ -0,0 +1,145 @@
+from __future__ import print_function
+
+import asyncio
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.aioclient import AsyncKVStoreClient, TransactionAborted
+from infra.client import KVStoreClient
+from infra.server import KVStoreServer
+from infra.utils import SOCKET_FILE
+
+"""
+Throughput per client CPU of the asyncio client against the threaded one.
+A single client process keeps n transactions in flight, on n connections:
+one thread per connection with KVStoreClient, or one coroutine per
+connection with AsyncKVStoreClient. Transactions of TXN_LENGTH requests,
+half of them PUTs, on NUM_KEYS keys, run for DURATION seconds; the asyncio
+client retries those aborted by a deadlock, the threaded client starts a new
+one. Reports commits per second, the CPU time used by the client process,
+the commits per client CPU second and the maximum resident set size of the
+client process. The server runs in its own process; on a machine with few
+cores, the server is the bottleneck, so commits per client CPU second is the
+number to compare. Beyond MAX_THREADS connections, only the asyncio client
+is run.
+
+Python 3 only.
+
+    $ python bench/bench_aioclient.py [connections ...]
+"""
+
+DURATION = 3.0
+TXN_LENGTH = 4
+NUM_KEYS = 100000
+CONNECTIONS = [8, 64, 512, 2048]
+MAX_THREADS = 2048
+
+def run_server():
+    KVStoreServer().run()
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def max_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 if sys.platform != 'darwin' else rss / 1024.0 ** 2
+
+def run_threaded(connections, results):
+    commits = [0]
+    mutex = threading.Lock()
+    deadline = time.time() + DURATION
+
+    def run(index):
+        rng = random.Random(index)
+        client = KVStoreClient(address=SOCKET_FILE)
+        done = 0
+        while time.time() < deadline:
+            client.begin()
+            aborted = False
+            for _ in range(TXN_LENGTH):
+                key = 'k%d' % (rng.randrange(NUM_KEYS))
+                response = client.put(key, 'v') if rng.random() < 0.5 else client.get(key)
+                if response == 'Deadlock Abort':
+                    aborted = True
+                    break
+            if not aborted and client.commit() == 'Transaction Completed':
+                done += 1
+        client.close()
+        with mutex:
+            commits[0] += done
+
+    start_cpu = cpu_time()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((commits[0], cpu_time() - start_cpu, max_rss()))
+
+def run_async(connections, results):
+    async def transaction(client, rng):
+        for _ in range(TXN_LENGTH):
+            key = 'k%d' % (rng.randrange(NUM_KEYS))
+            if rng.random() < 0.5:
+                await client.put(key, 'v')
+            else:
+                await client.get(key)
+        return await client.commit()
+
+    async def run(index, deadline):
+        rng = random.Random(index)
+        client = await AsyncKVStoreClient.connect(SOCKET_FILE)
+        done = 0
+        while time.time() < deadline:
+            try:
+                await client.run(lambda client: transaction(client, rng), rng=rng)
+                done += 1
+            except TransactionAborted:
+                pass
+        client.close()
+        return done
+
+    async def main():
+        deadline = time.time() + DURATION
+        return sum(await asyncio.gather(*[run(i, deadline) for i in range(connections)]))
+
+    start_cpu = cpu_time()
+    commits = asyncio.run(main())
+    results.put((commits, cpu_time() - start_cpu, max_rss()))
+
+def measure(target, connections):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(connections, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def main():
+    connections = [int(arg) for arg in sys.argv[1:]] or CONNECTIONS
+    server = multiprocessing.Process(target=run_server)
+    server.start()
+    time.sleep(0.5)
+    try:
+        print('%-8s %12s %12s %14s %16s %14s' % ('client', 'connections', 'commits/s', 'client CPU(s)', 'commits/CPU s', 'max RSS(MB)'))
+        for n in connections:
+            for name, target in [('threads', run_threaded), ('asyncio', run_async)]:
+                if name == 'threads' and n > MAX_THREADS:
+                    print('%-8s %12d %12s' % (name, n, 'skipped'))
+                    continue
+                commits, cpu, rss = measure(target, n)
+                print('%-8s %12d %12.0f %14.2f %16.0f %14.1f' % (name, n, commits / DURATION, cpu, commits / max(cpu, 1e-3), rss))
+    finally:
+        server.terminate()
+        server.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.client import KVStoreClient
+from infra.server import KVStoreServer
+
+"""
+Request latency as idle connections are added. The benchmark opens N idle
+client connections, each in the middle of a transaction, then runs ACTIVE
+clients (threads) that run short transactions on their own keys for DURATION
+seconds. Reports the p50/p99 latency of the active clients' requests.
+
+    $ python bench/bench_connections.py [max idle connections]
+"""
+
+IDLE = [0, 10, 100, 1000, 10000]
+ACTIVE = 100
+DURATION = 2.0
+TXN_LENGTH = 4
+
+def run_server():
+    KVStoreServer().run()
+
+def run_active(index, deadline, latencies):
+    while time.time() < deadline:
+        client = KVStoreClient()
+        for i in range(TXN_LENGTH):
+            start = time.time()
+            if i % 2:
+                client.get('a%d_%d' % (index, i))
+            else:
+                client.put('a%d_%d' % (index, i), str(i))
+            latencies.append(time.time() - start)
+        client.commit()
+        client.close()
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def measure(idle):
+    server = multiprocessing.Process(target=run_server)
+    server.start()
+    time.sleep(0.5)
+    idle_clients = [KVStoreClient() for _ in range(idle)]
+    for i, client in enumerate(idle_clients):
+        client.put('i%d' % i, '0')
+
+    latencies = []
+    deadline = time.time() + DURATION
+    threads = [threading.Thread(target=run_active, args=(i, deadline, latencies)) for i in range(ACTIVE)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for client in idle_clients:
+        client.close()
+    server.terminate()
+    server.join()
+    latencies.sort()
+    return len(latencies) / DURATION, percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+def main():
+    max_idle = int(sys.argv[1]) if len(sys.argv) > 1 else IDLE[-1]
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    print('%-8s %10s %10s %10s' % ('idle', 'ops/s', 'p50(ms)', 'p99(ms)'))
+    for idle in IDLE:
+        if idle > max_idle:
+            break
+        ops, p50, p99 = measure(idle)
+        print('%-8d %10.0f %10.2f %10.2f' % (idle, ops, p50 * 1e3, p99 * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import DBMStore
+from locktable import LockTable
+from sim import ZipfGenerator
+from student import USER, TransactionHandler
+
+"""
+Throughput of DBMStore with and without its cache. The file holds NUM_KEYS
+keys, 10 times CACHE_SIZE. Transactions of TXN_LENGTH requests, each a PUT
+with probability WRITE_FRACTION and a GET otherwise, on keys drawn from a Zipf
+distribution, run one after the other; ABORT_FRACTION of them abort. The
+store is flushed every POLL transactions, as the server does after each poll.
+
+uncached: cache_size=0 and batch_size=1, so that every read and every
+committed write goes to the file, as before the cache.
+cached: cache_size=CACHE_SIZE, and writes are batched until the flush.
+
+Reports transactions per second and the fraction of reads hit in memory.
+
+    $ python bench/bench_dbm.py [transactions]
+"""
+
+CACHE_SIZE = 1000
+NUM_KEYS = 10 * CACHE_SIZE
+TXN_LENGTH = 4
+WRITE_FRACTION = 0.2
+ABORT_FRACTION = 0.1
+POLL = 8
+
+def load(path):
+    store = DBMStore(path, cache_size=0)
+    for i in range(NUM_KEYS):
+        store.put('k%d' % (i), 'v%d' % (i))
+    store.commit(0, dict(('k%d' % (i), 'v%d' % (i)) for i in range(NUM_KEYS)))
+    store.close()
+
+def run(path, txns, skew, cache_size, batch_size):
+    store = DBMStore(path, cache_size=cache_size, batch_size=batch_size)
+    lock_table = LockTable()
+    rng = random.Random(0)
+    keys = ZipfGenerator(NUM_KEYS, skew, rng)
+    start = time.time()
+    for xid in range(1, txns + 1):
+        t = TransactionHandler(lock_table, xid, store)
+        for _ in range(TXN_LENGTH):
+            key = 'k%d' % (keys.next())
+            if rng.random() < WRITE_FRACTION:
+                t.perform_put(key, str(xid))
+            else:
+                t.perform_get(key)
+        if rng.random() < ABORT_FRACTION:
+            t.abort(USER)
+        else:
+            t.commit()
+        if xid % POLL == 0:
+            store.flush()
+    store.close()
+    elapsed = time.time() - start
+    return txns / elapsed, store.hits / float(max(1, store.hits + store.misses))
+
+def main():
+    txns = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    directory = tempfile.mkdtemp()
+    try:
+        print('%d keys, cache of %d keys, %d requests per transaction' % (NUM_KEYS, CACHE_SIZE, TXN_LENGTH))
+        print('%-10s %-10s %10s %10s' % ('keys', 'store', 'txns/s', 'hits'))
+        for name, skew in [('uniform', 0.0), ('zipf', 0.99)]:
+            for store, cache_size, batch_size in [('uncached', 0, 1), ('cached', CACHE_SIZE, 1000)]:
+                path = os.path.join(directory, '%s-%s' % (name, store))
+                load(path)
+                rate, hits = run(path, txns, skew, cache_size, batch_size)
+                print('%-10s %-10s %10.0f %9.1f%%' % (name, store, rate, hits * 100))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+from __future__ import print_function
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import InMemoryKVStore
+from locktable import LockTable
+from student import TransactionCoordinator, TransactionHandler
+
+"""
+Deadlock detection cost on a large lock table. HOLDERS transactions hold
+exclusive locks on KEYS keys in total, then WAITERS other transactions block
+on random held keys. Compares the incremental detector against rebuilding the
+waits-for graph from the whole lock table, as detect_deadlocks() used to be
+specified.
+
+    $ python bench/bench_deadlock_detect.py [keys] [waiters]
+"""
+
+HOLDERS = 1000
+
+def rebuild_and_detect(lock_table):
+    """
+    Reference implementation: scans every lock table entry to build the
+    waits-for graph, then looks for a cycle.
+    """
+    edges = {}
+    for entry in lock_table.values():
+        for txn, mode in entry.queue:
+            edges.setdefault(txn._xid, set()).update(entry.conflicts(txn._xid, mode))
+    visited = set()
+    for start in sorted(edges):
+        stack, on_path = [(start, iter(sorted(edges[start])))], set([start])
+        if start in visited:
+            continue
+        visited.add(start)
+        while stack:
+            node, successors = stack[-1]
+            for successor in successors:
+                if successor in on_path:
+                    return successor
+                if successor not in visited:
+                    visited.add(successor)
+                    on_path.add(successor)
+                    stack.append((successor, iter(sorted(edges.get(successor, ())))))
+                    break
+            else:
+                stack.pop()
+                on_path.discard(node)
+    return None
+
+def timed(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    waiters = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    random.seed(0)
+    lock_table = LockTable()
+    store = InMemoryKVStore()
+    coordinator = TransactionCoordinator(lock_table)
+
+    start = time.time()
+    holders = [TransactionHandler(lock_table, xid, store) for xid in range(HOLDERS)]
+    for i in range(keys):
+        holders[i % HOLDERS].acquire_Xlock('k%d' % i)
+    print('built lock table with %d keys in %.1fs' % (len(lock_table), time.time() - start))
+
+    for xid in range(HOLDERS, HOLDERS + waiters):
+        TransactionHandler(lock_table, xid, store).perform_get('k%d' % random.randrange(keys))
+    incremental, result = timed(coordinator.detect_deadlocks, repeat=1)
+    print('%d waiters, first check (%d new edges): %.1fus, victim %r' % (waiters, waiters, incremental * 1e6, result))
+
+    # One holder now waits for a key held by another: a few new edges per poll
+    holders[0].perform_get('k1')
+    incremental, result = timed(coordinator.detect_deadlocks, repeat=1)
+    print('next check (1 new edge): %.1fus, victim %r' % (incremental * 1e6, result))
+    incremental, result = timed(coordinator.detect_deadlocks)
+    print('idle check (no new edges): %.2fus, victim %r' % (incremental * 1e6, result))
+
+    # Close the cycle
+    holders[1].perform_get('k0')
+    incremental, result = timed(coordinator.detect_deadlocks)
+    print('check closing a cycle: %.1fus, victim %r' % (incremental * 1e6, result))
+
+    rebuild, result = timed(lambda: rebuild_and_detect(lock_table), repeat=1)
+    print('full rebuild from lock table: %.1fus, found cycle through %r' % (rebuild * 1e6, result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+from __future__ import print_function
+
+import sys
+
+from sim import Simulation
+from locktable import DETECT, TIMEOUT, WAIT_DIE, WOUND_WAIT, LockTable
+
+"""
+Compares deadlock detection against the prevention policies on a skewed
+read/write workload, using the in-process simulator.
+
+    $ python bench/bench_deadlock_policies.py [seconds]
+"""
+
+POLICIES = [
+    ('detect', DETECT),
+    ('wait-die', WAIT_DIE),
+    ('wound-wait', WOUND_WAIT),
+    ('timeout', TIMEOUT),
+]
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    print('%-12s %12s %10s %10s %10s' % ('policy', 'commits/s', 'aborts', 'p50(ms)', 'p99(ms)'))
+    for name, policy in POLICIES:
+        lock_table = LockTable(policy, lock_timeout=0.01)
+        result = Simulation(lock_table, clients=32, txn_length=8, write_fraction=0.5, num_keys=1000, skew=0.99).run(duration)
+        print('%-12s %12.0f %9.1f%% %10.2f %10.2f' % (name, result['throughput'], result['abort_rate'] * 100, result['p50'] * 1e3, result['p99'] * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import InMemoryKVStore
+from locktable import LockTable
+from student import TransactionHandler
+
+"""
+Cost of uncontended GETs with and without the fast path for sole readers
+(LockTable(fast_reads=...)). Transactions of TXN_LENGTH GETs run one after
+the other, on keys that no other transaction is using: either the same
+NUM_KEYS keys over and over (hot), or keys never read before (cold). Reports
+the time per GET, the number of lock table entries at the end, and, on
+Python 3, the memory allocated per GET while a transaction holds its locks.
+
+    $ python bench/bench_fast_reads.py [transactions]
+"""
+
+TXN_LENGTH = 16
+NUM_KEYS = 1000
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def run(txns, fast_reads, cold):
+    lock_table = LockTable(fast_reads=fast_reads)
+    store = InMemoryKVStore()
+    start = time.time()
+    for xid in range(txns):
+        t = TransactionHandler(lock_table, xid, store)
+        for i in range(TXN_LENGTH):
+            t.perform_get('k%d' % ((xid * TXN_LENGTH + i) if cold else (xid * TXN_LENGTH + i) % NUM_KEYS))
+        t.commit()
+    elapsed = time.time() - start
+    return elapsed / (txns * TXN_LENGTH), len(lock_table)
+
+def allocated(fast_reads):
+    """
+    @return: the bytes allocated per GET by a transaction reading TXN_LENGTH
+    new keys, measured before it commits.
+    """
+    if tracemalloc is None:
+        return None
+    lock_table = LockTable(fast_reads=fast_reads)
+    store = InMemoryKVStore()
+    keys = ['k%d' % (i) for i in range(TXN_LENGTH)]
+    TransactionHandler(lock_table, 0, store).perform_get('warmup')
+    t = TransactionHandler(lock_table, 1, store)
+    tracemalloc.start()
+    for key in keys:
+        t.perform_get(key)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / float(TXN_LENGTH)
+
+def main():
+    txns = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('%-6s %-6s %12s %14s %14s' % ('keys', 'fast', 'us/GET', 'lock entries', 'bytes/GET'))
+    for cold in [False, True]:
+        for fast_reads in [False, True]:
+            per_get, entries = min(run(txns, fast_reads, cold) for _ in range(3))
+            size = allocated(fast_reads)
+            print('%-6s %-6s %12.2f %14d %14s' % ('cold' if cold else 'hot', 'on' if fast_reads else 'off', per_get * 1e6, entries,
+                                                  '-' if size is None else '%.0f' % (size)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import InMemoryKVStore
+from locktable import LockTable
+from student import ESCALATION_THRESHOLD, TransactionHandler
+
+"""
+Cost of bulk transactions under multiple-granularity locking. A transaction
+writes every key, then another reads every key, with and without lock
+escalation; finally every key is read with a single SCAN. Reports the time per
+operation, the number of lock table entries and locks held at commit, and the
+time to commit (release every lock).
+
+    $ python bench/bench_granularity.py [keys]
+"""
+
+def bulk(keys, escalation_threshold, operation):
+    lock_table = LockTable(escalation_threshold=escalation_threshold)
+    store = InMemoryKVStore()
+    loader = TransactionHandler(lock_table, 0, store)
+    for key in keys:
+        store.put(key, '0')
+    txn = TransactionHandler(lock_table, 1, store)
+
+    start = time.time()
+    operation(txn)
+    elapsed = time.time() - start
+    entries = len(lock_table)
+    held = len(txn._acquired_locks)
+    start = time.time()
+    txn.commit()
+    commit = time.time() - start
+    loader.commit()
+    return elapsed, entries, held, commit
+
+def report(name, num_ops, result):
+    elapsed, entries, held, commit = result
+    print('%-24s %10.2f %10d %10d %10.1f' % (name, elapsed / num_ops * 1e6, entries, held, commit * 1e3))
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    keys = ['k%06d' % i for i in range(num_keys)]
+
+    def write_all(txn):
+        for key in keys:
+            txn.perform_put(key, '1')
+
+    def read_all(txn):
+        for key in keys:
+            txn.perform_get(key)
+
+    def scan_all(txn):
+        txn.perform_scan(keys[0], keys[-1])
+
+    print('%d keys, escalation threshold %d' % (num_keys, ESCALATION_THRESHOLD))
+    print('%-24s %10s %10s %10s %10s' % ('workload', 'us/op', 'entries', 'held', 'commit(ms)'))
+    report('PUT all, no escalation', num_keys, bulk(keys, None, write_all))
+    report('PUT all, escalation', num_keys, bulk(keys, ESCALATION_THRESHOLD, write_all))
+    report('GET all, no escalation', num_keys, bulk(keys, None, read_all))
+    report('GET all, escalation', num_keys, bulk(keys, ESCALATION_THRESHOLD, read_all))
+    report('SCAN all', num_keys, bulk(keys, None, scan_all))
+
+if __name__ == '__main__':
+    main()
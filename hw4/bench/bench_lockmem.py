@@ -0,0 +1,110 @@
+from __future__ import print_function
+
+import os
+import resource
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import InMemoryKVStore
+from locktable import EXCLUSIVE, LockEntry, LockTable
+from student import TransactionHandler
+
+"""
+Memory used by the lock table over a long run of transactions on distinct
+keys. Each transaction PUTs a key that no transaction has used before (GETs
+would take the fast path for sole readers and create no entry), and WINDOW
+transactions are open at any time, the oldest committing as a new one
+starts. Reports the number of lock table entries at the end, which stays at
+WINDOW plus TABLE, and the maximum resident set size of the process.
+
+Then compares the size of a single entry, with one holder, against the
+layout used before entries were removed and compacted (a __dict__ per entry,
+string modes, a dict of counts and a deque), and reports what the table of
+the run would have taken before, when it kept an entry for every key ever
+locked. Sizes are measured with tracemalloc, on Python 3 only.
+
+The request was for 10M transactions (python bench/bench_lockmem.py 10000000).
+
+    $ python bench/bench_lockmem.py [transactions]
+"""
+
+WINDOW = 100
+ENTRIES = 10000
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class OldLockEntry(object):
+    """
+    The entry as it was: holders and counts keyed by the mode names, and a
+    deque for the queue.
+    """
+
+    def __init__(self):
+        self.holders = {}
+        self.counts = dict((mode, 0) for mode in ['IS', 'IX', 'S', 'SIX', 'X'])
+        self.queue = deque()
+
+    def grant(self, xid, mode):
+        self.holders[xid] = mode
+        self.counts[mode] += 1
+
+def run(txns):
+    lock_table = LockTable()
+    store = InMemoryKVStore()
+    window = deque()
+    start = time.time()
+    for xid in range(txns):
+        t = TransactionHandler(lock_table, xid, store)
+        t.perform_put('k%d' % (xid), 'v')
+        window.append(t)
+        if len(window) > WINDOW:
+            window.popleft().commit()
+        if xid % 1000000 == 999999:
+            print('  %d transactions, %d entries, %.0f s' % (xid + 1, len(lock_table), time.time() - start))
+    entries = len(lock_table)
+    elapsed = time.time() - start
+    while window:
+        window.popleft().commit()
+    return elapsed, entries, len(lock_table)
+
+def entry_size(make, mode):
+    """
+    @return: the bytes allocated per entry for ENTRIES entries with one holder
+    each, not counting their keys.
+    """
+    tracemalloc.start()
+    entries = []
+    for xid in range(ENTRIES):
+        entry = make()
+        entry.grant(xid, mode)
+        entries.append(entry)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / float(ENTRIES)
+
+def main():
+    txns = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print('%d transactions, %d open at a time' % (txns, WINDOW))
+    elapsed, entries, left = run(txns)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    print('%.2f us per transaction' % (elapsed * 1e6 / txns))
+    print('lock table entries: %d during the run, %d after' % (entries, left))
+    print('max RSS: %.1f MB' % (rss / 1024.0))
+    if tracemalloc is None:
+        return
+    new = entry_size(LockEntry, EXCLUSIVE)
+    old = entry_size(OldLockEntry, 'X')
+    print('%-8s %14s %22s' % ('entry', 'bytes/entry', 'table after the run'))
+    print('%-8s %14.0f %19.1f MB' % ('before', old, old * txns / 2.0 ** 20))
+    print('%-8s %14.0f %19.1f MB' % ('now', new, new * left / 2.0 ** 20))
+
+if __name__ == '__main__':
+    main()
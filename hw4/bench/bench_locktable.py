@@ -0,0 +1,75 @@
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import InMemoryKVStore
+from student import TransactionHandler
+
+"""
+Microbenchmark for the lock table. Measures the cost of single lock/unlock
+operations as the number of sharers on a hot key, and the number of locks
+held by a single transaction, grow. Both columns should stay flat.
+
+    $ python bench/bench_locktable.py
+"""
+
+SIZES = [1, 10, 100, 1000, 10000]
+REPEAT = 2000
+
+def bench_sharers(n):
+    """
+    n transactions share the lock on a hot key. Measures one more transaction
+    acquiring and releasing a shared lock on it.
+    """
+    lock_table = {}
+    store = InMemoryKVStore()
+    for xid in range(n):
+        TransactionHandler(lock_table, xid, store).perform_get('hot')
+    state = {'xid': n}
+
+    def op():
+        t = TransactionHandler(lock_table, state['xid'], store)
+        state['xid'] += 1
+        t.perform_get('hot')
+        t.commit()
+    return min(timeit.repeat(op, number=REPEAT, repeat=3)) / REPEAT
+
+def bench_held(n):
+    """
+    One transaction holds n locks. Measures re-reading and re-writing one of
+    them (a lock table hit), which used to scan every lock held.
+    """
+    lock_table = {}
+    store = InMemoryKVStore()
+    t = TransactionHandler(lock_table, 0, store)
+    for i in range(n):
+        t.perform_put('k%d' % i, 'v')
+    key = 'k%d' % (n - 1)
+
+    def op():
+        t.perform_get(key)
+        t.perform_put(key, 'v')
+    return min(timeit.repeat(op, number=REPEAT, repeat=3)) / REPEAT
+
+def bench_commit(n):
+    """
+    Measures the per-lock cost of committing a transaction holding n locks.
+    """
+    lock_table = {}
+    store = InMemoryKVStore()
+    t = TransactionHandler(lock_table, 0, store)
+    for i in range(n):
+        t.perform_get('k%d' % i)
+    return timeit.timeit(t.commit, number=1) / n
+
+def main():
+    print('%8s %20s %20s %20s' % ('n', 'sharers S+release', 'held GET+PUT', 'commit per lock'))
+    for n in SIZES:
+        print('%8d %18.2fus %18.2fus %18.2fus' % (n, bench_sharers(n) * 1e6, bench_held(n) * 1e6, bench_commit(n) * 1e6))
+
+if __name__ == '__main__':
+    main()
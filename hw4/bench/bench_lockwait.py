@@ -0,0 +1,90 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.client import KVStoreClient
+from infra.server import KVStoreServer
+
+"""
+N clients contend for an exclusive lock on one hot key. Each transaction
+writes the key, holds the lock for HOLD_TIME seconds and commits. Reports the
+CPU seconds used by the server, and the grant latency: the time between a
+holder sending COMMIT and the next writer's PUT returning.
+
+    $ python bench/bench_lockwait.py [clients] [txns per client]
+"""
+
+HOLD_TIME = 0.005
+
+def run_server(max_handlers, result_queue):
+    server = KVStoreServer(max_handlers=max_handlers)
+    server.run()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result_queue.put(usage.ru_utime + usage.ru_stime)
+
+def run_client(index, txns, start_event, result_queue):
+    events = []
+    start_event.wait()
+    for i in range(txns):
+        client = KVStoreClient()
+        client.put('hot', '%d_%d' % (index, i))
+        granted = time.time()
+        time.sleep(HOLD_TIME)
+        released = time.time()
+        client.commit()
+        client.close()
+        events.append((granted, released))
+    result_queue.put(events)
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    txns = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    server_queue = multiprocessing.Queue()
+    client_queue = multiprocessing.Queue()
+    start_event = multiprocessing.Event()
+
+    server = multiprocessing.Process(target=run_server, args=(clients * txns, server_queue))
+    server.start()
+    time.sleep(0.5)
+    workers = [multiprocessing.Process(target=run_client, args=(i, txns, start_event, client_queue)) for i in range(clients)]
+    for worker in workers:
+        worker.start()
+    start = time.time()
+    start_event.set()
+    events = []
+    for _ in workers:
+        events.extend(client_queue.get())
+    wall = time.time() - start
+    for worker in workers:
+        worker.join()
+    cpu = server_queue.get()
+    server.join()
+
+    # Exactly one transaction holds the lock at a time, so each grant follows
+    # the release of the previous holder
+    timeline = sorted([(t, 'grant') for t, _ in events] + [(t, 'release') for _, t in events])
+    latencies = []
+    last_release = None
+    for t, kind in timeline:
+        if kind == 'release':
+            last_release = t
+        elif last_release is not None:
+            latencies.append(t - last_release)
+            last_release = None
+    latencies.sort()
+
+    print('clients=%d txns=%d wall=%.2fs' % (clients, clients * txns, wall))
+    print('server cpu: %.2fs (%.0f%% of wall)' % (cpu, 100.0 * cpu / wall))
+    print('grant latency: p50=%.2fms p99=%.2fms' % (percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3))
+
+if __name__ == '__main__':
+    main()
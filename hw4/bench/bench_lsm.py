@@ -0,0 +1,92 @@
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import DBMStore, LSMKVStore
+
+"""
+Write throughput and point-read latency of LSMKVStore against DBMStore. Each
+store is loaded with n keys, in random order, by transactions of TXN_LENGTH
+writes, flushed every POLL transactions as the server does after each poll.
+Neither store syncs to disk, and the memtable of the LSM tree holds
+MEMTABLE_SIZE keys. Then READS random keys that exist, and READS
+that do not, are read one at a time; neither store caches them, since the
+caches hold far fewer keys than n.
+
+Reports the keys written per second (including the compactions of the LSM
+tree, which run as part of its flushes) and the p50/p99 latency of the reads.
+
+The request was for 10M keys (python bench/bench_lsm.py 10000000); the dbm
+module available here is often dbm.dumb, whose index is rewritten on every
+flush, so DBMStore is skipped beyond DBM_LIMIT keys.
+
+    $ python bench/bench_lsm.py [n]
+"""
+
+TXN_LENGTH = 100
+POLL = 10
+READS = 2000
+MEMTABLE_SIZE = 20000
+DBM_LIMIT = 500000
+
+def open_dbm(path):
+    return DBMStore(path, cache_size=1000, batch_size=TXN_LENGTH * POLL)
+
+def open_lsm(path):
+    return LSMKVStore(path, memtable_size=MEMTABLE_SIZE, fsync=False)
+
+def load(store, keys):
+    start = time.time()
+    for i in range(0, len(keys), TXN_LENGTH):
+        writes = {}
+        for key in keys[i:i + TXN_LENGTH]:
+            store.put(key, 'v' + key)
+            writes[key] = 'v' + key
+        store.commit(i, writes)
+        if (i // TXN_LENGTH) % POLL == POLL - 1:
+            store.flush()
+    store.flush()
+    return len(keys) / (time.time() - start)
+
+def read_latencies(store, keys):
+    latencies = []
+    for key in keys:
+        start = time.time()
+        store.get(key)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rng = random.Random(0)
+    keys = ['k%09d' % (i) for i in range(n)]
+    rng.shuffle(keys)
+    hits = rng.sample(keys, READS)
+    misses = ['m%09d' % (rng.randrange(n)) for _ in range(READS)]
+    directory = tempfile.mkdtemp()
+    print('%d keys' % (n))
+    print('%-8s %12s %14s %14s %14s %14s' % ('store', 'writes/s', 'hit p50(us)', 'hit p99(us)', 'miss p50(us)', 'miss p99(us)'))
+    try:
+        for name, open_store in [('dbm', open_dbm), ('lsm', open_lsm)]:
+            if name == 'dbm' and n > DBM_LIMIT:
+                print('%-8s skipped' % (name))
+                continue
+            store = open_store(os.path.join(directory, name))
+            writes = load(store, keys)
+            hit_p50, hit_p99 = read_latencies(store, hits)
+            miss_p50, miss_p99 = read_latencies(store, misses)
+            store.close()
+            print('%-8s %12.0f %14.1f %14.1f %14.1f %14.1f' % (name, writes, hit_p50 * 1e6, hit_p99 * 1e6, miss_p50 * 1e6, miss_p99 * 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
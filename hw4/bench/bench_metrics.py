@@ -0,0 +1,109 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.client import KVStoreClient
+from infra.server import KVStoreServer
+
+"""
+Cost of the server's metrics. Each workload runs against a server with
+metrics on and off, REPEATS times each, and reports the CPU time the server
+spends in run() per request (the best run), which unlike throughput does not
+depend on the CPU time of the clients.
+
+pipelined: one client runs transactions of TXN_LENGTH requests on its own
+keys, PUT and GET alternately, DEPTH requests at a time.
+contended: CLIENTS threads run transactions of 4 requests on NUM_KEYS keys,
+half of them PUTs, so that many requests wait for locks.
+
+    $ python bench/bench_metrics.py [transactions]
+"""
+
+REPEATS = 5
+TXN_LENGTH = 256
+DEPTH = 16
+CLIENTS = 8
+NUM_KEYS = 20
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def run_server(metrics, max_handlers, result):
+    server = KVStoreServer(metrics=metrics, max_handlers=max_handlers)
+    start = cpu_time()
+    server.run()
+    result.put(cpu_time() - start)
+
+def pipelined(txns):
+    """
+    @return: the number of requests.
+    """
+    client = KVStoreClient()
+    for txn in range(txns):
+        client.begin()
+        ops = []
+        for i in range(TXN_LENGTH // 2):
+            ops.append('PUT k%d %d' % (i, txn))
+            ops.append('GET k%d' % (i))
+        for i in range(0, len(ops), DEPTH):
+            client.pipeline(ops[i:i + DEPTH])
+        client.commit()
+    client.close()
+    return txns * (TXN_LENGTH + 2)
+
+def contended(txns):
+    counts = []
+    def run_client(index):
+        rng = random.Random(index)
+        client = KVStoreClient()
+        requests = 0
+        for _ in range(txns // CLIENTS):
+            client.begin()
+            for _ in range(4):
+                key = 'k%d' % (rng.randrange(NUM_KEYS))
+                response = client.put(key, '1') if rng.random() < 0.5 else client.get(key)
+                requests += 1
+                if response == 'Deadlock Abort':
+                    break
+            else:
+                client.commit()
+            requests += 2
+        client.close()
+        counts.append(requests)
+    threads = [threading.Thread(target=run_client, args=(i,)) for i in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+
+def measure(workload, clients, txns, metrics):
+    result = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, args=(metrics, clients, result))
+    server.start()
+    time.sleep(0.5)
+    requests = workload(txns)
+    cpu = result.get()
+    server.join()
+    return cpu / requests
+
+def main():
+    txns = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print('%-12s %14s %14s %10s' % ('workload', 'off(us/req)', 'on(us/req)', 'overhead'))
+    for name, workload, clients, workload_txns in [('pipelined', pipelined, 1, txns), ('contended', contended, CLIENTS, txns * 20)]:
+        off, on = [], []
+        for _ in range(REPEATS):
+            off.append(measure(workload, clients, workload_txns, False))
+            on.append(measure(workload, clients, workload_txns, True))
+        print('%-12s %14.2f %14.2f %9.1f%%' % (name, min(off) * 1e6, min(on) * 1e6, (min(on) / min(off) - 1) * 100))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+from __future__ import print_function
+
+import sys
+
+from loadgen import run_load
+
+"""
+Optimistic concurrency control against two-phase locking, with the load
+generator. CLIENTS processes run transactions of TXN_LENGTH requests on
+NUM_KEYS keys, at increasing Zipf skew, for a read-mostly and a write-heavy
+mix. Reports commits per second, p99 latency and the abort rate: deadlock
+aborts under 2PL, validation aborts under OCC.
+
+    $ python bench/bench_occ.py [seconds]
+"""
+
+CLIENTS = 8
+TXN_LENGTH = 4
+NUM_KEYS = 1000
+SKEWS = [0.0, 0.6, 0.9, 1.2]
+WRITE_FRACTIONS = [0.1, 0.5]
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    print('%-8s %6s %6s %12s %10s %10s' % ('writes', 'skew', 'cc', 'commits/s', 'p99(ms)', 'aborts'))
+    for write_fraction in WRITE_FRACTIONS:
+        for skew in SKEWS:
+            for cc in ['2pl', 'occ']:
+                result = run_load(spawn=True, cc=cc, processes=CLIENTS, duration=duration, txn_length=TXN_LENGTH,
+                                  write_fraction=write_fraction, num_keys=NUM_KEYS, skew=skew)
+                print('%-8s %6.1f %6s %12.0f %10.2f %9.1f%%' % ('%d%%' % (write_fraction * 100), skew, cc, result['throughput'],
+                                                               result['latency_ms'].get('p99', 0), result['abort_rate'] * 100))
+
+if __name__ == '__main__':
+    main()
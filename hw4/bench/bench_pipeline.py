@@ -0,0 +1,69 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.client import KVStoreClient
+from infra.server import KVStoreServer
+
+"""
+Operations per second of a single client, by pipeline depth. The client runs
+transactions of TXN_LENGTH operations, alternating PUT and GET on its own
+keys, sending depth requests at a time before reading their responses. The
+last line sends each transaction as one MPUT and one MGET instead.
+
+    $ python bench/bench_pipeline.py [transactions per depth]
+"""
+
+DEPTHS = [1, 16, 256]
+TXN_LENGTH = 256
+
+def run_server(max_handlers):
+    KVStoreServer(max_handlers=max_handlers).run()
+
+def operations(txn):
+    ops = []
+    for i in range(TXN_LENGTH // 2):
+        ops.append('PUT k%d %d' % (i, txn))
+        ops.append('GET k%d' % (i))
+    return ops
+
+def run_pipelined(depth, txns):
+    start = time.time()
+    for txn in range(txns):
+        client = KVStoreClient()
+        ops = operations(txn)
+        for i in range(0, len(ops), depth):
+            client.pipeline(ops[i:i + depth])
+        client.commit()
+        client.close()
+    return txns * TXN_LENGTH / (time.time() - start)
+
+def run_batched(txns):
+    start = time.time()
+    for txn in range(txns):
+        client = KVStoreClient()
+        keys = ['k%d' % i for i in range(TXN_LENGTH // 2)]
+        client.put_many([(key, str(txn)) for key in keys])
+        client.get_many(keys)
+        client.commit()
+        client.close()
+    return txns * TXN_LENGTH / (time.time() - start)
+
+def main():
+    txns = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    server = multiprocessing.Process(target=run_server, args=(txns * (len(DEPTHS) + 1),))
+    server.start()
+    time.sleep(0.5)
+    print('%-12s %12s' % ('depth', 'ops/s'))
+    for depth in DEPTHS:
+        print('%-12d %12.0f' % (depth, run_pipelined(depth, txns)))
+    print('%-12s %12.0f' % ('MPUT+MGET', run_batched(txns)))
+    server.join()
+
+if __name__ == '__main__':
+    main()
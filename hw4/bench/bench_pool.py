@@ -0,0 +1,91 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.client import KVStoreClient, KVStoreClientPool
+from infra.server import KVStoreServer
+from infra.utils import SOCKET_FILE
+
+"""
+Cost of a connection per transaction. CLIENTS threads run short transactions
+(TXN_LENGTH requests on their own keys) for DURATION seconds, either opening a
+new connection for each transaction or taking one from a KVStoreClientPool,
+over the Unix socket and over TCP. Reports transactions per second and the
+p50/p99 transaction latency, including the time to connect.
+
+    $ python bench/bench_pool.py [clients]
+"""
+
+TCP_ADDRESS = ('127.0.0.1', 18186)
+DURATION = 2.0
+TXN_LENGTH = 2
+
+def run_server(address):
+    KVStoreServer(address=address).run()
+
+def run_transaction(client, index, i):
+    client.put('k%d' % index, str(i))
+    for _ in range(TXN_LENGTH - 1):
+        client.get('k%d' % index)
+    client.commit()
+
+def run_connect(index, address, pool, deadline, latencies):
+    i = 0
+    while time.time() < deadline:
+        start = time.time()
+        client = KVStoreClient(address=address)
+        run_transaction(client, index, i)
+        client.close()
+        latencies.append(time.time() - start)
+        i += 1
+
+def run_pooled(index, address, pool, deadline, latencies):
+    i = 0
+    while time.time() < deadline:
+        start = time.time()
+        client = pool.begin()
+        run_transaction(client, index, i)
+        pool.release(client)
+        latencies.append(time.time() - start)
+        i += 1
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def measure(address, run, clients):
+    server = multiprocessing.Process(target=run_server, args=(address,))
+    server.start()
+    time.sleep(0.5)
+    pool = KVStoreClientPool(max_idle=clients, address=address)
+
+    latencies = []
+    deadline = time.time() + DURATION
+    threads = [threading.Thread(target=run, args=(i, address, pool, deadline, latencies)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    pool.close()
+    server.terminate()
+    server.join()
+    latencies.sort()
+    return len(latencies) / DURATION, percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    print('%d clients, %d requests per transaction' % (clients, TXN_LENGTH + 1))
+    print('%-20s %10s %10s %10s' % ('mode', 'txns/s', 'p50(ms)', 'p99(ms)'))
+    for transport, address in [('unix', SOCKET_FILE), ('tcp', TCP_ADDRESS)]:
+        for name, run in [('connect', run_connect), ('pool', run_pooled)]:
+            txns, p50, p99 = measure(address, run, clients)
+            print('%-20s %10.0f %10.2f %10.2f' % ('%s, %s' % (transport, name), txns, p50 * 1e3, p99 * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.client import KVStoreClient
+from infra.server import KVStoreServer
+from infra.utils import SOCKET_FILE, KVStoreError
+from kvstore import MVCCKVStore
+
+"""
+Read scale-out and replication lag of a primary with two read-only replicas,
+all on this machine. Each configuration starts a primary and REPLICAS
+replicas, loads NUM_KEYS keys, then runs WRITERS processes committing
+transactions that PUT WRITE_LENGTH keys on the primary, and READERS
+processes running read-only transactions that MGET READ_LENGTH keys, spread
+over the servers of the configuration:
+
+primary: every reader on the primary.
+replicas: the readers split between the replicas.
+all: the readers split between the primary and the replicas.
+
+Reports the read and write transactions per second, and the replication
+lag: the time from commit on the primary to apply on a replica (p50, p99,
+over both replicas), and the largest number of entries a replica was behind,
+sampled every SAMPLE_INTERVAL seconds. On a machine with fewer cores than
+servers, the servers share the cores, and reads cannot scale out.
+
+    $ python bench/bench_replication.py [seconds]
+"""
+
+REPLICAS = 2
+WRITERS = 2
+READERS = 6
+NUM_KEYS = 10000
+WRITE_LENGTH = 4
+READ_LENGTH = 8
+SAMPLE_INTERVAL = 0.2
+
+PRIMARY = SOCKET_FILE
+REPLICATION = SOCKET_FILE + '.replication'
+
+CONFIGS = ['primary', 'replicas', 'all']
+
+def replica_address(index):
+    return '%s.replica%d' % (SOCKET_FILE, index)
+
+def run_primary():
+    KVStoreServer(kvstore_class=MVCCKVStore, address=PRIMARY, replication_address=REPLICATION).run()
+
+def run_replica(index):
+    KVStoreServer(kvstore_class=MVCCKVStore, address=replica_address(index), replica_of=REPLICATION).run()
+
+def stats(address):
+    client = KVStoreClient(address=address)
+    try:
+        return client.stats()['replication']
+    finally:
+        client.commit()
+        client.close()
+
+def load():
+    client = KVStoreClient(address=PRIMARY)
+    for start in range(0, NUM_KEYS, 1000):
+        client.begin()
+        client.put_many([('k%d' % (i), 'v0') for i in range(start, min(start + 1000, NUM_KEYS))])
+        client.commit()
+    client.close()
+    seq = stats(PRIMARY)['seq']
+    while any(stats(replica_address(i))['applied_seq'] < seq for i in range(REPLICAS)):
+        time.sleep(0.1)
+
+def write(index, deadline, results):
+    rng = random.Random(index)
+    client = KVStoreClient(address=PRIMARY)
+    done = 0
+    while time.time() < deadline:
+        keys = sorted(set('k%d' % (rng.randrange(NUM_KEYS)) for _ in range(WRITE_LENGTH)))
+        mput = 'MPUT ' + ' '.join('%s v%d' % (key, done) for key in keys)
+        if client.pipeline(['BEGIN', mput, 'COMMIT'])[-1] == 'Transaction Completed':
+            done += 1
+    client.close()
+    results.put(('write', done))
+
+def read(index, address, deadline, results):
+    rng = random.Random(-1 - index)
+    client = KVStoreClient(address=address)
+    done = 0
+    while time.time() < deadline:
+        mget = 'MGET ' + ' '.join('k%d' % (rng.randrange(NUM_KEYS)) for _ in range(READ_LENGTH))
+        responses = client.pipeline(['BEGIN', 'READONLY', mget, 'COMMIT'])
+        if responses[-1] != 'Transaction Completed':
+            raise KVStoreError('Read failed: %r' % (responses))
+        done += 1
+    client.close()
+    results.put(('read', done))
+
+def measure(config, duration):
+    servers = [multiprocessing.Process(target=run_primary)]
+    servers[0].start()
+    time.sleep(0.3)
+    for i in range(REPLICAS):
+        servers.append(multiprocessing.Process(target=run_replica, args=(i,)))
+        servers[-1].start()
+    time.sleep(0.3)
+    try:
+        load()
+        replicas = [replica_address(i) for i in range(REPLICAS)]
+        targets = {'primary': [PRIMARY], 'replicas': replicas, 'all': [PRIMARY] + replicas}[config]
+        results = multiprocessing.Queue()
+        deadline = time.time() + duration
+        clients = [multiprocessing.Process(target=write, args=(i, deadline, results)) for i in range(WRITERS)]
+        clients += [multiprocessing.Process(target=read, args=(i, targets[i % len(targets)], deadline, results)) for i in range(READERS)]
+        for client in clients:
+            client.start()
+        behind = 0
+        while time.time() < deadline:
+            time.sleep(SAMPLE_INTERVAL)
+            behind = max([behind] + [stats(address)['lag_entries'] for address in replicas])
+        totals = {'read': 0, 'write': 0}
+        for _ in clients:
+            kind, done = results.get()
+            totals[kind] += done
+        for client in clients:
+            client.join()
+        lag = [stats(address)['lag'] for address in replicas]
+    finally:
+        # Replicas first, so that they do not report losing the primary
+        for server in reversed(servers):
+            server.terminate()
+            server.join()
+    return totals, lag, behind
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    print('%d replicas, %d writers, %d readers, %d CPUs' % (REPLICAS, WRITERS, READERS, multiprocessing.cpu_count()))
+    print('%-10s %10s %10s %14s %14s %14s' % ('reads on', 'reads/s', 'writes/s', 'lag p50(ms)', 'lag p99(ms)', 'max behind'))
+    for config in CONFIGS:
+        totals, lag, behind = measure(config, duration)
+        # Both replicas apply the same entries, so the worse one is reported
+        p50 = max(summary.get('p50', 0) for summary in lag) / 1000.0
+        p99 = max(summary.get('p99', 0) for summary in lag) / 1000.0
+        print('%-10s %10.0f %10.0f %14.2f %14.2f %14d' % (config, totals['read'] / duration, totals['write'] / duration, p50, p99, behind))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+from __future__ import print_function
+
+import sys
+
+from loadgen import run_load
+
+"""
+Tail latency of high- and low-priority transactions under each lock grant
+scheduler, with the load generator. CLIENTS processes run transactions of
+TXN_LENGTH requests, half of them PUTs, on NUM_KEYS hot keys drawn with Zipf
+skew SKEW; HIGH_PRIORITY of the transactions have priority 1. Reports commits
+per second, the abort rate and the p50/p99 commit latency of each class.
+
+fifo: the default, FIFO order with upgrades first.
+batch: every compatible waiter is granted, overtaking conflicting ones at
+most MAX_BYPASS times each.
+priority: requests wait ahead of those of lower priority, without aging.
+aging: as priority, but a request is overtaken at most MAX_BYPASS times.
+
+    $ python bench/bench_scheduler.py [seconds]
+"""
+
+CLIENTS = 8
+TXN_LENGTH = 4
+NUM_KEYS = 50
+SKEW = 0.99
+HIGH_PRIORITY = 0.2
+MAX_BYPASS = 4
+
+SCHEDULERS = [
+    ('fifo', {}),
+    ('batch', {'batch': True, 'max_bypass': MAX_BYPASS}),
+    ('priority', {'priorities': True}),
+    ('aging', {'priorities': True, 'max_bypass': MAX_BYPASS}),
+]
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    print('%-10s %10s %8s %14s %14s %14s %14s' % ('scheduler', 'commits/s', 'aborts', 'high p50(ms)', 'high p99(ms)',
+                                                  'low p50(ms)', 'low p99(ms)'))
+    for name, options in SCHEDULERS:
+        result = run_load(spawn=True, processes=CLIENTS, duration=duration, txn_length=TXN_LENGTH, write_fraction=0.5,
+                          num_keys=NUM_KEYS, skew=SKEW, high_priority=HIGH_PRIORITY, **options)
+        high = result['latency_ms_by_priority']['high']
+        low = result['latency_ms_by_priority']['low']
+        print('%-10s %10.0f %7.1f%% %14.2f %14.2f %14.2f %14.2f' % (name, result['throughput'], result['abort_rate'] * 100,
+                                                                  high.get('p50', 0), high.get('p99', 0),
+                                                                  low.get('p50', 0), low.get('p99', 0)))
+
+if __name__ == '__main__':
+    main()
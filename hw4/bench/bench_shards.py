@@ -0,0 +1,97 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.client import KVStoreClient
+from infra.server import KVStoreServer
+from infra.sharding import ShardedKVStoreServer
+from sim import ZipfGenerator
+
+"""
+Throughput of the sharded server with 1, 2, 4 and 8 shards, against the
+single-process server. CLIENTS client processes run transactions of
+TXN_LENGTH requests back to back on persistent connections, each request a
+PUT with probability WRITE_FRACTION and a GET otherwise, on keys drawn
+uniformly or from a Zipf distribution over NUM_KEYS keys. Reports commits per
+second and the abort rate.
+
+The shards only run in parallel on a machine with more than one core; the
+number of cores is printed first.
+
+    $ python bench/bench_shards.py [seconds]
+"""
+
+SHARDS = [1, 2, 4, 8]
+CLIENTS = 16
+TXN_LENGTH = 4
+WRITE_FRACTION = 0.5
+NUM_KEYS = 10000
+
+def run_server(num_shards):
+    if num_shards is None:
+        KVStoreServer().run()
+    else:
+        ShardedKVStoreServer(num_shards).run()
+
+def run_client(index, skew, deadline, results):
+    rng = random.Random(index)
+    keys = ZipfGenerator(NUM_KEYS, skew, rng)
+    client = KVStoreClient()
+    commits = aborts = 0
+    while time.time() < deadline:
+        client.begin()
+        aborted = False
+        for _ in range(TXN_LENGTH):
+            key = 'k%d' % (keys.next())
+            if rng.random() < WRITE_FRACTION:
+                response = client.put(key, str(index))
+            else:
+                response = client.get(key)
+            if response == 'Deadlock Abort':
+                aborted = True
+                break
+        if not aborted and client.commit() == 'Transaction Completed':
+            commits += 1
+        else:
+            aborts += 1
+    client.close()
+    results.put((commits, aborts))
+
+def measure(num_shards, skew, duration):
+    server = multiprocessing.Process(target=run_server, args=(num_shards,))
+    server.start()
+    time.sleep(0.5 + 0.1 * (num_shards or 0))
+    results = multiprocessing.Queue()
+    deadline = time.time() + duration
+    clients = [multiprocessing.Process(target=run_client, args=(i, skew, deadline, results)) for i in range(CLIENTS)]
+    for client in clients:
+        client.start()
+    commits = aborts = 0
+    for _ in clients:
+        client_commits, client_aborts = results.get()
+        commits += client_commits
+        aborts += client_aborts
+    for client in clients:
+        client.join()
+    server.terminate()
+    server.join()
+    return commits / duration, float(aborts) / max(1, commits + aborts)
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    print('%d cores, %d clients, %d requests per transaction, %d keys' % (multiprocessing.cpu_count(), CLIENTS, TXN_LENGTH, NUM_KEYS))
+    print('%-12s %-8s %12s %10s' % ('server', 'keys', 'commits/s', 'aborts'))
+    for name, skew in [('uniform', 0.0), ('zipf', 0.99)]:
+        for num_shards in [None] + SHARDS:
+            commits, abort_rate = measure(num_shards, skew, duration)
+            server = 'single' if num_shards is None else '%d shards' % (num_shards)
+            print('%-12s %-8s %12.0f %9.1f%%' % (server, name, commits, abort_rate * 100))
+
+if __name__ == '__main__':
+    main()
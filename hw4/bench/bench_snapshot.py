@@ -0,0 +1,113 @@
+from __future__ import print_function
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import DurableKVStore, InMemoryKVStore
+from snapshot import Checkpointer, read_snapshot, write_snapshot
+from wal import encode_record, write_checkpoint
+
+"""
+Restart time of a store of n keys, by each way of getting the data back:
+
+replay log: DurableKVStore redoing a write-ahead log of n commits, one PUT
+each, the restart path of a store that was never checkpointed.
+replay puts: n PUTs and commits on a new InMemoryKVStore, in process, a
+lower bound for replaying the PUTs through the server.
+checkpoint: DurableKVStore loading its checkpoint (records of repr() tuples).
+snapshot: read_snapshot() and InMemoryKVStore.load(), the binary snapshot
+loaded through mmap.
+
+Then the cost of taking a snapshot of the loaded store: writing it in the
+foreground, and with Checkpointer, how long the parent is stalled by the
+fork and how long the child takes. Keys are 'k0' to 'k<n-1>' and values of
+VALUE_SIZE bytes. Files are written without fsync.
+
+The request was for 10M keys (python bench/bench_snapshot.py 10000000).
+
+    $ python bench/bench_snapshot.py [keys]
+"""
+
+VALUE_SIZE = 16
+
+def timed(fn):
+    gc.collect()
+    start = time.time()
+    result = fn()
+    return time.time() - start, result
+
+def make_data(n):
+    value = 'v' * VALUE_SIZE
+    return dict(('k%d' % (i), value) for i in range(n))
+
+def write_log(path, data):
+    with open(path, 'wb') as f:
+        for seq, item in enumerate(data.items()):
+            f.write(encode_record((seq + 1, seq, (item,))))
+
+def replay_puts(n):
+    store = InMemoryKVStore()
+    value = 'v' * VALUE_SIZE
+    for xid in range(n):
+        key = 'k%d' % (xid)
+        store.put(key, value)
+        store.commit(xid, {key: value})
+    return store
+
+def load_snapshot(path):
+    store = InMemoryKVStore()
+    store.load(read_snapshot(path))
+    return store
+
+def size(path):
+    return os.path.getsize(path) / 2.0 ** 20
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    directory = tempfile.mkdtemp()
+    try:
+        log_store = os.path.join(directory, 'log')
+        checkpoint_store = os.path.join(directory, 'checkpoint')
+        snapshot_path = os.path.join(directory, 'snapshot')
+        data = make_data(n)
+        write_log(log_store + '.log', data)
+        write_checkpoint(checkpoint_store + '.checkpoint', n, data.items(), fsync=False)
+        write_snapshot(snapshot_path, data, fsync=False)
+        sizes = {'replay log': size(log_store + '.log'), 'checkpoint': size(checkpoint_store + '.checkpoint'),
+                 'snapshot': size(snapshot_path)}
+
+        print('%d keys' % (n))
+        print('%-12s %10s %12s' % ('restart', 'seconds', 'file (MB)'))
+        results = [
+            ('replay log', lambda: DurableKVStore(log_store, fsync=False, checkpoint_interval=n + 1)),
+            ('replay puts', lambda: replay_puts(n)),
+            ('checkpoint', lambda: DurableKVStore(checkpoint_store, fsync=False, checkpoint_interval=n + 1)),
+            ('snapshot', lambda: load_snapshot(snapshot_path)),
+        ]
+        del data
+        store = None
+        for name, restart in results:
+            store = None
+            elapsed, store = timed(restart)
+            if len(store._kv_store) != n:
+                raise AssertionError('%s restored %d keys' % (name, len(store._kv_store)))
+            print('%-12s %10.2f %12s' % (name, elapsed, '%.1f' % (sizes[name]) if name in sizes else '-'))
+
+        # The last store restored is the one loaded from the snapshot
+        elapsed, _ = timed(lambda: write_snapshot(snapshot_path, store.data(), fsync=False))
+        print('snapshot write in the foreground: %.2f s' % (elapsed))
+        checkpointer = Checkpointer(snapshot_path, fsync=False)
+        stall, _ = timed(lambda: checkpointer.start(lambda: (store.data(), None)))
+        checkpointer.wait()
+        print('background snapshot: parent stalled %.1f ms, child took %.2f s' % (stall * 1e3, checkpointer.duration))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
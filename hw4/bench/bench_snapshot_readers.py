@@ -0,0 +1,34 @@
+from __future__ import print_function
+
+import sys
+
+from sim import Simulation
+from kvstore import MVCCKVStore
+from locktable import LockTable
+
+"""
+Writer latency as long read-only transactions are added, with the readers
+taking S locks (2PL) or reading snapshots. Writers run short read/write
+transactions on a skewed key space; each reader GETs 100 keys. Latency is
+reported in simulator rounds, which only grows while a writer waits for locks,
+and in milliseconds, which also grows with the CPU time spent on readers.
+
+    $ python bench/bench_snapshot_readers.py [seconds]
+"""
+
+READERS = [0, 4, 16, 64]
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    print('%-8s %8s %10s %10s %8s %10s %10s %8s %8s' % ('readers', 'mode', 'commits/s', 'reads/s', 'aborts', 'p50(rnd)', 'p99(rnd)', 'p50(ms)', 'p99(ms)'))
+    for readers in READERS:
+        for name, snapshot_readers in [('2pl', False), ('snapshot', True)]:
+            sim = Simulation(LockTable(), clients=8, txn_length=4, write_fraction=0.5, num_keys=1000, skew=0.99,
+                             store=MVCCKVStore(), readers=readers, reader_length=100, snapshot_readers=snapshot_readers)
+            result = sim.run(duration)
+            print('%-8d %8s %10.0f %10.0f %7.1f%% %10d %10d %8.2f %8.2f' % (
+                readers, name, result['throughput'], result['reader_commits'] * 100 / duration,
+                result['abort_rate'] * 100, result['p50_rounds'], result['p99_rounds'], result['p50'] * 1e3, result['p99'] * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import InMemoryKVStore
+from locktable import LockTable
+from locktrace import RingBuffer, TraceWriter
+from student import TransactionHandler
+
+"""
+Cost of tracing the lock manager. Transactions of TXN_LENGTH requests, half
+of them PUTs, run one after the other on NUM_KEYS keys, while another
+transaction holds shared locks on a number of other keys, so that the lock
+table has that many entries. Reports transactions per second, without a
+tracer, with a RingBuffer, with a TraceWriter, and with a tracer that prints
+the whole lock table on every event, as the debugging prints in the handler
+used to.
+
+    $ python bench/bench_trace.py [transactions]
+"""
+
+TABLE_SIZES = [10, 100, 1000]
+TXN_LENGTH = 4
+NUM_KEYS = 100
+REPEATS = 3
+
+class PrintTracer(object):
+
+    def __init__(self, lock_table, out):
+        self._lock_table = lock_table
+        self._out = out
+
+    def __call__(self, event, xid, key, mode=None):
+        print(event, xid, key, mode, str(self._lock_table), file=self._out)
+
+def run(txns, table_size, make_tracer):
+    lock_table = LockTable()
+    store = InMemoryKVStore()
+    tracer = make_tracer(lock_table)
+    reader = TransactionHandler(lock_table, 0, store)
+    for i in range(table_size):
+        reader.perform_get('bg%d' % (i))
+    rng = random.Random(0)
+    start = time.time()
+    for xid in range(1, txns + 1):
+        t = TransactionHandler(lock_table, xid, store, tracer=tracer)
+        for _ in range(TXN_LENGTH):
+            key = 'k%d' % (rng.randrange(NUM_KEYS))
+            if rng.random() < 0.5:
+                t.perform_put(key, 'v')
+            else:
+                t.perform_get(key)
+        t.commit()
+    if hasattr(tracer, 'close'):
+        tracer.close()
+    return txns / (time.time() - start)
+
+def main():
+    txns = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    directory = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    tracers = [
+        ('off', lambda lock_table: None),
+        ('ring', lambda lock_table: RingBuffer()),
+        ('file', lambda lock_table: TraceWriter(os.path.join(directory, 'trace'))),
+        ('print', lambda lock_table: PrintTracer(lock_table, devnull)),
+    ]
+    print('%-8s' % ('tracer') + ''.join('%14s' % ('%d locks' % (size)) for size in TABLE_SIZES) + '  (txns/s)')
+    try:
+        for name, make_tracer in tracers:
+            row = []
+            for size in TABLE_SIZES:
+                # The print tracer is too slow to run every transaction
+                n = txns if name != 'print' else max(1, txns // 10)
+                row.append(max(run(n, size, make_tracer) for _ in range(REPEATS)))
+            print('%-8s' % (name) + ''.join('%14.0f' % (rate) for rate in row))
+    finally:
+        devnull.close()
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
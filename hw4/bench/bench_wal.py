@@ -0,0 +1,57 @@
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import DurableKVStore
+from locktable import LockTable
+from student import TransactionHandler
+
+"""
+Commit throughput of DurableKVStore. In each round, group_size transactions
+write two keys each and commit, as if they were handled by the server in one
+poll, then the server flushes the store. With group commit, the round costs
+one fsync; without it, every commit pays its own fsync.
+
+    $ python bench/bench_wal.py [commits per run]
+"""
+
+GROUP_SIZES = [1, 2, 4, 8, 16, 32, 64]
+
+def run(directory, group_size, group_commit, commits):
+    path = os.path.join(directory, 'kvstore_%d_%d' % (group_size, group_commit))
+    store = DurableKVStore(path, group_commit=group_commit, checkpoint_interval=commits + 1)
+    lock_table = LockTable()
+    xid = 0
+    start = time.time()
+    while xid < commits:
+        for _ in range(group_size):
+            txn = TransactionHandler(lock_table, xid, store)
+            txn.perform_put('k%d' % (xid % 1000), str(xid))
+            txn.perform_put('n%d' % (xid % 1000), str(xid))
+            txn.commit()
+            xid += 1
+        store.flush()
+    elapsed = time.time() - start
+    store.close()
+    return xid / elapsed
+
+def main():
+    commits = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    directory = tempfile.mkdtemp(dir='.')
+    try:
+        print('%-12s %16s %16s' % ('group size', 'batched (c/s)', 'unbatched (c/s)'))
+        for group_size in GROUP_SIZES:
+            batched = run(directory, group_size, True, commits)
+            unbatched = run(directory, group_size, False, commits)
+            print('%-12d %16.0f %16.0f' % (group_size, batched, unbatched))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from infra.client import KVStoreClient
+from infra.server import KVStoreServer
+from infra.sharding import ShardedKVStoreServer
+from infra.utils import SOCKET_FILE, KVStoreError
+from locktable import DETECT, TIMEOUT, WAIT_DIE, WOUND_WAIT, GrantScheduler
+from sim import ZipfGenerator
+
+"""
+Load generator for the server. Client processes run transactions of
+txn_length requests on persistent connections (BEGIN), each request a PUT
+with probability write_fraction and a GET otherwise, on keys drawn from a
+Zipf distribution over num_keys keys (skew 0 is uniform). A transaction that
+gets through all of its requests commits, or aborts with probability
+abort_fraction.
+
+With rate 0, each process starts its next transaction as soon as the last
+one ends (closed loop). Otherwise the processes together start rate
+transactions per second at evenly spaced times (open loop), and a
+transaction's latency is measured from the time it was due to start, so
+that the time it spent waiting behind the previous one counts.
+
+Transactions that start in the first warmup seconds are run but not counted.
+The result is a dict, printed as JSON, of the configuration, the
+transactions per second that committed and that were attempted, the commit
+latency (mean, p50, p95, p99, max, in milliseconds), the fraction of
+transactions that aborted for any reason, for deadlocks (Deadlock Abort)
+and for failing optimistic validation (Validation Abort), the number of
+errors, and the server's STATS at the end, if it answers them.
+
+A fraction high_priority of the transactions are given priority 1 (the
+PRIORITY command), and the others priority 0; the latency of each class is
+also reported separately. Priorities only change the order in which locks are
+granted on a server whose GrantScheduler has priorities.
+
+Runs against a server at address, or starts one (--spawn) with the given
+deadlock policy and number of shards, under locking (2pl) or optimistic
+concurrency control (occ). The lock requests of the spawned server are
+granted in FIFO order, unless --batch, --priorities, --max-bypass or
+--upgrades-queued configure its GrantScheduler.
+
+    $ python bench/loadgen.py --spawn --processes 8 --duration 5 --skew 0.99
+"""
+
+POLICIES = {'detect': DETECT, 'wait-die': WAIT_DIE, 'wound-wait': WOUND_WAIT, 'timeout': TIMEOUT}
+
+DEFAULTS = {
+    'address': SOCKET_FILE,
+    'processes': 8,
+    'duration': 5.0,
+    'warmup': 0.5,
+    'rate': 0.0,
+    'txn_length': 4,
+    'write_fraction': 0.5,
+    'abort_fraction': 0.0,
+    'num_keys': 10000,
+    'skew': 0.0,
+    'seed': 0,
+    'spawn': False,
+    'policy': 'detect',
+    'shards': 0,
+    'cc': '2pl',
+    'high_priority': 0.0,
+    'batch': False,
+    'priorities': False,
+    'max_bypass': None,
+    'upgrades_queued': False,
+}
+
+def parse_address(address):
+    """
+    @return: address as a (host, port) pair if it is host:port, or as the
+    path of a Unix socket.
+    """
+    if isinstance(address, tuple) or ':' not in address:
+        return address
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+def run_server(config):
+    address = parse_address(config['address'])
+    policy = POLICIES[config['policy']]
+    if config['shards']:
+        ShardedKVStoreServer(config['shards'], deadlock_policy=policy, address=address).run()
+    else:
+        scheduler = GrantScheduler(batch=config['batch'], priorities=config['priorities'], max_bypass=config['max_bypass'],
+                                   upgrade_first=not config['upgrades_queued'])
+        KVStoreServer(deadlock_policy=policy, address=address, optimistic=config['cc'] == 'occ', scheduler=scheduler).run()
+
+def run_transaction(client, config, rng, keys, index, priority):
+    """
+    @return: 'commit', 'abort', 'deadlock' or 'validation'.
+    """
+    client.begin()
+    if priority:
+        client.priority(priority)
+    for _ in range(config['txn_length']):
+        key = 'k%d' % (keys.next())
+        if rng.random() < config['write_fraction']:
+            response = client.put(key, str(index))
+        else:
+            response = client.get(key)
+        if response == 'Deadlock Abort':
+            return 'deadlock'
+    if rng.random() < config['abort_fraction']:
+        client.abort()
+        return 'abort'
+    response = client.commit()
+    if response == 'Transaction Completed':
+        return 'commit'
+    if response == 'Validation Abort':
+        return 'validation'
+    return 'deadlock' if response == 'Deadlock Abort' else 'abort'
+
+def run_client(config, index, start, results):
+    rng = random.Random(config['seed'] * 1000003 + index)
+    keys = ZipfGenerator(config['num_keys'], config['skew'], rng)
+    address = parse_address(config['address'])
+    measure_from = start + config['warmup']
+    deadline = measure_from + config['duration']
+    counts = {'commit': 0, 'abort': 0, 'deadlock': 0, 'validation': 0, 'error': 0}
+    latencies = []
+    client = None
+    if config['rate'] > 0:
+        interval = config['processes'] / config['rate']
+        due = start + interval * index / config['processes']
+    else:
+        interval = 0
+        due = start
+    while True:
+        now = time.time()
+        if config['rate'] > 0:
+            if due >= deadline:
+                break
+            if due > now:
+                time.sleep(due - now)
+        else:
+            due = now
+            if due >= deadline:
+                break
+        priority = 1 if config['high_priority'] > 0 and rng.random() < config['high_priority'] else 0
+        try:
+            if client is None:
+                client = KVStoreClient(address=address)
+            outcome = run_transaction(client, config, rng, keys, index, priority)
+        except (KVStoreError, socket.error):
+            outcome = 'error'
+            if client is not None:
+                client.close()
+            client = None
+        end = time.time()
+        if due >= measure_from:
+            counts[outcome] += 1
+            if outcome == 'commit':
+                latencies.append((end - due, priority))
+        due += interval
+    if client is not None:
+        client.close()
+    results.put((counts, latencies))
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summarize(latencies):
+    """
+    @return: the mean, p50, p95, p99 and max of the sorted latencies, in
+    milliseconds, or {} if there are none.
+    """
+    if not latencies:
+        return {}
+    return {
+        'mean': sum(latencies) * 1e3 / len(latencies),
+        'p50': percentile(latencies, 0.5) * 1e3,
+        'p95': percentile(latencies, 0.95) * 1e3,
+        'p99': percentile(latencies, 0.99) * 1e3,
+        'max': latencies[-1] * 1e3,
+    }
+
+def server_stats(address):
+    try:
+        client = KVStoreClient(address=address)
+        try:
+            return client.stats()
+        finally:
+            client.close()
+    except (KVStoreError, socket.error, ValueError):
+        return None
+
+def run_load(**options):
+    """
+    Runs the load described by options, which override DEFAULTS.
+
+    @return: the result, as described above.
+    """
+    config = dict(DEFAULTS)
+    config.update(options)
+    if config['shards'] and config['cc'] != '2pl':
+        raise ValueError('The sharded server only supports 2pl')
+    if config['shards'] and config['high_priority'] > 0:
+        raise ValueError('The sharded server does not support priorities')
+    server = None
+    if config['spawn']:
+        server = multiprocessing.Process(target=run_server, args=(config,))
+        server.start()
+        time.sleep(0.5 + 0.1 * config['shards'])
+    try:
+        results = multiprocessing.Queue()
+        start = time.time() + 0.2
+        clients = [multiprocessing.Process(target=run_client, args=(config, i, start, results)) for i in range(config['processes'])]
+        for client in clients:
+            client.start()
+        counts = {'commit': 0, 'abort': 0, 'deadlock': 0, 'validation': 0, 'error': 0}
+        latencies = []
+        for _ in clients:
+            client_counts, client_latencies = results.get()
+            for outcome, count in client_counts.items():
+                counts[outcome] += count
+            latencies.extend(client_latencies)
+        for client in clients:
+            client.join()
+        stats = server_stats(parse_address(config['address']))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    latencies.sort()
+    aborts = counts['abort'] + counts['deadlock'] + counts['validation']
+    attempted = counts['commit'] + aborts
+    result = {
+        'config': config,
+        'commits': counts['commit'],
+        'aborts': aborts,
+        'deadlocks': counts['deadlock'],
+        'validation_aborts': counts['validation'],
+        'errors': counts['error'],
+        'throughput': counts['commit'] / config['duration'],
+        'attempted': attempted / config['duration'],
+        'abort_rate': aborts / float(max(1, attempted)),
+        'deadlock_rate': counts['deadlock'] / float(max(1, attempted)),
+        'validation_rate': counts['validation'] / float(max(1, attempted)),
+        'latency_ms': summarize([latency for latency, _ in latencies]),
+        'latency_ms_by_priority': {
+            'high': summarize([latency for latency, priority in latencies if priority]),
+            'low': summarize([latency for latency, priority in latencies if not priority]),
+        },
+        'server': stats,
+    }
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the CS186 KVS.')
+    parser.add_argument('--address', default=DEFAULTS['address'], help='Unix socket path, or host:port')
+    parser.add_argument('--processes', type=int, default=DEFAULTS['processes'], help='client processes')
+    parser.add_argument('--duration', type=float, default=DEFAULTS['duration'], help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=DEFAULTS['warmup'], help='seconds run before measuring')
+    parser.add_argument('--rate', type=float, default=DEFAULTS['rate'], help='offered transactions per second, 0 for a closed loop')
+    parser.add_argument('--txn-length', type=int, default=DEFAULTS['txn_length'], help='requests per transaction')
+    parser.add_argument('--write-fraction', type=float, default=DEFAULTS['write_fraction'], help='fraction of requests that are PUTs')
+    parser.add_argument('--abort-fraction', type=float, default=DEFAULTS['abort_fraction'], help='fraction of transactions that abort instead of committing')
+    parser.add_argument('--num-keys', type=int, default=DEFAULTS['num_keys'], help='size of the key space')
+    parser.add_argument('--skew', type=float, default=DEFAULTS['skew'], help='Zipf skew of the keys, 0 for uniform')
+    parser.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+    parser.add_argument('--spawn', action='store_true', help='start a server for the run')
+    parser.add_argument('--policy', choices=sorted(POLICIES), default=DEFAULTS['policy'], help='deadlock policy of the spawned server')
+    parser.add_argument('--shards', type=int, default=DEFAULTS['shards'], help='shards of the spawned server, 0 for a single process')
+    parser.add_argument('--cc', choices=['2pl', 'occ'], default=DEFAULTS['cc'], help='concurrency control of the spawned server')
+    parser.add_argument('--high-priority', type=float, default=DEFAULTS['high_priority'], help='fraction of transactions given priority 1')
+    parser.add_argument('--batch', action='store_true', help='spawned server grants every compatible waiter, not just a prefix of the queue')
+    parser.add_argument('--priorities', action='store_true', help='spawned server queues requests by transaction priority')
+    parser.add_argument('--max-bypass', type=int, default=DEFAULTS['max_bypass'], help='times a waiting request of the spawned server may be overtaken')
+    parser.add_argument('--upgrades-queued', action='store_true', help='spawned server queues lock upgrades like new requests')
+    parser.add_argument('--output', help='append the result to this file, as one line of JSON')
+    args = parser.parse_args()
+
+    options = dict(vars(args))
+    output = options.pop('output')
+    result = json.dumps(run_load(**options), sort_keys=True)
+    if output is not None:
+        with open(output, 'a') as f:
+            f.write(result + '\n')
+    print(result)
+
+if __name__ == '__main__':
+    main()
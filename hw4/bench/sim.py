@@ -0,0 +1,182 @@
+from __future__ import print_function
+
+import bisect
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kvstore import InMemoryKVStore
+from student import DEADLOCK, TransactionCoordinator, TransactionHandler
+
+"""
+In-process workload simulator for the lock manager. Drives many concurrent
+transactions through TransactionHandler directly, the way the server would,
+without any sockets, so that lock manager policies can be compared on their
+own.
+
+Each simulated client runs transactions of txn_length operations back to
+back. An operation is a PUT with probability write_fraction and a GET
+otherwise, on a key drawn from a Zipf distribution over num_keys keys. In
+every round, each client that is not blocked issues its next operation. After
+each round, the coordinator's victims are aborted, as the server does after
+each poll, and their clients restart with a new transaction.
+
+The simulation can also run reader clients, whose transactions are
+reader_length GETs. If snapshot_readers is set, they are read-only
+transactions, which need a store that keeps versions. Latencies are only
+reported for the other (writer) clients, both in seconds and in rounds. The
+number of rounds a transaction takes does not depend on the CPU time spent
+on other clients, only on how long it waits for locks.
+"""
+
+class ZipfGenerator:
+    """
+    Draws integers in [0, n) with P(i) proportional to 1 / (i + 1) ** skew.
+    skew == 0 is uniform.
+    """
+
+    def __init__(self, n, skew, rng):
+        self._rng = rng
+        self._cdf = []
+        total = 0.0
+        for i in range(n):
+            total += 1.0 / (i + 1) ** skew
+            self._cdf.append(total)
+        self._total = total
+
+    def next(self):
+        return bisect.bisect_left(self._cdf, self._rng.random() * self._total)
+
+class SimulatedClient:
+    def __init__(self, sim, index, reader=False):
+        self._sim = sim
+        self.index = index
+        self.reader = reader
+        self.txn = None
+        self.ops = None
+        self.blocked = False
+        self.granted = False
+        self.started = None
+        self.started_round = None
+
+    def begin(self):
+        sim = self._sim
+        self.txn = sim.new_transaction(self)
+        if self.reader:
+            self.ops = [(False, 'k%d' % sim.keys.next()) for _ in range(sim.reader_length)]
+            if sim.snapshot_readers:
+                self.txn.begin_read_only()
+        else:
+            self.ops = [(sim.rng.random() < sim.write_fraction, 'k%d' % sim.keys.next()) for _ in range(sim.txn_length)]
+        self.blocked = False
+        self.granted = False
+        self.started = time.time()
+        self.started_round = sim.round
+
+    def lock_granted(self):
+        self.granted = True
+
+    def step(self):
+        """
+        Issues the next operation, or commits. Returns True if the
+        transaction committed.
+        """
+        if self.blocked:
+            if not self.granted:
+                return False
+            self.granted = False
+            if self.txn.check_lock() is None:
+                return False
+            self.blocked = False
+            self.ops.pop(0)
+        elif not self.ops:
+            self.txn.commit()
+            return True
+        else:
+            is_write, key = self.ops[0]
+            if is_write:
+                result = self.txn.perform_put(key, str(self.index))
+            else:
+                result = self.txn.perform_get(key)
+            if result is None:
+                self.blocked = True
+            else:
+                self.ops.pop(0)
+        return False
+
+class Simulation:
+    def __init__(self, lock_table, clients=32, txn_length=8, write_fraction=0.5, num_keys=1000, skew=0.99, seed=0, store=None,
+                 readers=0, reader_length=100, snapshot_readers=False):
+        self.rng = random.Random(seed)
+        self.keys = ZipfGenerator(num_keys, skew, self.rng)
+        self.txn_length = txn_length
+        self.write_fraction = write_fraction
+        self.reader_length = reader_length
+        self.snapshot_readers = snapshot_readers
+        self.lock_table = lock_table
+        self.store = store if store is not None else InMemoryKVStore()
+        self.coordinator = TransactionCoordinator(lock_table)
+        self.round = 0
+        self._next_xid = 0
+        self._by_xid = {}
+        self.clients = [SimulatedClient(self, i) for i in range(clients)]
+        self.clients += [SimulatedClient(self, clients + i, reader=True) for i in range(readers)]
+
+    def new_transaction(self, client):
+        xid = self._next_xid
+        self._next_xid += 1
+        self._by_xid[xid] = client
+        return TransactionHandler(self.lock_table, xid, self.store, client.lock_granted)
+
+    def run(self, duration=2.0):
+        """
+        Runs the workload for duration seconds. Returns a dict of counters
+        and latencies (in seconds) of committed writer transactions.
+        """
+        commits = aborts = reader_commits = 0
+        latencies = []
+        rounds = []
+        for client in self.clients:
+            client.begin()
+        start = time.time()
+        while time.time() - start < duration:
+            for client in self.clients:
+                if client.step():
+                    if client.reader:
+                        reader_commits += 1
+                    else:
+                        commits += 1
+                        latencies.append(time.time() - client.started)
+                        rounds.append(self.round - client.started_round)
+                    del self._by_xid[client.txn._xid]
+                    client.begin()
+            victim = self.coordinator.detect_deadlocks()
+            while victim is not None:
+                client = self._by_xid.pop(victim)
+                client.txn.abort(DEADLOCK)
+                aborts += 1
+                client.begin()
+                victim = self.coordinator.detect_deadlocks()
+            self.round += 1
+        elapsed = time.time() - start
+        latencies.sort()
+        rounds.sort()
+        return {
+            'commits': commits,
+            'aborts': aborts,
+            'reader_commits': reader_commits,
+            'throughput': commits / elapsed,
+            'abort_rate': float(aborts) / max(1, commits + aborts),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'p50_rounds': percentile(rounds, 0.5),
+            'p99_rounds': percentile(rounds, 0.99),
+        }
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import random
+from collections import deque
+
+from infra.utils import SOCKET_FILE, KVStoreError, MessageReader, encode_message
+
+"""
+An asyncio client for the server, speaking the same protocol as
+infra/client.py: one connection per transaction, length-prefixed messages,
+and BEGIN to run the next transaction on the same connection. A connection
+costs a coroutine instead of an OS thread, so that one process can keep
+thousands of transactions in flight. Python 3 only.
+
+    client = await AsyncKVStoreClient.connect(address)
+    await client.put('a', '1')
+    await client.commit()
+"""
+
+# Responses that abort the transaction, other than a user's ABORT
+ABORTS = frozenset(['Deadlock Abort', 'Validation Abort'])
+
+class TransactionAborted(KVStoreError):
+    """
+    Raised by a request whose response aborts the transaction: Deadlock Abort,
+    or Validation Abort at COMMIT under optimistic concurrency control. The
+    response is in self.response.
+    """
+
+    def __init__(self, response):
+        KVStoreError.__init__(self, response)
+        self.response = response
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    Reassembles the responses of the server as they arrive, and hands each
+    one to the oldest request waiting for a response.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self._reader = MessageReader()
+        # Futures of the requests waiting for their responses, in order
+        self._waiters = deque()
+        # Responses received before anyone waited for them
+        self._responses = deque()
+        self._error = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        try:
+            messages = self._reader.feed(data)
+        except KVStoreError as e:
+            self._error = e
+            self.transport.close()
+            return
+        for message in messages:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(message)
+            else:
+                self._responses.append(message)
+
+    def connection_lost(self, exc):
+        if self._error is None:
+            self._error = KVStoreError('Connection to server was lost')
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(self._error)
+
+    def next_response(self):
+        """
+        @return: a future of the next response.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self._responses:
+            future.set_result(self._responses.popleft())
+        elif self._error is not None:
+            future.set_exception(self._error)
+        else:
+            self._waiters.append(future)
+        return future
+
+class AsyncKVStoreClient(object):
+    """
+    A connection to the server, created with connect(). Each request returns
+    the response of the server, as KVStoreClient's do, except that responses
+    in ABORTS raise TransactionAborted. Requests on one connection must not
+    be run concurrently: await each one before sending the next.
+
+    timeout: the number of seconds to wait for a response, or None to wait
+    forever. A request that times out raises KVStoreError and closes the
+    connection, since its response could still arrive.
+    """
+
+    def __init__(self, protocol, timeout=None):
+        self._protocol = protocol
+        self.timeout = timeout
+        self._xid = None
+        # False once the transaction has committed or aborted
+        self.in_transaction = False
+
+    @classmethod
+    async def connect(cls, address=SOCKET_FILE, timeout=None):
+        """
+        Connects to the server at address, the path of its Unix socket or a
+        (host, port) pair for TCP, and starts a transaction.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            if isinstance(address, tuple):
+                connection = loop.create_connection(ClientProtocol, *address)
+            else:
+                connection = loop.create_unix_connection(ClientProtocol, address)
+            _, protocol = await asyncio.wait_for(connection, timeout)
+        except (OSError, asyncio.TimeoutError):
+            raise KVStoreError('Server does not seem to be running')
+        client = cls(protocol, timeout)
+        data = await client.recv()
+        try:
+            client._xid = int(data)
+        except ValueError:
+            client.close()
+            raise KVStoreError('Server did not provide valid transaction id: %r' % (data))
+        client.in_transaction = True
+        return client
+
+    async def recv(self):
+        """
+        @return: the next response from the server.
+        """
+        if self.timeout is None:
+            return await self._protocol.next_response()
+        try:
+            return await asyncio.wait_for(self._protocol.next_response(), self.timeout)
+        except asyncio.TimeoutError:
+            self.close()
+            raise KVStoreError('No response from the server in %s seconds' % (self.timeout))
+
+    async def request(self, msg):
+        if msg == '':
+            raise ValueError("msg is ''")
+        transport = self._protocol.transport
+        if transport.is_closing():
+            raise KVStoreError('Connection to server was lost')
+        transport.write(encode_message(msg))
+        return self.check_response(msg, await self.recv())
+
+    def check_response(self, msg, response):
+        """
+        Notes the end of the transaction, if response ends it.
+        """
+        if msg in ('COMMIT', 'ABORT') or response == 'Deadlock Abort':
+            self.in_transaction = False
+        if response in ABORTS:
+            raise TransactionAborted(response)
+        return response
+
+    async def begin(self):
+        """
+        Keeps the connection open after the current transaction ends, and
+        starts a new transaction if the current one has ended.
+
+        @return: the xid of the transaction.
+        """
+        response = await self.request('BEGIN')
+        try:
+            self._xid = int(response)
+        except ValueError:
+            raise KVStoreError('BEGIN failed: %s' % (response))
+        self.in_transaction = True
+        return self._xid
+
+    async def get(self, key):
+        return await self.request('GET %s' % (key))
+
+    async def put(self, key, value):
+        return await self.request('PUT %s %s' % (key, value))
+
+    async def get_many(self, keys):
+        return (await self.request('MGET %s' % (' '.join(keys)))).split('\n')
+
+    async def put_many(self, pairs):
+        return await self.request('MPUT %s' % (' '.join('%s %s' % pair for pair in pairs)))
+
+    async def read_only(self):
+        return await self.request('READONLY')
+
+    async def priority(self, priority):
+        return await self.request('PRIORITY %d' % (priority))
+
+    async def scan(self, low, high):
+        return await self.request('SCAN %s %s' % (low, high))
+
+    async def stats(self):
+        response = await self.request('STATS')
+        if not response.startswith('{'):
+            raise KVStoreError(response)
+        return json.loads(response)
+
+    async def commit(self):
+        return await self.request('COMMIT')
+
+    async def abort(self):
+        return await self.request('ABORT')
+
+    async def run(self, body, retries=10, backoff=0.001, max_backoff=0.1, rng=random):
+        """
+        Runs await body(self) as a transaction on this connection, starting a
+        new transaction first if the last one has ended. body sends the
+        requests of the transaction, including its COMMIT or ABORT. If it is
+        aborted by the server (TransactionAborted), it is run again in a new
+        transaction, up to retries times, after a random delay of up to
+        backoff seconds, doubled on each attempt up to max_backoff. If body
+        raises anything else, the transaction is aborted, if the connection
+        still allows it, and the exception is raised again, even if the abort
+        fails.
+
+        @return: the result of body.
+        """
+        attempt = 0
+        while True:
+            await self.begin()
+            try:
+                return await body(self)
+            except TransactionAborted:
+                if attempt >= retries:
+                    raise
+            except Exception:
+                if self.in_transaction and not self._protocol.transport.is_closing():
+                    try:
+                        await self.abort()
+                    except Exception:
+                        # The error of body is the one to report, not the
+                        # loss of the connection or an abort by the server
+                        pass
+                raise
+            await asyncio.sleep(rng.uniform(0, min(max_backoff, backoff * 2 ** attempt)))
+            attempt += 1
+
+    def close(self):
+        self._protocol.transport.close()
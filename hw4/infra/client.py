@@ -1,64 +1,122 @@
+from __future__ import print_function
+
 import errno
+import json
 import logging
 import os
 import re
 import socket
 import sys
+import threading
+from collections import deque
 
-from utils import CHUNK_SIZE, SOCKET_FILE, KVStoreError
+from infra.utils import CHUNK_SIZE, SOCKET_FILE, KVStoreError, MessageReader, encode_message, get_logger
 
 """
 If you want to write your own test cases, you will want to look at the code in
-KVStoreClient, and possibly some of the methods of its parent class.
-
-DO NOT CHANGE ANY CODE IN THIS FILE.
+KVStoreClient, and possibly some of the methods of its parent class. The
+assignment does not need any change to this file.
 """
 
 class BaseKVStoreClient:
-    def __init__(self, log_level=logging.WARNING):
-        if not os.path.exists(SOCKET_FILE):
+    def __init__(self, log_level=logging.WARNING, address=SOCKET_FILE):
+        """
+        Connects to the server at address, the path of its Unix socket or a
+        (host, port) pair for TCP, and starts a transaction.
+        """
+        if isinstance(address, tuple):
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        elif not os.path.exists(address):
             raise KVStoreError('Server does not seem to be running')
-        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            self._sock.connect(SOCKET_FILE)
+            self._sock.connect(address)
         except socket.error as e:
             if e.errno == errno.ECONNREFUSED:
                 raise KVStoreError('Server does not seem to be running')
             else:
                 raise e
-        # TODO: implement reliable recv?
-        data = self._sock.recv(CHUNK_SIZE)
+        self._reader = MessageReader()
+        # Responses received but not returned yet
+        self._responses = deque()
+        data = self.recv()
         try:
             self._xid = int(data)
         except ValueError:
             self._sock.close()
             raise KVStoreError('Server did not provide valid transaction id: %r' % (data))
+        # False once the transaction has committed or aborted
+        self.in_transaction = True
 
-        self._logger = logging.getLogger('<%s %s>' % (self.__class__.__name__, self._xid))
-        self._logger.setLevel(log_level)
+        self._logger = get_logger(self, self._xid, log_level)
 
         self._logger.debug('Constructed client')
 
     def reliable_send(self, msg):
         if msg == '':
             raise ValueError("msg is ''")
+        self.send_frames(encode_message(msg))
+
+    def send_frames(self, frames):
         try:
-            return self._sock.sendall(msg)
+            return self._sock.sendall(frames)
         except socket.error as e:
             if e.errno == errno.EPIPE:
                 raise KVStoreError('Connection to server was lost')
             raise e
 
     def recv(self):
-        resp = self._sock.recv(CHUNK_SIZE)
-        if resp == '':
-            raise KVStoreError('Connection to server was lost')
-        return resp
+        """
+        @return: the next response from the server.
+        """
+        while not self._responses:
+            data = self._sock.recv(CHUNK_SIZE)
+            if not data:
+                raise KVStoreError('Connection to server was lost')
+            self._responses.extend(self._reader.feed(data))
+        return self._responses.popleft()
 
     def request(self, msg):
         self.reliable_send(msg)
-        # TODO: implement reliable recv?
-        return self.recv()
+        return self.check_response(msg, self.recv())
+
+    def check_response(self, msg, response):
+        """
+        Notes the end of the transaction, if response ends it.
+        """
+        if msg in ('COMMIT', 'ABORT') or response == 'Deadlock Abort':
+            self.in_transaction = False
+        return response
+
+    def begin(self):
+        """
+        Keeps the connection open after the current transaction ends, and
+        starts a new transaction if the current one has ended. Unless BEGIN is
+        sent, the server closes the connection after a COMMIT or ABORT.
+
+        @return: the xid of the transaction.
+        """
+        response = self.request('BEGIN')
+        try:
+            self._xid = int(response)
+        except ValueError:
+            raise KVStoreError('BEGIN failed: %s' % (response))
+        self.in_transaction = True
+        return self._xid
+
+    def pipeline(self, msgs):
+        """
+        Sends all of the requests in msgs at once, without waiting for the
+        responses in between, then waits for the responses.
+
+        @return: the list of responses, in the order of msgs.
+        """
+        if '' in msgs:
+            raise ValueError("msg is ''")
+        self.send_frames(b''.join(encode_message(msg) for msg in msgs))
+        return [self.check_response(msg, self.recv()) for msg in msgs]
 
     def close(self):
         self._sock.close()
@@ -71,6 +129,30 @@ class KVStoreClient(BaseKVStoreClient):
     def put(self, key, value):
         return self.request('PUT %s %s' % (key, value))
 
+    def get_many(self, keys):
+        return self.request('MGET %s' % (' '.join(keys))).split('\n')
+
+    def put_many(self, pairs):
+        return self.request('MPUT %s' % (' '.join('%s %s' % pair for pair in pairs)))
+
+    def read_only(self):
+        return self.request('READONLY')
+
+    def priority(self, priority):
+        return self.request('PRIORITY %d' % (priority))
+
+    def scan(self, low, high):
+        return self.request('SCAN %s %s' % (low, high))
+
+    def stats(self):
+        """
+        @return: the metrics of the server, as a dict (see infra/metrics.py).
+        """
+        response = self.request('STATS')
+        if not response.startswith('{'):
+            raise KVStoreError(response)
+        return json.loads(response)
+
     def commit(self):
         return self.request('COMMIT')
 
@@ -87,10 +169,68 @@ class KVStoreCommandLineClient(BaseKVStoreClient):
                 break
             sanitized_msg = re.sub(r'\s+', ' ', msg.strip())
             if sanitized_msg == 'COMMIT':
-                print self.request('COMMIT')
+                print(self.request('COMMIT'))
                 break
             if sanitized_msg == 'ABORT' or sanitized_msg == 'EXIT':
-                print self.request('ABORT')
+                print(self.request('ABORT'))
                 break
-            print self.request(sanitized_msg)
+            print(self.request(sanitized_msg))
         self.close()
+
+class KVStoreClientPool(object):
+    """
+    A thread-safe pool of persistent connections, so that a short transaction
+    does not pay for a connection to be set up and torn down.
+
+    max_idle: the number of idle connections kept open. Connections released
+    beyond that are closed.
+    """
+
+    def __init__(self, max_idle=8, address=SOCKET_FILE, log_level=logging.WARNING):
+        self.max_idle = max_idle
+        self._address = address
+        self._log_level = log_level
+        self._idle = []
+        self._mutex = threading.Lock()
+
+    def begin(self):
+        """
+        @return: a KVStoreClient in a new transaction, on an idle connection
+        if there is one. Give it back with release() once the transaction has
+        ended.
+        """
+        with self._mutex:
+            client = self._idle.pop() if self._idle else None
+        if client is None:
+            client = KVStoreClient(self._log_level, self._address)
+        try:
+            client.begin()
+        except (KVStoreError, socket.error):
+            # The server has closed the idle connection; try a new one
+            client.close()
+            client = KVStoreClient(self._log_level, self._address)
+            client.begin()
+        return client
+
+    def release(self, client):
+        """
+        Returns client to the pool. A transaction still in progress is
+        aborted.
+        """
+        try:
+            if client.in_transaction:
+                client.abort()
+        except (KVStoreError, socket.error):
+            client.close()
+            return
+        with self._mutex:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(client)
+                return
+        client.close()
+
+    def close(self):
+        with self._mutex:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            client.close()
@@ -0,0 +1,156 @@
+import errno
+import select
+import socket
+
+"""
+The event loop of the server, a replacement for asyncore. Sockets are
+registered once with epoll (or poll, where epoll is not available) together
+with the events they are interested in, and a poll returns only the sockets
+that are ready. The cost of a loop iteration therefore depends on the number
+of active connections, not on the number of open ones, and there is no limit
+like select's FD_SETSIZE on the number of connections.
+"""
+
+# The epoll and poll event bits have the same values, so these work with
+# either back end
+READ, WRITE = select.POLLIN, select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+# Errors meaning that the other end of the connection is gone
+DISCONNECTED = frozenset([errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN, errno.ECONNABORTED, errno.EPIPE, errno.EBADF])
+
+# Errors meaning that a non-blocking call would have blocked
+WOULD_BLOCK = frozenset([errno.EAGAIN, errno.EWOULDBLOCK])
+
+class EventLoop(object):
+    """
+    handlers: maps the file descriptor of each registered socket to its
+    Dispatcher.
+    """
+
+    def __init__(self, use_epoll=None):
+        """
+        use_epoll: whether to use epoll rather than poll. By default, epoll is
+        used where it is available.
+        """
+        if use_epoll is None:
+            use_epoll = hasattr(select, 'epoll')
+        if use_epoll:
+            self._poller = select.epoll()
+            self._timeout_scale = 1
+        else:
+            self._poller = select.poll()
+            self._timeout_scale = 1000
+        self.handlers = {}
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def register(self, fd, handler, events):
+        self.handlers[fd] = handler
+        self._poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poller.modify(fd, events)
+
+    def unregister(self, fd):
+        if self.handlers.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def poll(self, timeout):
+        """
+        Waits up to timeout seconds for events, then calls handle_read() and
+        handle_write() on the handlers of the ready sockets. Errors and hang-
+        ups are handled by handle_read(), whose recv() reports them.
+        """
+        try:
+            events = self._poller.poll(timeout * self._timeout_scale)
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        handlers = self.handlers
+        for fd, event in events:
+            handler = handlers.get(fd)
+            if handler is None:
+                # Closed by another handler during this poll
+                continue
+            try:
+                if event & (READ | ERROR):
+                    handler.handle_read()
+                # The handler may have been closed by handle_read()
+                if event & WRITE and handler.connected:
+                    handler.handle_write()
+            except Exception:
+                handler.handle_error()
+
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+
+class Dispatcher(object):
+    """
+    Wraps a non-blocking socket registered with an event loop, much like
+    asyncore.dispatcher. A dispatcher always waits for the socket to become
+    readable, and also writable while set_writable(True) is in effect.
+
+    Subclasses implement handle_read(), handle_write(), handle_close() and
+    handle_error().
+    """
+
+    def __init__(self, loop, sock):
+        self._loop = loop
+        self.socket = sock
+        self._fd = None
+        self._events = READ
+        sock.setblocking(False)
+        self._fd = sock.fileno()
+        self.connected = True
+        loop.register(self._fd, self, self._events)
+
+    def fileno(self):
+        return self._fd
+
+    def set_writable(self, writable):
+        events = READ | WRITE if writable else READ
+        if events != self._events and self.connected:
+            self._events = events
+            self._loop.modify(self._fd, events)
+
+    def recv(self, buffer_size):
+        """
+        @return: the data read, or '' if the connection was closed (after
+        calling handle_close()), or None if there is nothing to read yet.
+        """
+        try:
+            data = self.socket.recv(buffer_size)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return None
+            if e.args[0] in DISCONNECTED:
+                self.handle_close()
+                return b''
+            raise
+        if not data:
+            self.handle_close()
+        return data
+
+    def send(self, data):
+        """
+        @return: the number of bytes sent, which is 0 if the socket buffer is
+        full or the connection was closed (after calling handle_close()).
+        """
+        try:
+            return self.socket.send(data)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return 0
+            if e.args[0] in DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    def close(self):
+        self.connected = False
+        self._loop.unregister(self._fd)
+        self.socket.close()
@@ -0,0 +1,212 @@
+import bisect
+import json
+import time
+
+from locktable import DETECT, TIMEOUT, WAIT_DIE, WOUND_WAIT
+
+"""
+Runtime metrics of the server, returned by the STATS command and optionally
+appended to a file, as JSON. To keep their cost low, requests are sampled:
+only one in sample_every has its latency, queue length and keys recorded.
+Lock waits, commits and aborts, which are rarer or cheaper to count, are all
+recorded. Memory stays bounded however many keys are used: hot keys are
+tracked approximately, by keeping the most frequent ones only.
+"""
+
+# Bucket bounds, in seconds, for latencies: 1us to about 30s, doubling
+LATENCY_BOUNDS = [1e-6 * 2 ** i for i in range(25)]
+
+# Bucket bounds for queue lengths
+LENGTH_BOUNDS = [0] + [2 ** i for i in range(17)]
+
+# Commands whose latency is recorded; others count as 'other'
+COMMANDS = frozenset(['GET', 'PUT', 'MGET', 'MPUT', 'SCAN', 'READONLY', 'PRIORITY', 'COMMIT', 'ABORT', 'BEGIN', 'PREPARE', 'STATS', 'EDGES', 'KILL'])
+
+# Causes of aborts
+USER_ABORT = 'user'
+DISCONNECT_ABORT = 'disconnect'
+GLOBAL_DEADLOCK_ABORT = 'global deadlock'
+VALIDATION_ABORT = 'validation'
+POLICY_ABORTS = {DETECT: 'deadlock', WAIT_DIE: 'wait-die', WOUND_WAIT: 'wound-wait', TIMEOUT: 'timeout'}
+
+class Histogram(object):
+    """
+    Counts values in buckets with fixed bounds. A percentile is reported as
+    the upper bound of its bucket, or the largest value seen.
+    """
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        rank = p * self.count
+        seen = 0
+        for bound, count in zip(self._bounds, self._counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self, scale=1):
+        """
+        @return: a dict of the count, mean, p50, p99 and max, multiplied by
+        scale.
+        """
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total * scale / float(self.count),
+            'p50': self.percentile(0.5) * scale,
+            'p99': self.percentile(0.99) * scale,
+            'max': self.max * scale,
+        }
+
+class TopKeys(object):
+    """
+    Approximate totals of the keys with the largest totals. Up to 2 *
+    capacity keys are tracked; beyond that, only the capacity largest are
+    kept, so a key that only becomes hot later starts from zero.
+    """
+
+    def __init__(self, capacity=1000):
+        self._capacity = capacity
+        self._totals = {}
+
+    def add(self, key, amount=1):
+        totals = self._totals
+        if key in totals:
+            totals[key] += amount
+        else:
+            totals[key] = amount
+            if len(totals) > 2 * self._capacity:
+                kept = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:self._capacity]
+                self._totals = dict(kept)
+
+    def top(self, n):
+        """
+        @return: the n (key, total) pairs with the largest totals, largest
+        first.
+        """
+        return sorted(self._totals.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+class Metrics(object):
+    """
+    The metrics of a server, recorded by the server and its handlers.
+
+    commands: maps each command to the histogram of the latency of the
+    sampled requests, from the time the server starts running the request to
+    its response, including any wait for locks.
+
+    lock_waits: the histogram of the time requests waited for a lock, and
+    contended_keys the keys with the largest total wait.
+
+    lock_queue: the histogram of the number of requests queued on a lock,
+    including the new one, each time a request has to wait.
+
+    request_queue: the histogram of the number of requests a handler has
+    received but not run, including the sampled request, when the sampled
+    request starts.
+
+    hot_keys: the keys of the sampled requests with the most accesses.
+
+    aborts: maps each cause (a deadlock policy, or one of the causes above) to
+    the number of transactions aborted for it.
+
+    replication: the infra.replication.Primary or Replica of the server, if
+    it replicates, whose snapshot() reports the replication lag.
+    """
+
+    def __init__(self, top_n=10, sample_every=16):
+        self.top_n = top_n
+        self.sample_every = sample_every
+        self._countdown = sample_every
+        self.start_time = time.time()
+        self.commands = {}
+        self.lock_waits = Histogram(LATENCY_BOUNDS)
+        self.lock_queue = Histogram(LENGTH_BOUNDS)
+        self.request_queue = Histogram(LENGTH_BOUNDS)
+        self.commits = 0
+        self.aborts = {}
+        self.hot_keys = TopKeys()
+        self.contended_keys = TopKeys()
+        self.replication = None
+
+    def skip(self):
+        """
+        @return: False for the requests to sample.
+        """
+        self._countdown -= 1
+        if self._countdown:
+            return True
+        self._countdown = self.sample_every
+        return False
+
+    def record_keys(self, command, tokens):
+        """
+        Counts the accesses to the keys of a request, split into tokens.
+        """
+        if command == 'GET' or command == 'PUT' or command == 'MGET':
+            keys = tokens[1:2] if command != 'MGET' else tokens[1:]
+        elif command == 'MPUT':
+            keys = tokens[1::2]
+        else:
+            return
+        for key in keys:
+            self.hot_keys.add(key)
+
+    def record_command(self, command, latency):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram(LATENCY_BOUNDS)
+        histogram.add(latency)
+
+    def record_lock_wait(self, key, latency):
+        self.lock_waits.add(latency)
+        self.contended_keys.add(key, latency)
+
+    def record_abort(self, cause):
+        self.aborts[cause] = self.aborts.get(cause, 0) + 1
+
+    def snapshot(self):
+        """
+        @return: the metrics as a dict that can be encoded as JSON. Times are
+        in microseconds.
+        """
+        snapshot = {
+            'time': time.time(),
+            'uptime': time.time() - self.start_time,
+            'sample_every': self.sample_every,
+            'commands': dict((command, histogram.summary(1e6)) for command, histogram in self.commands.items()),
+            'lock_waits': self.lock_waits.summary(1e6),
+            'lock_queue': self.lock_queue.summary(),
+            'request_queue': self.request_queue.summary(),
+            'commits': self.commits,
+            'aborts': self.aborts,
+            'hot_keys': self.hot_keys.top(self.top_n),
+            'contended_keys': [(key, total * 1e6) for key, total in self.contended_keys.top(self.top_n)],
+        }
+        if self.replication is not None:
+            snapshot['replication'] = self.replication.snapshot()
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def dump(self, path):
+        """
+        Appends the metrics to the file at path, as one line of JSON.
+        """
+        with open(path, 'a') as f:
+            f.write(self.to_json() + '\n')
@@ -0,0 +1,475 @@
+import itertools
+import json
+import logging
+import socket
+import time
+import traceback
+from collections import deque
+
+from infra.eventloop import WOULD_BLOCK, Dispatcher
+from infra.metrics import LATENCY_BOUNDS, Histogram
+from infra.utils import CHUNK_SIZE, KVStoreError, MessageReader, encode_message
+
+"""
+Primary-backup replication by log shipping. The primary records the write
+set of every transaction as it commits, numbered in commit order, and after
+each flush of its store streams the new entries to its replicas, so that a
+replica never sees a commit that is not durable on the primary. A replica
+applies the entries in order, as commits of its own MVCCKVStore, and serves
+read-only transactions on snapshots of it; every transaction on a replica is
+read-only. Replicas are for reading: they may lag behind the primary, and a
+client that needs to read its own writes reads from the primary.
+
+A replica connects to the replication address of the primary and sends
+'REPLICATE epoch seq', the epoch of the primary it last followed and the seq
+of the last entry it applied (0 0 the first time). If the epoch is the
+primary's and the entries after seq are still retained, the primary streams
+them; otherwise it sends a copy of its store first, then the entries after
+it. The copy is a snapshot of a store with snapshots, or else the data of an
+in-memory store with the writes of open transactions undone. The primary sends JSON messages:
+
+    {"epoch": e, "seq": s, "snapshot": [[key, value], ...], "done": d}
+        part of a copy of the store as of entry s, the last part if d
+    {"seq": s, "entries": [[seq, commit time, {key: value}], ...]}
+        entries in commit order, s being the last entry of the primary
+    {"error": message}
+        the primary cannot serve the replica, and closes the connection
+
+The replica answers 'ACK seq' once it has applied the entries up to seq.
+Lag is reported in STATS (see infra/metrics.py): by the primary, the entries
+each replica has yet to acknowledge and the time from commit to
+acknowledgement; by a replica, the time from commit on the primary to apply,
+which assumes both run on the same machine, and the entries it is behind.
+"""
+
+# Number of log entries the primary keeps for replicas that reconnect
+RETAIN = 100000
+
+# Entries, or (key, value) pairs of a snapshot, per message
+BATCH = 1000
+
+# Bytes of unsent output after which the primary drops a replica that does
+# not keep up; the replica reconnects and catches up
+MAX_BACKLOG = 1 << 26
+
+# Seconds between two attempts of a replica to reconnect to the primary
+RECONNECT_INTERVAL = 1.0
+
+# Keys are made of [A-Za-z0-9_], so every key sorts between these
+MIN_KEY = ''
+MAX_KEY = '{'
+
+class CommitLog(object):
+    """
+    Wraps the store of a primary, and logs the write set of each commit
+    before the store is flushed. Every other method is the store's.
+
+    epoch: identifies this log, which starts over when the server restarts.
+
+    seq: the number of the last entry, the number of commits that wrote
+    anything.
+
+    entries: the last RETAIN entries, (seq, commit time, writes), oldest
+    first. writes is the dict passed to commit(), which must not be changed
+    afterwards.
+    """
+
+    def __init__(self, store, retain=RETAIN):
+        self.store = store
+        self.epoch = int(time.time() * 1e6)
+        self.seq = 0
+        self.entries = deque(maxlen=retain)
+        # The methods the server calls most, without going through
+        # __getattr__
+        self.get = store.get
+        self.put = store.put
+        self.flush = store.flush
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def commit(self, xid, writes):
+        self.store.commit(xid, writes)
+        if writes:
+            self.seq += 1
+            self.entries.append((self.seq, time.time(), writes))
+
+    def since(self, seq):
+        """
+        @return: the entries after seq, or None if some of them are no longer
+        retained.
+        """
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self.entries or self.entries[0][0] > seq + 1:
+            return None
+        return list(itertools.islice(self.entries, seq + 1 - self.entries[0][0], None))
+
+    def commit_time(self, seq):
+        """
+        @return: the commit time of entry seq, or None if it is no longer
+        retained.
+        """
+        if not self.entries or not self.entries[0][0] <= seq <= self.seq:
+            return None
+        return self.entries[seq - self.entries[0][0]][1]
+
+class FollowerHandler(Dispatcher):
+    """
+    The connection of the primary to a replica.
+
+    sent_seq: the last entry sent to the replica, or None until it has sent
+    REPLICATE and been caught up.
+
+    acked_seq: the last entry the replica has applied.
+
+    copied_seq: the entry as of which the replica was sent a copy of the
+    store, whose acknowledgement says nothing about lag.
+    """
+
+    def __init__(self, loop, sock, primary):
+        self._primary = primary
+        self._reader = MessageReader()
+        self._output = b''
+        self.sent_seq = None
+        self.acked_seq = 0
+        self.copied_seq = 0
+        self.connected = False
+        Dispatcher.__init__(self, loop, sock)
+
+    def send_message(self, message):
+        if not self.connected:
+            return
+        self._output += encode_message(json.dumps(message))
+        self.handle_write()
+        if len(self._output) > MAX_BACKLOG:
+            self._primary.logger.warning('Replica is %d bytes behind, dropping it', len(self._output))
+            self.close()
+
+    def send_entries(self, entries, seq):
+        for start in range(0, len(entries), BATCH):
+            self.send_message({'seq': seq, 'entries': entries[start:start + BATCH]})
+        if entries:
+            self.sent_seq = entries[-1][0]
+
+    def fail(self, message):
+        self.send_message({'error': message})
+        self.close()
+
+    def handle_read(self):
+        data = self.recv(CHUNK_SIZE)
+        if not data:
+            return
+        for message in self._reader.feed(data):
+            tokens = message.split(' ')
+            if tokens[0] == 'REPLICATE' and len(tokens) == 3 and tokens[1].isdigit() and tokens[2].isdigit() and self.sent_seq is None:
+                self._primary.join(self, int(tokens[1]), int(tokens[2]))
+            elif tokens[0] == 'ACK' and len(tokens) == 2 and tokens[1].isdigit():
+                self._primary.acknowledged(self, int(tokens[1]))
+            else:
+                self.fail('Unexpected message from replica: %r' % (message[:100]))
+                return
+
+    def handle_write(self):
+        if self._output and self.connected:
+            sent = self.send(self._output)
+            self._output = self._output[sent:]
+            self.set_writable(len(self._output) > 0)
+
+    def backlog(self):
+        return len(self._output)
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        exc = traceback.format_exc()
+        self._primary.logger.error('Uncaught exception, closing replica connection\n%s', exc[:-1])
+        self.close()
+
+class Primary(Dispatcher):
+    """
+    Accepts the connections of replicas on the replication address of a
+    primary server, and ships them the entries of its CommitLog.
+    """
+
+    def __init__(self, loop, sock, log, log_level=logging.WARNING, state=None):
+        self.logger = logging.getLogger('<%s>' % (self.__class__.__name__))
+        self.logger.setLevel(log_level)
+        self.log = log
+        # For a store without snapshots, returns its data and the committed
+        # values of the keys written by open transactions
+        self._state = state
+        self.address = sock.getsockname()
+        self._tcp = isinstance(self.address, tuple)
+        self.followers = []
+        # Replicas that sent REPLICATE, caught up after the next flush
+        self._joining = []
+        # Time from commit to acknowledgement by a replica
+        self.ack_lag = Histogram(LATENCY_BOUNDS)
+        self.connected = False
+        Dispatcher.__init__(self, loop, sock)
+
+    def handle_read(self):
+        while self.connected:
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            if self._tcp:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.followers.append(FollowerHandler(self._loop, sock, self))
+
+    def join(self, follower, epoch, seq):
+        self._joining.append((follower, epoch, seq))
+
+    def acknowledged(self, follower, seq):
+        if seq <= follower.acked_seq:
+            return
+        follower.acked_seq = seq
+        commit_time = self.log.commit_time(seq)
+        if commit_time is not None and seq > follower.copied_seq:
+            self.ack_lag.add(time.time() - commit_time)
+
+    def catch_up(self, follower, epoch, seq):
+        """
+        Sends a replica that has just joined the entries it is missing, after
+        a copy of the store if they are no longer retained, or if it followed
+        another primary and the store may hold data from before the log.
+        """
+        log = self.log
+        entries = log.since(seq) if epoch == log.epoch else None
+        if entries is None:
+            if hasattr(log, 'snapshot'):
+                ts = log.snapshot()
+                try:
+                    pairs = log.scan_version(MIN_KEY, MAX_KEY, ts)
+                finally:
+                    log.release_snapshot(ts)
+            elif self._state is not None:
+                data, overrides = self._state()
+                pairs = sorted((key, overrides.get(key, value)) for key, value in data.items())
+                pairs = [(key, value) for key, value in pairs if value is not None]
+            else:
+                follower.fail('The store cannot be copied to a replica')
+                return
+            for start in range(0, max(len(pairs), 1), BATCH):
+                follower.send_message({'epoch': log.epoch, 'seq': log.seq, 'snapshot': pairs[start:start + BATCH],
+                                       'done': start + BATCH >= len(pairs)})
+            entries = []
+            follower.copied_seq = log.seq
+        follower.send_entries(entries, log.seq)
+        follower.sent_seq = log.seq
+
+    def after_flush(self):
+        """
+        Called by the server after each flush of the store: ships the entries
+        committed since the last flush to every replica.
+        """
+        joining, self._joining = self._joining, []
+        for follower, epoch, seq in joining:
+            if follower.connected:
+                self.catch_up(follower, epoch, seq)
+        log = self.log
+        for follower in self.followers:
+            if follower.connected and follower.sent_seq is not None and follower.sent_seq < log.seq:
+                follower.send_entries(log.since(follower.sent_seq), log.seq)
+        if not all(follower.connected for follower in self.followers):
+            self.followers = [follower for follower in self.followers if follower.connected]
+
+    def dispatchers(self):
+        """
+        @return: the number of open connections that belong to replication,
+        which do not keep the server running.
+        """
+        return self.connected + sum(follower.connected for follower in self.followers)
+
+    def snapshot(self):
+        return {
+            'role': 'primary',
+            'epoch': self.log.epoch,
+            'seq': self.log.seq,
+            'ack_lag': self.ack_lag.summary(1e6),
+            'replicas': [{'acked_seq': follower.acked_seq, 'lag_entries': self.log.seq - follower.acked_seq,
+                          'backlog_bytes': follower.backlog()}
+                         for follower in self.followers if follower.connected and follower.sent_seq is not None],
+        }
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        exc = traceback.format_exc()
+        self.logger.error('Uncaught exception, closing replication listener\n%s', exc[:-1])
+        self.close()
+
+class PrimaryConnection(Dispatcher):
+    """
+    The connection of a replica to its primary.
+    """
+
+    def __init__(self, loop, replica, address):
+        self._replica = replica
+        self._reader = MessageReader()
+        self._output = b''
+        self.connected = False
+        if isinstance(address, tuple):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+        except socket.error:
+            sock.close()
+            raise
+        Dispatcher.__init__(self, loop, sock)
+        self.send_message('REPLICATE %d %d' % (replica.epoch, replica.applied_seq))
+
+    def send_message(self, message):
+        self._output += encode_message(message)
+        self.handle_write()
+
+    def handle_read(self):
+        data = self.recv(CHUNK_SIZE)
+        if not data:
+            return
+        applied_seq = self._replica.applied_seq
+        for message in self._reader.feed(data):
+            self._replica.apply(json.loads(message))
+            if not self.connected:
+                return
+        if self._replica.applied_seq != applied_seq:
+            self.send_message('ACK %d' % (self._replica.applied_seq))
+
+    def handle_write(self):
+        if self._output and self.connected:
+            sent = self.send(self._output)
+            self._output = self._output[sent:]
+            self.set_writable(len(self._output) > 0)
+
+    def handle_close(self):
+        self._replica.logger.warning('Lost the connection to the primary')
+        self.close()
+
+    def handle_error(self):
+        exc = traceback.format_exc()
+        self._replica.logger.error('Uncaught exception, closing the connection to the primary\n%s', exc[:-1])
+        self.close()
+
+class Replica(object):
+    """
+    Follows the primary whose replication address is primary_address, and
+    applies its commits to store, which must support snapshots. The
+    connection is retried every RECONNECT_INTERVAL seconds while it is down.
+
+    epoch, applied_seq: the log of the primary, and the last entry of it
+    applied to the store.
+
+    primary_seq: the last entry of the primary, as of its last message.
+    """
+
+    def __init__(self, loop, store, primary_address, log_level=logging.WARNING):
+        if not hasattr(store, 'snapshot'):
+            raise KVStoreError('A replica needs a store that supports snapshots, like MVCCKVStore')
+        self.logger = logging.getLogger('<%s>' % (self.__class__.__name__))
+        self.logger.setLevel(log_level)
+        self._loop = loop
+        self.store = store
+        self.primary_address = primary_address
+        self.epoch = 0
+        self.applied_seq = 0
+        self.primary_seq = 0
+        # Time from commit on the primary to apply on the replica
+        self.lag = Histogram(LATENCY_BOUNDS)
+        # The values of the snapshot being received, by key
+        self._loading = None
+        self.connection = None
+        self._next_connect = 0
+        self.connect()
+
+    def connect(self):
+        self._loading = None
+        try:
+            self.connection = PrimaryConnection(self._loop, self, self.primary_address)
+        except socket.error as e:
+            self.logger.warning('Cannot connect to the primary: %s', e)
+            self.connection = None
+            self._next_connect = time.time() + RECONNECT_INTERVAL
+
+    def is_connected(self):
+        return self.connection is not None and self.connection.connected
+
+    def after_flush(self):
+        """
+        Called by the server after each poll: reconnects to the primary if the
+        connection is down.
+        """
+        if not self.is_connected() and time.time() >= self._next_connect:
+            self._next_connect = time.time() + RECONNECT_INTERVAL
+            self.connect()
+
+    def apply(self, message):
+        """
+        Applies a message from the primary to the store.
+        """
+        if 'error' in message:
+            raise KVStoreError('Primary refused to replicate: %s' % (message['error']))
+        self.primary_seq = message['seq']
+        if 'snapshot' in message:
+            self.load_snapshot(message)
+            return
+        store = self.store
+        now = time.time()
+        for seq, commit_time, writes in message['entries']:
+            if seq != self.applied_seq + 1:
+                raise KVStoreError('Expected entry %d from the primary, got %d' % (self.applied_seq + 1, seq))
+            writes = dict((str(key), None if value is None else str(value)) for key, value in writes.items())
+            for key, value in writes.items():
+                store.put(key, value)
+            store.commit(seq, writes)
+            self.applied_seq = seq
+            self.lag.add(max(now - commit_time, 0))
+
+    def load_snapshot(self, message):
+        """
+        Receives part of a copy of the store of the primary. Once every part
+        has arrived, the store is made equal to it by a single commit, so
+        that no transaction sees part of it.
+        """
+        if self._loading is None:
+            self._loading = {}
+        for key, value in message['snapshot']:
+            self._loading[str(key)] = str(value)
+        if not message['done']:
+            return
+        loading, self._loading = self._loading, None
+        store = self.store
+        writes = {}
+        for key, value in store.scan(MIN_KEY, MAX_KEY):
+            if key not in loading:
+                writes[key] = None
+        for key, value in loading.items():
+            if store.get(key) != value:
+                writes[key] = value
+        for key, value in writes.items():
+            store.put(key, value)
+        store.commit(message['seq'], writes)
+        self.epoch = message['epoch']
+        self.applied_seq = message['seq']
+
+    def dispatchers(self):
+        return int(self.is_connected())
+
+    def snapshot(self):
+        return {
+            'role': 'replica',
+            'connected': self.is_connected(),
+            'epoch': self.epoch,
+            'applied_seq': self.applied_seq,
+            'primary_seq': self.primary_seq,
+            'lag_entries': max(self.primary_seq - self.applied_seq, 0),
+            'lag': self.lag.summary(1e6),
+        }
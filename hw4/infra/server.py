@@ -1,65 +1,119 @@
-import asyncore
+import errno
 import logging
 import os
 import re
 import socket
 import time
 import traceback
+from collections import deque
 
-from utils import CHUNK_SIZE, SOCKET_FILE, KVStoreError
-from student import DEADLOCK, USER, KVSTORE_CLASS, TransactionCoordinator, TransactionHandler
+from infra.eventloop import WOULD_BLOCK, Dispatcher, EventLoop
+from infra.metrics import COMMANDS, DISCONNECT_ABORT, GLOBAL_DEADLOCK_ABORT, POLICY_ABORTS, USER_ABORT, VALIDATION_ABORT, Metrics
+from infra.replication import CommitLog, Primary, Replica
+from infra.utils import CHUNK_SIZE, SOCKET_FILE, KVStoreError, MessageReader, encode_message, get_logger
+from locktable import LockTable
+from locktrace import TraceWriter
+from snapshot import Checkpointer, read_snapshot
+from student import DEADLOCK, DETECT, ESCALATION_THRESHOLD, TIMEOUT, USER, KVSTORE_CLASS, OptimisticTransactionHandler, TransactionCoordinator, TransactionHandler
 
 """
-YOU DO NOT NEED TO LOOK AT ANY CODE IN THIS FILE.
-EVEN MORE IMPORTANTLY, DO NOT CHANGE ANY CODE IN THIS FILE.
+The server: an event loop (see eventloop.py) that accepts connections and
+runs the requests of each client through a transaction handler from
+student.py, making commits durable before responding. You do not need to
+look at this file, or change it, for the assignment; your code goes in
+student.py.
 """
 
 """
-Constants representing the current state of the handler between calls to
-handle_read() and handle_write(). After data is sent in handle_write(), the
-handler is WAITING. If handle_write() is still waiting for a lock, the handler
-is LOCKING. After data is received in handle_read(), the handler is ABORTING,
-COMMITTING, LOCKING, or RESPONDING.
+Constants representing the state of the handler's transaction. A WAITING
+handler runs the requests it has received, in order. If the transaction has
+to wait for a lock, the handler is LOCKING, and stays idle until the lock
+manager notifies it of the grant. After a COMMIT or ABORT, the handler is
+ENDED, and closes once its responses have been sent, unless the client has
+sent BEGIN on this connection: then the handler is IDLE until the next BEGIN
+starts a new transaction.
 """
 WAITING = 0
-ABORTING = 1
-COMMITTING = 2
-LOCKING = 3
-RESPONDING = 4
+LOCKING = 1
+ENDED = 2
+IDLE = 3
 
-class KVStoreServerHandler(asyncore.dispatcher):
+# Number of connections that may wait to be accepted
+LISTEN_BACKLOG = 1024
+
+class KVStoreServerHandler(Dispatcher):
     """
     Each handler communicates with a single client. If the handler raises an
     exception, during the constructor or from a handle_*() method, then it is
     automatically closed. The handle_*() methods of all handlers (that have not
-    yet been closed) are called by the polling loop whenever appropriate.
+    yet been closed) are called by the event loop whenever their socket is
+    ready.
+
+    Requests and responses are framed messages (see utils.encode_message()),
+    so a client may send any number of requests without waiting for the
+    responses (pipelining). Requests are run one at a time, in order, and the
+    responses are sent in the same order.
+
+    Each connection starts with a transaction, whose xid is sent to the
+    client. A client that sends BEGIN keeps the connection open after the
+    transaction ends, and runs its next transaction, with a new xid, after
+    the next BEGIN.
+
+    On a shard server (see infra/sharding.py), connections come from the
+    front end, which numbers the transactions itself: a connection starts
+    IDLE, without a transaction or a greeting, and 'BEGIN xid' starts
+    transaction xid. The front end also sends PREPARE, for two-phase commit,
+    and, outside of transactions, EDGES and KILL for the global deadlock
+    detector.
+
+    On a replica (see infra/replication.py), every transaction is read-only.
     """
 
-    def __init__(self, sock, server, store, stats, lock_table, xid, log_level):
+    def __init__(self, loop, sock, server, store, stats, lock_table, xid, log_level):
         """
-        Initializes the handler and adds it to the polling loop. If an
+        Initializes the handler and adds it to the event loop. If an
         exception is raised during the constructor, then the handler is closed
-        and removed from the polling loop.
+        and removed from the event loop. On a shard server, xid is None.
         """
-        self._logger = logging.getLogger('<%s %s>' % (self.__class__.__name__, xid))
-        self._logger.setLevel(log_level)
+        self._log_level = log_level
         self._server = server
         self._store = store
         self._stats = stats
-        # Global lock table. Each key maps to a list of four lists.
-        # The first list contains txns holding the key's s lock. The second list contains txns holding the key's x lock (list length should be either 0 or 1)
-        # The third list contains txns waiting to acquire the s lock. The fourth list contains txns waiting to acquire the x lock
+        # The server's infra.metrics.Metrics, or None
+        self._metrics = server.metrics
+        # Global lock table. Each key maps to a locktable.LockEntry.
         self._lock_table = lock_table
-        self._xid = xid
-        # A string storing data passed from handle_read() to handle_write().
-        self._data = str(self._xid)
-        # One of the state constants listed above
-        self._state = RESPONDING
+        # Set once the client has sent BEGIN
+        self._persistent = False
+        # Reassembles the requests received from the client
+        self._reader = MessageReader()
+        # Requests received but not run yet
+        self._requests = deque()
+        # Responses waiting for the store to be flushed, so that the client
+        # never sees a commit before it is durable
+        self._unflushed = []
+        # Set when the lock a LOCKING handler is waiting for has been granted
+        self._lock_granted = False
+        # Response to the next request of a transaction that was aborted
+        # while it had no request running
+        self._pending_abort = None
         # self.connected is inherited
-        self._txn_handler = TransactionHandler(self._lock_table, self._xid, self._store)
+        self.connected = False
+        if xid is None:
+            self._persistent = True
+            self._xid = None
+            self._logger = get_logger(self, None, log_level)
+            self._state = IDLE
+            self._ended = True
+            self._output = b''
+        else:
+            self.start_transaction(xid)
+            # Responses ready to be sent. The first one is the transaction id.
+            self._output = encode_message(str(self._xid))
 
         try:
-            asyncore.dispatcher.__init__(self, sock)
+            Dispatcher.__init__(self, loop, sock)
+            self.handle_write()
         except:
             # Exceptions from constructor are not caught by handle_error(), so
             # we catch them in the constructor itself
@@ -70,164 +124,362 @@ class KVStoreServerHandler(asyncore.dispatcher):
 
         self._logger.debug('Constructed server handler')
 
-    def reliable_send(self, msg):
+    def start_transaction(self, xid):
+        self._xid = xid
+        self._logger = get_logger(self, xid, self._log_level)
+        # One of the state constants listed above
+        self._state = WAITING
+        # Set once the transaction has run a request
+        self._started = False
+        # Set once the transaction has committed or aborted
+        self._ended = False
+        # Set once the transaction has voted to commit, after which it can
+        # no longer be chosen for a deadlock abort
+        self._prepared = False
+        handler_class = OptimisticTransactionHandler if self._server.optimistic else TransactionHandler
+        self._txn_handler = handler_class(self._lock_table, self._xid, self._store, self.lock_granted, self._server.tracer)
+        if self._server.is_replica:
+            self._txn_handler.begin_read_only()
+        self._server.add_transaction(xid, self)
+
+    def lock_granted(self):
+        """
+        Called by the lock manager when the lock that this handler's
+        transaction is waiting for has been granted. The server calls resume()
+        at the end of the current loop iteration.
+        """
+        self._lock_granted = True
+        self._server.wake(self)
+
+    def handle_read(self):
         """
-        asyncore.dispatcher does not have sendall, so we implement it here.
-        We stop trying to send if the handler is ever closed.
+        Called by the event loop when the socket is ready to read. We read the
+        data by calling recv(). recv() returns '' if the connection was
+        closed, so we check for this explicitly. The data may hold any number
+        of requests, or part of one.
         """
-        if not self.connected:
+        data = self.recv(CHUNK_SIZE)
+
+        if not data:
+            # The connection was closed (and handle_close() was already called)
             return
-        sent = self.send(msg)
-        while sent < len(msg) and self.connected:
-            sent += self.send(msg[sent:])
 
-    def end_transaction(self):
+        self._requests.extend(self._reader.feed(data))
+        self.run_requests()
+
+    def run_requests(self):
+        """
+        Runs the pending requests in order, until one of them has to wait for
+        a lock or ends the connection.
+        """
+        metrics = self._metrics
+        while self._requests and (self._state == WAITING or self._state == IDLE):
+            data = self._requests.popleft()
+            if metrics is None:
+                self.respond(self.run_request(data))
+                continue
+            if metrics.skip():
+                self._request_start = None
+                self.respond(self.run_request(data))
+                continue
+            # A sampled request
+            metrics.request_queue.add(len(self._requests) + 1)
+            tokens = data.split(' ')
+            self._command = tokens[0] if tokens[0] in COMMANDS else 'other'
+            self._request_start = time.time()
+            result = self.run_request(data)
+            if result is not None:
+                metrics.record_command(self._command, time.time() - self._request_start)
+            metrics.record_keys(self._command, tokens)
+            self.respond(result)
+        self._logger.debug('Lock table is %r', self._lock_table)
+
+    def resume(self):
         """
-        Marks the end of a transaction, after a COMMIT or ABORT. Notifies the
-        user that the COMMIT or ABORT completed.
+        Called by the server after the lock manager has granted the lock that
+        this handler is waiting for. Finishes the blocked request with
+        check_lock(), then runs the requests behind it.
         """
-        self.close()
+        if self._state != LOCKING or not self._lock_granted:
+            return
+        self._lock_granted = False
+        result = self._txn_handler.check_lock()
+        if result is None:
+            return
+        if not isinstance(result, str):
+            raise KVStoreError('T%s.check_lock() returned %r, which is not a string or None' % (self._xid, result))
+        if self._metrics is not None:
+            self.end_wait()
+        self._state = WAITING
+        self.respond(result, waited=True)
+        self.run_requests()
+
+    def respond(self, result, waited=False):
+        """
+        Queues the response to a request, or makes the handler LOCKING if the
+        request returned None. The response is sent once the server has
+        flushed the store. waited is True if the request had to wait for a
+        lock.
+        """
+        if result is None:
+            self._state = LOCKING
+            if self._metrics is not None:
+                self.start_wait()
+            return
+        if not self._unflushed:
+            self._server.has_output(self, waited)
+        self._unflushed.append(encode_message(result))
 
-    def readable(self):
+    def start_wait(self):
         """
-        handle_read() is called if readable() is True and the select syscall
-        says the socket is ready to read.
-
-        We always want to call handle_read() if there is data to be read.
+        Records the length of the queue of the lock the request waits for.
         """
-        return True
+        self._wait_start = time.time()
+        self._wait_key = self._txn_handler.waiting_for()
+        entry = self._lock_table.get(self._wait_key)
+        if entry is not None:
+            self._metrics.lock_queue.add(len(entry.queue))
 
-    def writable(self):
+    def end_wait(self):
         """
-        handle_write() is called if writable() is True and the select syscall
-        says the socket is ready to write.
-
-        We avoid calling handle_write() when there is no data to be written.
+        Records the time the blocked request waited, once it was granted its
+        lock or aborted.
         """
-        return self._state != WAITING
+        now = time.time()
+        self._metrics.record_lock_wait(self._wait_key, now - self._wait_start)
+        if self._request_start is not None:
+            self._metrics.record_command(self._command, now - self._request_start)
 
-    def handle_read(self):
+    def flush_output(self):
         """
-        Called by the polling loop if readable() is True and the socket is
-        ready to read. We read the data by calling recv(). recv() returns '' if
-        the connection was closed, so we check for this explicitly. If the
-        connection is still open, handle_read() must set self._data to a
-        non-None value.
+        Called by the server after it has flushed the store. Sends the queued
+        responses, as far as the socket allows without blocking.
         """
-        # TODO: implement reliable recv. Create input buffer, in case the input takes too long to arrive or arrives in multiple chunks, and delimiter to mark end of stream.
-        data = self.recv(CHUNK_SIZE)
+        self._output += b''.join(self._unflushed)
+        self._unflushed = []
+        self.handle_write()
 
+    def run_request(self, data):
+        """
+        Runs a single request, and returns its response, or None if the
+        transaction has to wait for a lock.
+        """
         if data == '':
-            # The connection was closed (and handle_close() was already called)
-            return
-
+            return 'Unrecognized command'
         if data[0] == ' ':
-            self._state, self._data = RESPONDING, 'Command begins with whitespace'
-            return
+            return 'Command begins with whitespace'
         if re.search(r'[^A-Za-z0-9_ ]', data):
-            self._state, self._data = RESPONDING, 'Special characters in message'
-            return
+            return 'Special characters in message'
         tokens = data.split(' ', 3)
+        if tokens[0] == 'BEGIN':
+            if self._server.is_shard:
+                if len(tokens) != 2 or not tokens[1].isdigit():
+                    return 'Bad format for BEGIN'
+                return self.begin(int(tokens[1]))
+            if len(tokens) != 1:
+                return 'Bad format for BEGIN'
+            return self.begin()
+        if tokens[0] == 'STATS':
+            if len(tokens) != 1:
+                return 'Bad format for STATS'
+            return self._server.stats_report()
+        if self._pending_abort is not None:
+            result, self._pending_abort = self._pending_abort, None
+            return result
+        if self._state == IDLE:
+            if self._server.is_shard and tokens[0] == 'EDGES':
+                return self._server.waits_for_edges()
+            if self._server.is_shard and tokens[0] == 'KILL':
+                if len(tokens) != 2 or not tokens[1].isdigit():
+                    return 'Bad format for KILL'
+                return self._server.kill(int(tokens[1]))
+            return 'No transaction in progress'
+        self._started = True
         if tokens[0] == 'GET':
-            if len(tokens) == 2:
-                key = tokens[1]
-                if key == '':
-                    self._state, self._data = RESPONDING, 'Bad format for GET'
-                else:
-                    result = self._txn_handler.perform_get(key)
-                    self._stats[0] += 1
-                    if result is None:
-                        self._state, self._data = LOCKING, None
-                    elif isinstance(result, str):
-                        self._state, self._data = RESPONDING, result
-                    else:
-                        raise KVStoreError('T%s.perform_get() returned %r, which is not a string or None' % (self._xid, result))
-            else:
-                self._state, self._data = RESPONDING, 'Bad format for GET'
+            if len(tokens) != 2 or tokens[1] == '':
+                return 'Bad format for GET'
+            self._stats[0] += 1
+            return self.check_result('perform_get', self._txn_handler.perform_get(tokens[1]))
         elif tokens[0] == 'PUT':
-            if len(tokens) == 3:
-                key, value = tokens[1], tokens[2]
-                if key == '' or value == '':
-                    self._state, self._data = RESPONDING, 'Bad format for PUT'
-                else:
-                    result = self._txn_handler.perform_put(key, value)
-                    self._stats[1] += 1
-                    if result is None:
-                        self._state, self._data = LOCKING, None
-                    elif isinstance(result, str):
-                        self._state, self._data = RESPONDING, result
-                    else:
-                        raise KVStoreError('T%s.perform_put() returned %r, which is not a string or None' % (self._xid, result))
-            else:
-                self._state, self._data = RESPONDING, 'Bad format for PUT'
+            if len(tokens) != 3 or tokens[1] == '' or tokens[2] == '':
+                return 'Bad format for PUT'
+            self._stats[1] += 1
+            return self.check_result('perform_put', self._txn_handler.perform_put(tokens[1], tokens[2]))
+        elif tokens[0] == 'MGET':
+            keys = data.split(' ')[1:]
+            if not keys or '' in keys:
+                return 'Bad format for MGET'
+            self._stats[0] += len(keys)
+            return self.check_result('perform_mget', self._txn_handler.perform_mget(keys))
+        elif tokens[0] == 'MPUT':
+            args = data.split(' ')[1:]
+            if not args or len(args) % 2 != 0 or '' in args:
+                return 'Bad format for MPUT'
+            self._stats[1] += len(args) // 2
+            return self.check_result('perform_mput', self._txn_handler.perform_mput(list(zip(args[::2], args[1::2]))))
+        elif tokens[0] == 'SCAN':
+            if len(tokens) != 3 or tokens[1] == '' or tokens[2] == '':
+                return 'Bad format for SCAN'
+            self._stats[0] += 1
+            return self.check_result('perform_scan', self._txn_handler.perform_scan(tokens[1], tokens[2]))
+        elif tokens[0] == 'PREPARE' and self._server.is_shard:
+            if len(tokens) != 1:
+                return 'Bad format for PREPARE'
+            self._prepared = True
+            return 'Prepared'
+        elif tokens[0] == 'READONLY':
+            if len(tokens) != 1:
+                return 'Bad format for READONLY'
+            if self._server.is_replica:
+                return 'Read-only transaction started'
+            return self._txn_handler.begin_read_only()
+        elif tokens[0] == 'PRIORITY':
+            if len(tokens) != 2 or not tokens[1].isdigit():
+                return 'Bad format for PRIORITY'
+            self._txn_handler.priority = int(tokens[1])
+            return 'Priority set'
         elif tokens[0] == 'COMMIT':
-            if len(tokens) == 1:
-                result = self._txn_handler.commit()
-                if not isinstance(result, str):
-                    raise KVStoreError('T%s.commit() returned %r, which is not a string' % (self._xid, result))
-                self._state, self._data = COMMITTING, result
-            else:
-                self._state, self._data = RESPONDING, 'Bad format for COMMIT'
+            if len(tokens) != 1:
+                return 'Bad format for COMMIT'
+            result = self._txn_handler.commit()
+            self.end_transaction()
+            if self._metrics is not None:
+                if result == 'Validation Abort':
+                    self._metrics.record_abort(VALIDATION_ABORT)
+                else:
+                    self._metrics.commits += 1
+            if not isinstance(result, str):
+                raise KVStoreError('T%s.commit() returned %r, which is not a string' % (self._xid, result))
+            return result
         elif tokens[0] == 'ABORT':
-            if len(tokens) == 1:
-                result = self._txn_handler.abort(USER)
-                if not isinstance(result, str):
-                    raise KVStoreError('T%s.abort() returned %r, which is not a string' % (self._xid, result))
-                self._state, self._data = ABORTING, result
-            else:
-                self._state, self._data = RESPONDING, 'Bad format for ABORT'
+            if len(tokens) != 1:
+                return 'Bad format for ABORT'
+            result = self._txn_handler.abort(USER)
+            self.end_transaction()
+            if self._metrics is not None:
+                self._metrics.record_abort(USER_ABORT)
+            if not isinstance(result, str):
+                raise KVStoreError('T%s.abort() returned %r, which is not a string' % (self._xid, result))
+            return result
         else:
-            self._state, self._data = RESPONDING, 'Unrecognized command'
+            return 'Unrecognized command'
 
-        self._logger.debug('Lock table is %r', self._lock_table)
+    def check_result(self, method, result):
+        if result is not None and not isinstance(result, str):
+            raise KVStoreError('T%s.%s() returned %r, which is not a string or None' % (self._xid, method, result))
+        return result
 
-    def handle_write(self):
+    def begin(self, xid=None):
+        """
+        Handles the BEGIN request, which keeps the connection open after the
+        current transaction ends. Starts a new transaction if there is none,
+        numbered xid on a shard server. The abort of a transaction that
+        ended without the client noticing is not reported.
+
+        @return: the xid of the new transaction, or of the current one if it
+        has not run any request yet.
+        """
+        self._persistent = True
+        self._pending_abort = None
+        if self._state == IDLE:
+            self.start_transaction(self._server.new_xid() if xid is None else xid)
+        elif self._started:
+            return 'Transaction in progress'
+        return str(self._xid)
+
+    def end_transaction(self):
         """
-        Called by the polling loop if writable() is True and the socket is
-        ready to write. We write the data by calling send().
+        Marks the end of a transaction, after a COMMIT or ABORT. Unless the
+        client has sent BEGIN, the handler closes once the response has been
+        sent, and requests pipelined after it are dropped.
         """
-        if self._state != LOCKING:
-            self.reliable_send(self._data)
-            if self._state == ABORTING or self._state == COMMITTING:
-                self.end_transaction()
-            self._data = None
-            self._state = WAITING
+        self._ended = True
+        self._server.remove_transaction(self._xid)
+        if self._persistent:
+            self._state = IDLE
         else:
-            # Try to acquire the necessary locks
-            result = self._txn_handler.check_lock()
-            if result is not None:
-                if not isinstance(result, str):
-                    raise KVStoreError('T%s.check_lock() returned %r, which is not a string or None' % (self._xid, result))
-                self._state, self._data = RESPONDING, result
+            self._state = ENDED
+            self._requests.clear()
+
+    def handle_write(self):
+        """
+        Called to send the queued responses, and by the event loop when the
+        socket is ready to write. We write as much data as the socket takes by
+        calling send(), and wait for the socket to be writable again to send
+        the rest.
+        """
+        if self._output and self.connected:
+            sent = self.send(self._output)
+            self._output = self._output[sent:]
+            self.set_writable(len(self._output) > 0)
+        if not self._output and self._state == ENDED and not self._unflushed:
+            self.close()
 
-    def deadlock_abort(self):
+    def deadlock_abort(self, cause):
+        """
+        Aborts the transaction on behalf of the coordinator, for the given
+        cause (see infra/metrics.py). If no request of the transaction is
+        running (a holder wounded under WOUND_WAIT), the response is held
+        until the client's next request, so that responses still match
+        requests on a persistent connection.
+        """
+        locking = self._state == LOCKING
+        if self._metrics is not None:
+            self._metrics.record_abort(cause)
+            if locking:
+                self.end_wait()
         result = self._txn_handler.abort(DEADLOCK)
+        self.end_transaction()
         if not isinstance(result, str):
             raise KVStoreError('T%s.abort() returned %r, which is not a string' % (self._xid, result))
-        self._state, self._data = ABORTING, result
+        if locking or not self._persistent:
+            self.respond(result)
+        else:
+            self._pending_abort = result
+
+    def uncommitted(self):
+        """
+        @return: the committed values of the keys written by the transaction.
+        """
+        return self._txn_handler.uncommitted()
+
+    def is_locking(self):
+        return self._state == LOCKING
+
+    def is_prepared(self):
+        return self._prepared and not self._ended
 
     def is_open(self):
         return self.connected
 
     def close(self):
-        asyncore.dispatcher.close(self)
-        self._server.remove_transaction(self._xid)
+        Dispatcher.close(self)
+        if not self._ended:
+            # The client went away in the middle of the transaction
+            self._ended = True
+            if self._metrics is not None:
+                self._metrics.record_abort(DISCONNECT_ABORT)
+            self._txn_handler.abort(USER)
+            self._server.remove_transaction(self._xid)
         self._logger.debug('Closed server handler')
 
     def handle_close(self):
         """
-        Closes the handler and removes it from the polling loop.
+        Closes the handler and removes it from the event loop.
 
-        Called when the client has closed the connection. Because the polling
-        loop uses the select syscall, handle_close() is called immediately
-        after the connection is closed.
+        Called when the client has closed the connection, as soon as recv()
+        or send() notices.
         """
         self._logger.debug('Client disconnected, closing server handler')
         self.close()
+        if self._server.is_shard and self._server.is_open():
+            # The front end only closes its connections when it stops, so
+            # the shard stops too, once the other connections are closed
+            self._server.handle_close()
 
     def handle_error(self):
         """
-        Closes the handler and removes it from the polling loop.
+        Closes the handler and removes it from the event loop.
 
         Called when one of the handle_*() methods of the class raises an
         exception. Prints the stack trace and closes the handler.
@@ -236,11 +488,47 @@ class KVStoreServerHandler(asyncore.dispatcher):
         self._logger.error('Uncaught exception, closing server handler\n%s', exc[:-1])
         self.close()
 
-class KVStoreServer(asyncore.dispatcher):
+def listen(address):
+    """
+    @return: a socket listening on address, a Unix socket path or a (host,
+    port) pair.
+    """
+    # Raise an exception if we can connect to an existing server. If a
+    # context switch occurs in the middle of this code segment, or before
+    # the socket is bound to the socket file, then this will fail. We
+    # assume that the probability that the user constructs two servers in
+    # two different processes at the same time is low, and we ignore this
+    # edge case. It should not be a problem in any of the test files - most
+    # of these only create a single instance of the server class.
+    if not isinstance(address, tuple) and os.path.exists(address):
+        test_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            test_sock.connect(address)
+            raise KVStoreError('Server seems to be running')
+        except socket.error as e:
+            pass
+        finally:
+            test_sock.close()
+        os.unlink(address)
+
+    if isinstance(address, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(address)
+        sock.listen(LISTEN_BACKLOG)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+class KVStoreServer(Dispatcher):
     """
     The server listens for incoming connections from clients and spawns a
     handler to communicate with each client. The run() method of the server
-    starts the polling loop.
+    starts the event loop.
     """
 
     @classmethod
@@ -250,49 +538,102 @@ class KVStoreServer(asyncore.dispatcher):
         else:
             return min(poll_timeout, ttl - elapsed_time)
 
-    def __init__(self, kvstore_class=KVSTORE_CLASS, log_level=logging.WARNING, max_handlers=None):
+    def __init__(self, kvstore_class=KVSTORE_CLASS, log_level=logging.WARNING, max_handlers=None, deadlock_policy=DETECT, lock_timeout=1.0, escalation_threshold=ESCALATION_THRESHOLD, address=SOCKET_FILE, shard=False, metrics=True, metrics_file=None, metrics_interval=10.0, trace_file=None, optimistic=False, scheduler=None, replication_address=None, replica_of=None, snapshot_file=None, snapshot_interval=None):
         """
-        Initializes the server. Does not start the polling loop. After the
-        constructor returns, there can be no other servers.
+        Initializes the server. Does not start the event loop. After the
+        constructor returns, there can be no other servers on the same
+        address.
+
+        address is the path of the Unix socket to listen on, or a (host,
+        port) pair to listen on TCP instead. With port 0, the system picks a
+        free port, which can be found in self.address.
+
+        deadlock_policy selects deadlock detection or one of the prevention
+        policies in locktable.py. lock_timeout is the number of seconds a
+        transaction may wait for a lock under the TIMEOUT policy.
+        escalation_threshold is the number of key locks after which a
+        transaction's key locks are escalated to a table lock, or None.
+
+        shard makes this server one of the shards behind the front end of
+        infra/sharding.py, which takes its requests from the front end only.
+
+        metrics enables the metrics returned by the STATS command, which are
+        also appended to metrics_file, if given, every metrics_interval
+        seconds.
+
+        trace_file, if given, is the path of a binary trace file to which
+        every change to the lock table is appended (see locktrace.py).
+
+        optimistic runs transactions under optimistic concurrency control
+        (see student.OptimisticTransactionHandler) instead of locking.
+
+        scheduler is the locktable.GrantScheduler that orders the requests
+        for each lock, or None for FIFO order.
+
+        replication_address, if given, makes this server a primary, whose
+        replicas connect to that address (see infra/replication.py), and
+        whose store must support snapshots or be an in-memory one.
+        replica_of, the replication address of a primary, makes it a replica
+        of that primary instead, whose store must support snapshots.
+
+        snapshot_file, if given, is the path of a binary snapshot of the store
+        (see snapshot.py), loaded into the store if it exists, and written
+        when run() returns and, if snapshot_interval is given, every
+        snapshot_interval seconds by a forked child, without stalling the
+        loop. The store must be an in-memory one.
         """
         self._logger = logging.getLogger('<%s>' % (self.__class__.__name__))
         self._logger.setLevel(log_level)
         self._remaining_handlers = max_handlers
+        self.is_shard = shard
+        self.optimistic = optimistic
+        self.metrics = Metrics() if metrics else None
+        self._metrics_file = metrics_file if metrics else None
+        self._metrics_interval = metrics_interval
+        self.tracer = TraceWriter(trace_file) if trace_file is not None else None
         self._stats = [0, 0]
-        self._lock_table = {}
+        self._lock_table = LockTable(deadlock_policy, lock_timeout, escalation_threshold=escalation_threshold, scheduler=scheduler)
         self._next_xid = 0
         self._store = kvstore_class()
+        self._checkpointer = None
+        self._snapshot_interval = snapshot_interval
+        if snapshot_file is not None:
+            if not hasattr(self._store, 'load') or not hasattr(self._store, 'data'):
+                raise KVStoreError('%s cannot load or write snapshots' % (kvstore_class.__name__))
+            if os.path.exists(snapshot_file):
+                start = time.time()
+                self._store.load(read_snapshot(snapshot_file))
+                self._logger.info('Loaded %s in %.2f s', snapshot_file, time.time() - start)
+            self._checkpointer = Checkpointer(snapshot_file)
+        if replication_address is not None:
+            if not hasattr(self._store, 'snapshot') and not hasattr(self._store, 'data'):
+                raise KVStoreError('%s cannot be copied to replicas' % (kvstore_class.__name__))
+            self._store = CommitLog(self._store)
+        self.is_replica = replica_of is not None
+        # The infra.replication.Primary or Replica of the server, or None
+        self.replication = None
         self._log_level = log_level
         self._txn_map = {}
+        # Handlers whose locks were granted during the current loop iteration
+        self._woken = []
+        # Handlers with responses waiting for the store to be flushed
+        self._has_waited_output = []
+        self._has_output = []
         self._coordinator = TransactionCoordinator(self._lock_table)
 
-        # Raise an exception if we can connect to an existing server. If a
-        # context switch occurs in the middle of this code segment, or before
-        # the socket is bound to the socket file, then this will fail. We
-        # assume that the probability that the user constructs two servers in
-        # two different processes at the same time is low, and we ignore this
-        # edge case. It should not be a problem in any of the test files - most
-        # of these only create a single instance of the server class.
-        if os.path.exists(SOCKET_FILE):
-            test_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            try:
-                test_sock.connect(SOCKET_FILE)
-                raise KVStoreError('Server seems to be running')
-            except socket.error as e:
-                pass
-            finally:
-                test_sock.close()
-            os.unlink(SOCKET_FILE)
-
+        self._tcp = isinstance(address, tuple)
+        self._loop = EventLoop()
+        sock = listen(address)
         try:
-            asyncore.dispatcher.__init__(self)
-
-            # Create socket, but do not connect to anything yet
-            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.set_reuse_addr()
-
-            self.bind(SOCKET_FILE)
-            self.listen(5)
+            self.address = sock.getsockname()
+            Dispatcher.__init__(self, self._loop, sock)
+            if replication_address is not None:
+                self.replication = Primary(self._loop, listen(replication_address), self._store, log_level,
+                                           self.committed_state)
+            elif replica_of is not None:
+                self.replication = Replica(self._loop, self._store, replica_of, log_level)
+            if self.replication is not None and self.metrics is not None:
+                self.metrics.replication = self.replication
         except Exception as e:
             exc = traceback.format_exc()
             self._logger.error('Uncaught exception in __init__, closing server\n%s', exc[:-1])
@@ -301,99 +642,248 @@ class KVStoreServer(asyncore.dispatcher):
 
         self._logger.debug('Constructed server')
 
+    def new_xid(self):
+        xid = self._next_xid
+        self._next_xid += 1
+        return xid
+
+    def add_transaction(self, xid, handler):
+        """
+        Server handler calls this when it starts a transaction.
+        """
+        self._txn_map[xid] = handler
+
     def remove_transaction(self, xid):
         """
-        Server handler calls this when it is closed. No method in the server
-        should have to call this directly.
+        Server handler calls this when its transaction ends, or when it is
+        closed. No method in the server should have to call this directly.
         """
         self._txn_map.pop(xid, None)
 
+    def wake(self, handler):
+        """
+        Server handler calls this when its transaction is granted a lock.
+        """
+        self._woken.append(handler)
+
+    def respond_woken(self):
+        """
+        Lets handlers whose locks were granted finish their requests without
+        waiting for another poll. Blocked handlers cost nothing until they are
+        woken.
+        """
+        while self._woken:
+            woken, self._woken = self._woken, []
+            for handler in woken:
+                if handler.is_open():
+                    try:
+                        handler.resume()
+                    except Exception:
+                        handler.handle_error()
+
+    def has_output(self, handler, waited=False):
+        """
+        Server handler calls this when it queues responses, which are sent
+        after the store is flushed. waited is True if the first response is
+        for a request that had to wait for a lock.
+        """
+        if waited:
+            self._has_waited_output.append(handler)
+        else:
+            self._has_output.append(handler)
+
+    def send_output(self):
+        """
+        Sends the responses queued since the store was last flushed, starting
+        with the handlers that waited for a lock, which have waited longest.
+        """
+        has_output = self._has_waited_output + self._has_output
+        self._has_waited_output, self._has_output = [], []
+        for handler in has_output:
+            if handler.is_open():
+                try:
+                    handler.flush_output()
+                except Exception:
+                    handler.handle_error()
+
     def run(self, check_deadlock_fn=None, poll_timeout=1.0, ttl=None):
         """
-        Runs the polling loop. This does not create any separate processes or
+        Runs the event loop. This does not create any separate processes or
         threads, and it only returns after all handlers and the server itself
         have been closed. For debugging purposes, we can also specify a time-
         to-live (ttl), which specifies the number of seconds that the server
         and server handlers are allowed to run before they are forcibly closed.
 
-        This is a monkeypatched version of asyncore.loop(). This was the
-        cleanest way to add the deadlock detector and ttl.
+        After each poll, the loop runs the deadlock detector, lets the
+        handlers whose locks were granted finish their requests, flushes the
+        store and sends the responses. Only handlers that have something to
+        do are visited, so idle connections cost nothing.
+
+        The connections of replication do not keep the server running: run()
+        returns once the clients are gone and the server is closed.
         """
         if check_deadlock_fn is None:
             check_deadlock_fn = lambda get_count, put_count: True
+        if self._lock_table.policy == TIMEOUT:
+            poll_timeout = min(poll_timeout, self._lock_table.lock_timeout)
+        if self._metrics_file is not None:
+            poll_timeout = min(poll_timeout, self._metrics_interval)
+        if self._snapshot_interval is not None:
+            poll_timeout = min(poll_timeout, self._snapshot_interval)
         start_time = time.time()
+        next_dump = start_time + self._metrics_interval
+        next_snapshot = start_time + (self._snapshot_interval or 0)
         timed_out = False
-        while len(asyncore.socket_map) > 0:
+        while len(self._loop) > (0 if self.replication is None else self.replication.dispatchers()):
             elapsed_time = time.time() - start_time
             if ttl is not None and elapsed_time > ttl:
                 timed_out = True
                 break
+            if self._metrics_file is not None and time.time() >= next_dump:
+                next_dump = time.time() + self._metrics_interval
+                self.metrics.dump(self._metrics_file)
             new_poll_timeout = self.get_poll_timeout(poll_timeout, ttl, elapsed_time)
-            # Run select syscall and readable() and writable() on all handlers,
-            # then run handle_read() and handle_write() on appropriate handlers
-            asyncore.poll(new_poll_timeout, asyncore.socket_map)
-            if check_deadlock_fn(self._stats[0], self._stats[1]):
-                abort_id = self._coordinator.detect_deadlocks()
-                if abort_id is not None:
-                    self._txn_map[abort_id].deadlock_abort()
-        for fd, obj in asyncore.socket_map.items():
-            if obj != self:
-                obj.close()
+            # Wait for sockets to be ready, then run handle_read() and
+            # handle_write() on their handlers
+            self._loop.poll(new_poll_timeout)
+            while True:
+                # Prevention policies only pick victims, which is cheap, so we
+                # always abort them
+                if self._lock_table.policy != DETECT or check_deadlock_fn(self._stats[0], self._stats[1]):
+                    self.abort_deadlocked()
+                if not self._woken:
+                    break
+                self.respond_woken()
+            # Make the commits of this poll durable before responding to any
+            # request that may have seen them (group commit)
+            self._store.flush()
+            if self.replication is not None:
+                self.replication.after_flush()
+            if self._snapshot_interval is not None and time.time() >= next_snapshot and self._checkpointer.start(self.committed_state):
+                next_snapshot = time.time() + self._snapshot_interval
+            self.send_output()
+        for handler in list(self._loop.handlers.values()):
+            if handler is not self:
+                handler.close()
         self.close()
+        self._loop.close()
+        self._store.flush()
+        if self._checkpointer is not None:
+            self._checkpointer.wait()
+            self._checkpointer.write(self.committed_state)
+        if self._metrics_file is not None:
+            self.metrics.dump(self._metrics_file)
+        if self.tracer is not None:
+            self.tracer.close()
         self._logger.debug('No more open connections')
         if timed_out:
             raise KVStoreError('Server timed out')
 
-    def readable(self):
+    def committed_state(self):
+        """
+        @return: the data of the store, and the committed values of the keys
+        written by open transactions, which snapshot.write_snapshot() writes
+        as the committed state of the store.
+        """
+        overrides = {}
+        for handler in self._txn_map.values():
+            overrides.update(handler.uncommitted())
+        return self._store.data(), overrides
+
+    def abort_deadlocked(self):
         """
-        handle_accept() is called if readable() is True and the select syscall
-        says the socket is ready to read.
+        Aborts the transactions chosen by the coordinator, through the same
+        path as a deadlock abort, until there are none left.
+        """
+        abort_id = self._coordinator.detect_deadlocks()
+        while abort_id is not None:
+            handler = self._txn_map.get(abort_id)
+            if handler is None:
+                self._logger.error('T%s was chosen for abort but has no handler', abort_id)
+                break
+            if handler.is_prepared():
+                # A prepared transaction is about to commit on every shard,
+                # so the older transaction waits for it instead
+                self._lock_table.victims.pop(abort_id, None)
+            else:
+                handler.deadlock_abort(POLICY_ABORTS[self._lock_table.policy])
+            abort_id = self._coordinator.detect_deadlocks()
 
-        We always want to call handle_accept() if there is data to be read.
+    def waits_for_edges(self):
+        """
+        @return: the edges of the waits-for graph of this shard, as
+        'waiter holder waiter holder ...', for the global deadlock detector.
         """
-        return True
+        waits_for = self._lock_table.waits_for
+        if waits_for is None:
+            return ''
+        return ' '.join('%d %d' % (waiter, holder) for waiter, holders in sorted(waits_for.edges.items()) for holder in sorted(holders))
 
-    def writable(self):
+    def kill(self, xid):
+        """
+        Aborts transaction xid, chosen by the global deadlock detector, if it
+        is still waiting for a lock on this shard.
         """
-        handle_write() is called if writable() is True and the select syscall
-        says the socket is ready to write.
+        handler = self._txn_map.get(xid)
+        if handler is None or not handler.is_locking():
+            return 'Not waiting'
+        handler.deadlock_abort(GLOBAL_DEADLOCK_ABORT)
+        return 'Killed'
 
-        We never want to call handle_write().
+    def stats_report(self):
         """
-        return False
+        @return: the response to STATS, the metrics as JSON.
+        """
+        if self.metrics is None:
+            return 'Metrics are disabled'
+        return self.metrics.to_json()
 
-    def handle_accept(self):
+    def handle_read(self):
         """
-        Accepts a connection from a client, and spawns a new handler to perform
-        all future communication with that client. The handler is closed
-        immediately if an exception occurs in the constructor, otherwise it
-        is added to the polling loop.
+        Called by the event loop when connections are waiting to be accepted.
+        Accepts all of them.
         """
-        pair = self.accept()
-        if pair is not None:
-            sock, _ = pair
-            self._logger.debug('Accepted connection')
-            xid = self._next_xid
-            self._next_xid += 1
-            # After it is initialized, the handler only interacts with the
-            # server through the variables passed (by reference) into the
-            # constructor
-            server_handler = KVStoreServerHandler(sock, self, self._store, self._stats, self._lock_table, xid, self._log_level)
-            if server_handler.is_open():
-                # Constructor did not raise an exception
-                self._txn_map[xid] = server_handler
+        while self.connected:
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK or e.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+            self.handle_accept(sock)
+
+    def handle_accept(self, sock):
+        """
+        Spawns a new handler to perform all future communication with the
+        client connected to sock. The handler is closed immediately if an
+        exception occurs in the constructor, otherwise it is added to the
+        event loop.
+        """
+        self._logger.debug('Accepted connection')
+        if self._tcp:
+            # Responses are small and latency-bound
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # After it is initialized, the handler only interacts with the
+        # server through the variables passed (by reference) into the
+        # constructor, and the methods that register its transactions.
+        # The handler is closed if the constructor raises an exception.
+        xid = None if self.is_shard else self.new_xid()
+        KVStoreServerHandler(self._loop, sock, self, self._store, self._stats, self._lock_table, xid, self._log_level)
         if self._remaining_handlers is not None:
             self._remaining_handlers -= 1
             if self._remaining_handlers == 0:
                 self.handle_close()
 
+    def is_open(self):
+        return self.connected
+
     def close(self):
-        asyncore.dispatcher.close(self)
+        Dispatcher.close(self)
         self._logger.debug('Closed server')
 
     def handle_close(self):
         """
-        Closes the server and removes it from the polling loop. If handlers
+        Closes the server and removes it from the event loop. If handlers
         have not been closed yet, then run() will not return.
 
         Called when the server has created the maximum number of handlers.
@@ -403,7 +893,7 @@ class KVStoreServer(asyncore.dispatcher):
 
     def handle_error(self):
         """
-        Closes the server and removes it from the polling loop. If handlers
+        Closes the server and removes it from the event loop. If handlers
         have not been closed yet, then run() will not return.
 
         Called when one of the handle_*() methods of the class raises an
@@ -0,0 +1,698 @@
+import errno
+import json
+import logging
+import multiprocessing
+import re
+import socket
+import time
+import traceback
+import zlib
+from collections import deque
+from functools import partial
+
+from infra.eventloop import WOULD_BLOCK, Dispatcher, EventLoop
+from infra.server import ENDED, IDLE, LOCKING, WAITING, KVStoreServer, listen
+from infra.utils import CHUNK_SIZE, SOCKET_FILE, KVStoreError, MessageReader, encode_message, get_logger, to_bytes
+from locktable import DETECT, LockTable
+from student import ESCALATION_THRESHOLD, KVSTORE_CLASS, TransactionCoordinator
+
+"""
+A sharded server, for running on more than one core. Keys are hash-
+partitioned across shards, each a KVStoreServer in its own process with its
+own store and lock table. Clients connect to a front end, which speaks the
+same protocol as KVStoreServer and routes each request to the shards that
+own its keys, within a transaction that has the same xid on every shard.
+
+A transaction that wrote to more than one shard commits with two-phase
+commit: the front end sends PREPARE to every shard it touched, then COMMIT
+if all of them voted 'Prepared', or ABORT otherwise. A prepared transaction
+can no longer be aborted by a shard. Prepare records are not logged, so a
+shard that crashes between the two phases loses its part of the
+transaction.
+
+Each shard breaks the deadlocks among its own transactions. Under the DETECT
+policy, the front end also collects the waits-for edges of every shard, and
+breaks the cycles that span shards by sending KILL to the shard where the
+victim waits. The prevention policies need no global detector, since xids
+are global timestamps.
+"""
+
+def shard_of(key, num_shards):
+    """
+    @return: the index of the shard that owns key. The hash is the same in
+    every process, unlike hash() of a string.
+    """
+    return (zlib.crc32(to_bytes(key)) & 0xffffffff) % num_shards
+
+def shard_address(address, index):
+    """
+    @return: the address of shard index of the front end at address: the
+    next ports for TCP, or sibling socket files.
+    """
+    if isinstance(address, tuple):
+        host, port = address
+        return (host, port + 1 + index)
+    return '%s.shard%d' % (address, index)
+
+def global_deadlock_victims(edges):
+    """
+    Breaks the cycles of the global waits-for graph, the union of the graphs
+    of the shards, choosing victims as TransactionCoordinator does.
+
+    @param edges: the (waiter, holder) edges of every shard.
+    @return: the xids of the transactions to abort.
+    """
+    lock_table = LockTable(DETECT)
+    for waiter, holder in edges:
+        lock_table.waits_for.add_edges(waiter, [holder])
+    coordinator = TransactionCoordinator(lock_table)
+    victims = []
+    victim = coordinator.detect_deadlocks()
+    while victim is not None:
+        victims.append(victim)
+        lock_table.waits_for.remove_waiter(victim)
+        victim = coordinator.detect_deadlocks()
+    return victims
+
+def run_shard(address, kwargs):
+    KVStoreServer(address=address, shard=True, **kwargs).run()
+
+def ignore(response):
+    pass
+
+class ShardConnection(Dispatcher):
+    """
+    A connection from the front end to a shard. Requests are sent in order,
+    each with a callback that is called with its response. Connections are
+    pooled by the front end, and carry one transaction at a time.
+    """
+
+    def __init__(self, loop, server, address, index):
+        self.index = index
+        self._server = server
+        self._reader = MessageReader()
+        # Callbacks of the requests sent, in order
+        self._callbacks = deque()
+        # Requests queued since the last flush_output()
+        self._unflushed = []
+        self._output = b''
+        self.connected = False
+        if isinstance(address, tuple):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+        except socket.error:
+            sock.close()
+            raise
+        Dispatcher.__init__(self, loop, sock)
+
+    def request(self, msg, callback):
+        """
+        Queues msg, which is sent once the front end has finished the current
+        loop iteration.
+        """
+        if not self._unflushed:
+            self._server.has_output(self)
+        self._unflushed.append(encode_message(msg))
+        self._callbacks.append(callback)
+
+    def flush_output(self):
+        self._output += b''.join(self._unflushed)
+        self._unflushed = []
+        self.handle_write()
+
+    def handle_write(self):
+        if self._output and self.connected:
+            sent = self.send(self._output)
+            self._output = self._output[sent:]
+            self.set_writable(len(self._output) > 0)
+
+    def handle_read(self):
+        data = self.recv(CHUNK_SIZE)
+        if not data:
+            return
+        for response in self._reader.feed(data):
+            self._callbacks.popleft()(response)
+
+    def handle_close(self):
+        self.close()
+        self._server.shard_lost(self.index)
+
+    def handle_error(self):
+        exc = traceback.format_exc()
+        logging.getLogger('<%s>' % (self.__class__.__name__)).error('Uncaught exception on shard %d\n%s', self.index, exc[:-1])
+        self.handle_close()
+
+class FrontEndHandler(Dispatcher):
+    """
+    Communicates with a single client, like KVStoreServerHandler, and runs
+    each request of the client's transaction on the shards that own its
+    keys. The handler has the states of KVStoreServerHandler; it is LOCKING
+    while a request runs on the shards, whether or not they wait for locks.
+
+    Requests on keys of several shards (MGET, MPUT and SCAN) are split, and
+    run on one shard after another, in shard order, so that a transaction
+    never waits on two shards at once.
+    """
+
+    def __init__(self, loop, sock, server, xid, log_level):
+        self._log_level = log_level
+        self._server = server
+        self._persistent = False
+        self._reader = MessageReader()
+        self._requests = deque()
+        # Responses queued since the last flush_output()
+        self._unflushed = []
+        self._closed = False
+        self.connected = False
+        self.start_transaction(xid)
+        self._output = encode_message(str(self._xid))
+
+        try:
+            Dispatcher.__init__(self, loop, sock)
+            self.handle_write()
+        except:
+            exc = traceback.format_exc()
+            self._logger.error('Uncaught exception in __init__, cannot construct front end handler\n%s', exc[:-1])
+            self.close()
+            return
+
+        self._logger.debug('Constructed front end handler')
+
+    def start_transaction(self, xid):
+        self._xid = xid
+        self._logger = get_logger(self, xid, self._log_level)
+        self._state = WAITING
+        self._started = False
+        self._ended = False
+        # Set once COMMIT has been sent to the shards, after which the
+        # outcome of the transaction no longer depends on the client
+        self._committing = False
+        # Maps the index of each shard that the transaction has run requests
+        # on to the connection to that shard
+        self._shards = {}
+
+    def handle_read(self):
+        data = self.recv(CHUNK_SIZE)
+        if not data:
+            return
+        self._requests.extend(self._reader.feed(data))
+        self.run_requests()
+
+    def run_requests(self):
+        while self._requests and (self._state == WAITING or self._state == IDLE):
+            state = self._state
+            result = self.run_request(self._requests.popleft())
+            if result is None:
+                # STATS may run between transactions
+                self._resume_state = state
+                self._state = LOCKING
+            else:
+                self.respond(result)
+
+    def respond(self, result):
+        if not self.connected:
+            return
+        if not self._unflushed:
+            self._server.has_output(self)
+        self._unflushed.append(encode_message(result))
+
+    def finish(self, result):
+        """
+        Called with the response of the request that ran on the shards.
+        """
+        if self._state == LOCKING:
+            self._state = self._resume_state
+        self.respond(result)
+        self.run_requests()
+
+    def flush_output(self):
+        self._output += b''.join(self._unflushed)
+        self._unflushed = []
+        self.handle_write()
+
+    def run_request(self, data):
+        """
+        Runs a single request, and returns its response, or None if it was
+        sent to the shards, in which case finish() is called with the
+        response.
+        """
+        if data == '':
+            return 'Unrecognized command'
+        if data[0] == ' ':
+            return 'Command begins with whitespace'
+        if re.search(r'[^A-Za-z0-9_ ]', data):
+            return 'Special characters in message'
+        tokens = data.split(' ', 3)
+        if tokens[0] == 'BEGIN':
+            if len(tokens) != 1:
+                return 'Bad format for BEGIN'
+            return self.begin()
+        if tokens[0] == 'STATS':
+            if len(tokens) != 1:
+                return 'Bad format for STATS'
+            self._server.collect_stats(self.finish)
+            return None
+        if self._state == IDLE:
+            return 'No transaction in progress'
+        self._started = True
+        num_shards = self._server.num_shards
+        if tokens[0] == 'GET' or tokens[0] == 'PUT':
+            if len(tokens) != (2 if tokens[0] == 'GET' else 3) or '' in tokens:
+                return 'Bad format for %s' % (tokens[0])
+            self._server.stats[tokens[0] == 'PUT'] += 1
+            self.forward(shard_of(tokens[1], num_shards), data, self.finish)
+        elif tokens[0] == 'MGET':
+            keys = data.split(' ')[1:]
+            if not keys or '' in keys:
+                return 'Bad format for MGET'
+            self._server.stats[0] += len(keys)
+            groups = self.group(keys, 1)
+            def on_values(responses):
+                values = {}
+                for group, response in zip(groups, responses):
+                    values.update(zip(group[1], response.split('\n')))
+                self.finish('\n'.join(values[key] for key in keys))
+            self.run_in_turn([(index, 'MGET ' + ' '.join(group)) for index, group in groups], on_values)
+        elif tokens[0] == 'MPUT':
+            args = data.split(' ')[1:]
+            if not args or len(args) % 2 != 0 or '' in args:
+                return 'Bad format for MPUT'
+            self._server.stats[1] += len(args) // 2
+            groups = self.group(args, 2)
+            def on_written(responses):
+                self.finish(next((response for response in responses if response != 'Success'), 'Success'))
+            self.run_in_turn([(index, 'MPUT ' + ' '.join(group)) for index, group in groups], on_written)
+        elif tokens[0] == 'SCAN':
+            if len(tokens) != 3 or tokens[1] == '' or tokens[2] == '':
+                return 'Bad format for SCAN'
+            self._server.stats[0] += 1
+            def on_scanned(responses):
+                pairs = []
+                for response in responses:
+                    if response != 'No such key':
+                        words = response.split(' ')
+                        pairs.extend(zip(words[::2], words[1::2]))
+                pairs.sort()
+                self.finish(' '.join('%s %s' % pair for pair in pairs) if pairs else 'No such key')
+            self.run_in_turn([(index, data) for index in range(num_shards)], on_scanned)
+        elif tokens[0] == 'READONLY':
+            return 'Read-only transactions are not supported by the sharded server'
+        elif tokens[0] == 'PRIORITY':
+            return 'Priorities are not supported by the sharded server'
+        elif tokens[0] == 'COMMIT':
+            if len(tokens) != 1:
+                return 'Bad format for COMMIT'
+            return self.commit()
+        elif tokens[0] == 'ABORT':
+            if len(tokens) != 1:
+                return 'Bad format for ABORT'
+            self.abort_shards()
+            self.end_transaction()
+            return 'User Abort'
+        else:
+            return 'Unrecognized command'
+        return None
+
+    def group(self, words, step):
+        """
+        Splits a list of keys (step 1) or of keys and values (step 2) by
+        shard.
+
+        @return: a list of (shard index, words of that shard), in shard order.
+        """
+        groups = {}
+        num_shards = self._server.num_shards
+        for i in range(0, len(words), step):
+            groups.setdefault(shard_of(words[i], num_shards), []).extend(words[i:i + step])
+        return sorted(groups.items())
+
+    def run_in_turn(self, requests, callback):
+        """
+        Runs the (shard index, request) pairs one after another, then calls
+        callback with the list of their responses.
+        """
+        responses = []
+        def run_next(response=None):
+            if response is not None:
+                responses.append(response)
+            if len(responses) == len(requests):
+                callback(responses)
+            else:
+                index, msg = requests[len(responses)]
+                self.forward(index, msg, run_next)
+        run_next()
+
+    def forward(self, index, msg, callback):
+        """
+        Sends msg to shard index, starting the transaction there if this is
+        its first request on that shard, and calls callback with the
+        response. If the shard aborts the transaction, the transaction is
+        aborted on the other shards, and the client gets the abort instead.
+        """
+        conn = self._shards.get(index)
+        if conn is None:
+            conn = self._server.connect_shard(index)
+            self._shards[index] = conn
+            conn.request('BEGIN %d' % (self._xid), ignore)
+        xid = self._xid
+        def on_response(response):
+            if self._xid != xid or self._ended:
+                # The client went away, and the transaction was aborted
+                return
+            if response == 'Deadlock Abort':
+                del self._shards[index]
+                self._server.release_shard(conn)
+                self.abort_shards()
+                self.end_transaction()
+                self.finish(response)
+            else:
+                callback(response)
+        conn.request(msg, on_response)
+
+    def abort_shards(self):
+        """
+        Aborts the transaction on every shard it has run requests on.
+        """
+        for conn in self._shards.values():
+            conn.request('ABORT', partial(self._server.release_shard, conn))
+        self._shards = {}
+
+    def commit(self):
+        """
+        Commits the transaction on the shards: directly if it ran on one
+        shard, with two-phase commit if it ran on several.
+        """
+        shards, self._shards = self._shards, {}
+        self._committing = True
+        if not shards:
+            self.end_transaction()
+            return 'Transaction Completed'
+        responses = []
+        def on_commit(conn, response):
+            self._server.release_shard(conn)
+            responses.append(response)
+            if len(responses) == len(shards):
+                self.end_transaction()
+                self.finish(responses[0])
+        if len(shards) == 1:
+            for conn in shards.values():
+                conn.request('COMMIT', partial(on_commit, conn))
+            return None
+        votes = []
+        def on_vote(conn, vote):
+            votes.append((conn, vote))
+            if len(votes) < len(shards):
+                return
+            if all(vote == 'Prepared' for _, vote in votes):
+                self._server.stats[2] += 1
+                for conn, _ in votes:
+                    conn.request('COMMIT', partial(on_commit, conn))
+                return
+            # A shard aborted the transaction before it could prepare
+            for conn, vote in votes:
+                if vote == 'Prepared':
+                    conn.request('ABORT', partial(self._server.release_shard, conn))
+                else:
+                    self._server.release_shard(conn)
+            self.end_transaction()
+            self.finish(next(vote for _, vote in votes if vote != 'Prepared'))
+        for conn in shards.values():
+            conn.request('PREPARE', partial(on_vote, conn))
+        return None
+
+    def begin(self):
+        self._persistent = True
+        if self._state == IDLE:
+            self.start_transaction(self._server.new_xid())
+        elif self._started:
+            return 'Transaction in progress'
+        return str(self._xid)
+
+    def end_transaction(self):
+        self._ended = True
+        if self._persistent:
+            self._state = IDLE
+        else:
+            self._state = ENDED
+            self._requests.clear()
+
+    def handle_write(self):
+        if self._output and self.connected:
+            sent = self.send(self._output)
+            self._output = self._output[sent:]
+            self.set_writable(len(self._output) > 0)
+        if not self._output and self._state == ENDED and not self._unflushed:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        Dispatcher.close(self)
+        if not self._ended and not self._committing:
+            # The client went away in the middle of the transaction
+            self._ended = True
+            self.abort_shards()
+        self._server.remove_handler()
+        self._logger.debug('Closed front end handler')
+
+    def handle_close(self):
+        self._logger.debug('Client disconnected, closing front end handler')
+        self.close()
+
+    def handle_error(self):
+        exc = traceback.format_exc()
+        self._logger.error('Uncaught exception, closing front end handler\n%s', exc[:-1])
+        self.close()
+
+class ShardedKVStoreServer(Dispatcher):
+    """
+    The front end of the sharded server. The constructor starts num_shards
+    shard processes, and run() runs the event loop of the front end.
+
+    stats: [GETs, PUTs, two-phase commits, global deadlock aborts]
+    """
+
+    def __init__(self, num_shards=4, kvstore_class=KVSTORE_CLASS, log_level=logging.WARNING, max_handlers=None, deadlock_policy=DETECT, lock_timeout=1.0, escalation_threshold=ESCALATION_THRESHOLD, address=SOCKET_FILE, detect_interval=0.01):
+        """
+        The arguments are those of KVStoreServer, which are passed on to the
+        shards, and detect_interval, the number of seconds between two runs of
+        the global deadlock detector.
+        """
+        self._logger = logging.getLogger('<%s>' % (self.__class__.__name__))
+        self._logger.setLevel(log_level)
+        self._log_level = log_level
+        self.num_shards = num_shards
+        self.stats = [0, 0, 0, 0]
+        self._remaining_handlers = max_handlers
+        self._num_handlers = 0
+        self._next_xid = 0
+        self._policy = deadlock_policy
+        self._detect_interval = detect_interval
+        self._collecting = False
+        self._has_output = []
+        self._loop = EventLoop()
+        self._shard_addresses = [shard_address(address, index) for index in range(num_shards)]
+        # Idle connections to each shard
+        self._idle_shards = [[] for _ in range(num_shards)]
+
+        kwargs = dict(kvstore_class=kvstore_class, log_level=log_level, deadlock_policy=deadlock_policy, lock_timeout=lock_timeout, escalation_threshold=escalation_threshold)
+        self._processes = []
+        for shard in self._shard_addresses:
+            process = multiprocessing.Process(target=run_shard, args=(shard, kwargs))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        try:
+            # Connections for EDGES and KILL
+            self._control = [self.wait_for_shard(index) for index in range(num_shards)]
+            self._tcp = isinstance(address, tuple)
+            sock = listen(address)
+            self.address = sock.getsockname()
+            Dispatcher.__init__(self, self._loop, sock)
+        except Exception:
+            exc = traceback.format_exc()
+            self._logger.error('Uncaught exception in __init__, closing server\n%s', exc[:-1])
+            self.stop_shards()
+            raise
+
+        self._logger.debug('Constructed server with %d shards', num_shards)
+
+    def wait_for_shard(self, index, timeout=10.0):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return ShardConnection(self._loop, self, self._shard_addresses[index], index)
+            except socket.error:
+                if time.time() > deadline or not self._processes[index].is_alive():
+                    raise KVStoreError('Shard %d did not start' % (index))
+                time.sleep(0.01)
+
+    def new_xid(self):
+        xid = self._next_xid
+        self._next_xid += 1
+        return xid
+
+    def connect_shard(self, index):
+        """
+        @return: an idle connection to shard index.
+        """
+        idle = self._idle_shards[index]
+        if idle:
+            return idle.pop()
+        return ShardConnection(self._loop, self, self._shard_addresses[index], index)
+
+    def release_shard(self, conn, response=None):
+        """
+        Returns a connection whose transaction has ended to the pool. May be
+        used as the callback of the request that ends the transaction.
+        """
+        if conn.connected:
+            self._idle_shards[conn.index].append(conn)
+
+    def has_output(self, dispatcher):
+        self._has_output.append(dispatcher)
+
+    def send_output(self):
+        has_output, self._has_output = self._has_output, []
+        for dispatcher in has_output:
+            if dispatcher.connected:
+                try:
+                    dispatcher.flush_output()
+                except Exception:
+                    dispatcher.handle_error()
+
+    def remove_handler(self):
+        self._num_handlers -= 1
+
+    def detect_deadlocks(self):
+        """
+        Collects the waits-for edges of every shard, then aborts a victim on
+        each cycle of the global graph.
+        """
+        if self._collecting:
+            return
+        self._collecting = True
+        edges = []
+        # Maps each waiter to the shard where it waits
+        waiting_at = {}
+        replies = []
+        def on_edges(index, response):
+            words = response.split()
+            for i in range(0, len(words), 2):
+                waiter = int(words[i])
+                edges.append((waiter, int(words[i + 1])))
+                waiting_at[waiter] = index
+            replies.append(index)
+            if len(replies) < self.num_shards:
+                return
+            self._collecting = False
+            for victim in global_deadlock_victims(edges):
+                self._logger.debug('Aborting T%d on shard %d', victim, waiting_at[victim])
+                self._control[waiting_at[victim]].request('KILL %d' % (victim), self.killed)
+        for index, conn in enumerate(self._control):
+            conn.request('EDGES', partial(on_edges, index))
+
+    def collect_stats(self, callback):
+        """
+        Calls callback with the response to STATS: the metrics of every
+        shard, as a JSON list under 'shards'.
+        """
+        responses = [None] * self.num_shards
+        def on_stats(index, response):
+            responses[index] = json.loads(response) if response.startswith('{') else response
+            if None not in responses:
+                callback(json.dumps({'shards': responses}, sort_keys=True))
+        for index, conn in enumerate(self._control):
+            conn.request('STATS', partial(on_stats, index))
+
+    def killed(self, response):
+        if response == 'Killed':
+            self.stats[3] += 1
+
+    def run(self, poll_timeout=1.0, ttl=None):
+        """
+        Runs the event loop of the front end, until the server and all of the
+        client handlers have been closed, then stops the shards.
+        """
+        if self._policy == DETECT:
+            poll_timeout = min(poll_timeout, self._detect_interval)
+        start_time = time.time()
+        next_detect = start_time + self._detect_interval
+        timed_out = False
+        try:
+            while self.connected or self._num_handlers > 0:
+                elapsed_time = time.time() - start_time
+                if ttl is not None and elapsed_time > ttl:
+                    timed_out = True
+                    break
+                self._loop.poll(KVStoreServer.get_poll_timeout(poll_timeout, ttl, elapsed_time))
+                if self._policy == DETECT and time.time() >= next_detect:
+                    next_detect = time.time() + self._detect_interval
+                    self.detect_deadlocks()
+                self.send_output()
+        finally:
+            for handler in list(self._loop.handlers.values()):
+                if handler is not self and not isinstance(handler, ShardConnection):
+                    handler.close()
+            if self.connected:
+                self.close()
+            self.stop_shards()
+        self._logger.debug('No more open connections')
+        if timed_out:
+            raise KVStoreError('Server timed out')
+
+    def stop_shards(self):
+        for handler in list(self._loop.handlers.values()):
+            if isinstance(handler, ShardConnection):
+                handler.close()
+        self._loop.close()
+        for process in self._processes:
+            process.terminate()
+            process.join()
+
+    def shard_lost(self, index):
+        """
+        Called when the connection to a shard is lost. The front end cannot
+        go on without it, so it stops accepting connections and closes every
+        client handler.
+        """
+        self._logger.error('Lost connection to shard %d', index)
+        for handler in list(self._loop.handlers.values()):
+            if isinstance(handler, FrontEndHandler):
+                handler.close()
+        if self.connected:
+            self.close()
+
+    def handle_read(self):
+        while self.connected:
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK or e.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+            self.handle_accept(sock)
+
+    def handle_accept(self, sock):
+        if self._tcp:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._num_handlers += 1
+        FrontEndHandler(self._loop, sock, self, self.new_xid(), self._log_level)
+        if self._remaining_handlers is not None:
+            self._remaining_handlers -= 1
+            if self._remaining_handlers == 0:
+                self.handle_close()
+
+    def handle_close(self):
+        self._logger.debug('Server is not accepting more connections')
+        self.close()
+
+    def handle_error(self):
+        exc = traceback.format_exc()
+        self._logger.error('Uncaught exception, closing server\n%s', exc[:-1])
+        self.close()
@@ -1,14 +1,88 @@
 import logging
 import os
 import stat
+import struct
 
 # Maximum number of bytes received at one time from socket
-CHUNK_SIZE = 1024
+CHUNK_SIZE = 65536
 SOCKET_FILE = './uds_socket'
 
+# Every message, in both directions, is framed by a header holding the length
+# of its body
+HEADER = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 1 << 24
+
 class KVStoreError(Exception):
     pass
 
+def to_bytes(msg):
+    if isinstance(msg, bytes):
+        return msg
+    return msg.encode('utf-8')
+
+def to_str(data):
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8')
+
+def encode_message(msg):
+    """
+    @return: the frame for msg, ready to be sent: the length of msg encoded
+    as UTF-8, as a 4-byte big-endian integer, then msg encoded as UTF-8, as
+    bytes.
+    """
+    body = to_bytes(msg)
+    return HEADER.pack(len(body)) + body
+
+class MessageReader(object):
+    """
+    Reassembles the messages sent over a stream socket from the chunks
+    returned by recv(), which may hold any number of messages, or part of one.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds the data received from the socket.
+
+        @return: the list of messages completed by data, as str.
+        """
+        buf = self._buffer
+        buf.extend(data)
+        messages = []
+        offset = 0
+        while len(buf) - offset >= HEADER.size:
+            length, = HEADER.unpack_from(buf, offset)
+            if length > MAX_MESSAGE_SIZE:
+                raise KVStoreError('Message of %d bytes is too long' % (length))
+            end = offset + HEADER.size + length
+            if len(buf) < end:
+                break
+            messages.append(to_str(bytes(buf[offset + HEADER.size:end])))
+            offset = end
+        if offset:
+            del buf[:offset]
+        return messages
+
+def get_logger(owner, xid, log_level):
+    """
+    @return: a logger for the object owner (a client or server handler) of
+    transaction xid, which prints messages as '<ClassName xid> message'.
+    Loggers are shared by all the objects of a class, since the logging
+    module keeps every logger forever, and setting the level of one costs
+    time proportional to the number of loggers.
+    """
+    logger = logging.getLogger('<%s>' % (owner.__class__.__name__))
+    if logger.level != log_level:
+        logger.setLevel(log_level)
+    return TransactionLogger(logger, {'xid': xid})
+
+class TransactionLogger(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return '%s %s' % (self.extra['xid'], msg), kwargs
+
 # We want this to happen only once per process, so we perform it here, rather
 # than in the server and client classes (which are constructed multiple times
 # in unit tests)
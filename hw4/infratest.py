@@ -0,0 +1,306 @@
+import os
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+from infra.client import KVStoreClient, KVStoreClientPool
+from infra.eventloop import Dispatcher, EventLoop
+from infra.metrics import Histogram, Metrics, TopKeys
+from infra.server import KVStoreServer
+from infra.utils import HEADER, MAX_MESSAGE_SIZE, KVStoreError, MessageReader, encode_message, to_str
+
+class MessageReaderTest(unittest.TestCase):
+    def test_split_frames(self):
+        # The length counts bytes, not characters
+        multibyte = u'PUT b \xe9'.encode('utf-8')
+        data = encode_message('GET a') + encode_message('') + encode_message(multibyte)
+        reader = MessageReader()
+        messages = []
+        # One byte at a time, so that every header and body is split
+        for i in range(len(data)):
+            messages += reader.feed(data[i:i + 1])
+        self.assertEqual(messages, ['GET a', '', to_str(multibyte)])
+        self.assertEqual(reader.feed(b''), [])
+
+    def test_several_frames(self):
+        reader = MessageReader()
+        data = b''.join(encode_message('m%d' % (i)) for i in range(3))
+        frame = encode_message('last')
+        self.assertEqual(reader.feed(data + frame[:3]), ['m0', 'm1', 'm2'])
+        self.assertEqual(reader.feed(frame[3:] + encode_message('next')), ['last', 'next'])
+
+    def test_too_long(self):
+        self.assertRaises(KVStoreError, MessageReader().feed, HEADER.pack(MAX_MESSAGE_SIZE + 1))
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram([1, 2, 4, 8])
+        self.assertEqual(histogram.summary(), {'count': 0})
+        for value in [0.5, 1.5, 1.5, 3, 3, 3, 3, 6, 7, 20]:
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(0.1), 1)
+        self.assertEqual(histogram.percentile(0.3), 2)
+        self.assertEqual(histogram.percentile(0.5), 4)
+        self.assertEqual(histogram.percentile(0.9), 8)
+        self.assertEqual(histogram.percentile(0.99), 20)          # Past the last bound
+        self.assertEqual(histogram.summary(10), {'count': 10, 'mean': 48.5, 'p50': 40, 'p99': 200, 'max': 200})
+        histogram = Histogram([1, 2, 4, 8])
+        histogram.add(3)
+        self.assertEqual(histogram.percentile(0.5), 3)            # The largest value, not the bound
+
+    def test_top_keys(self):
+        top = TopKeys(capacity=2)
+        for key, amount in [('a', 5), ('b', 3), ('c', 1), ('d', 4)]:
+            top.add(key, amount)
+        self.assertEqual(top.top(3), [('a', 5), ('d', 4), ('b', 3)])
+        top.add('e', 2)                                           # 5 keys: only the 2 largest are kept
+        self.assertEqual(top.top(10), [('a', 5), ('d', 4)])
+        top.add('c')                                              # c starts from zero again
+        top.add('a')
+        self.assertEqual(top.top(10), [('a', 6), ('d', 4), ('c', 1)])
+
+    def test_sampling(self):
+        metrics = Metrics(sample_every=4)
+        self.assertEqual([metrics.skip() for _ in range(8)], [True, True, True, False] * 2)
+        metrics.record_keys('MPUT', ['MPUT', 'a', '1', 'b', '2'])
+        metrics.record_keys('MGET', ['MGET', 'a', 'c'])
+        metrics.record_keys('SCAN', ['SCAN', 'a', 'z'])
+        self.assertEqual(metrics.hot_keys.top(10), [('a', 2), ('b', 1), ('c', 1)])
+
+class Recorder(Dispatcher):
+    """
+    Records the calls made by the event loop, and stops waiting to write
+    after the first handle_write().
+    """
+
+    def __init__(self, loop, sock):
+        Dispatcher.__init__(self, loop, sock)
+        self.calls = []
+
+    def handle_read(self):
+        data = self.recv(1024)
+        self.calls.append(('read', data))
+        if data == b'error':
+            raise ValueError(data)
+
+    def handle_write(self):
+        self.calls.append(('write', self.send(b'pong')))
+        self.set_writable(False)
+
+    def handle_close(self):
+        self.calls.append(('close',))
+        self.close()
+
+    def handle_error(self):
+        self.calls.append(('error',))
+
+class EventLoopTest(object):
+    """
+    Tests of EventLoop and Dispatcher, run with each back end by the
+    subclasses below.
+    """
+
+    use_epoll = None
+
+    def setUp(self):
+        self.loop = EventLoop(self.use_epoll)
+        self.addCleanup(self.loop.close)
+        self.sock, self.peer = socket.socketpair()
+        self.addCleanup(self.peer.close)
+        self.dispatcher = Recorder(self.loop, self.sock)
+        self.addCleanup(self.sock.close)
+
+    def test_register(self):
+        self.assertEqual(len(self.loop), 1)
+        self.assertTrue(self.loop.handlers[self.sock.fileno()] is self.dispatcher)
+        other, other_peer = socket.socketpair()
+        self.addCleanup(other_peer.close)
+        dispatcher = Recorder(self.loop, other)
+        self.assertEqual(len(self.loop), 2)
+        dispatcher.close()
+        self.assertEqual(len(self.loop), 1)
+        self.assertFalse(dispatcher.connected)
+        self.loop.unregister(dispatcher.fileno())                 # Already unregistered
+        self.assertEqual(len(self.loop), 1)
+
+    def test_read(self):
+        self.loop.poll(0)
+        self.assertEqual(self.dispatcher.calls, [])               # Nothing to read
+        self.peer.sendall(b'ping')
+        self.loop.poll(1)
+        self.assertEqual(self.dispatcher.calls, [('read', b'ping')])
+        self.peer.sendall(b'error')
+        self.loop.poll(1)
+        self.assertEqual(self.dispatcher.calls[1:], [('read', b'error'), ('error',)])
+
+    def test_write(self):
+        self.dispatcher.set_writable(True)
+        self.loop.poll(1)
+        self.assertEqual(self.dispatcher.calls, [('write', 4)])
+        self.assertEqual(self.peer.recv(1024), b'pong')
+        self.loop.poll(0)
+        self.assertEqual(self.dispatcher.calls, [('write', 4)])   # No longer waiting to write
+        self.peer.sendall(b'ping')
+        self.dispatcher.set_writable(True)
+        self.loop.poll(1)
+        self.assertEqual(self.dispatcher.calls[1:], [('read', b'ping'), ('write', 4)])
+
+    def test_close(self):
+        self.dispatcher.set_writable(True)
+        self.peer.close()
+        self.loop.poll(1)
+        # recv() calls handle_close() before returning, and the dispatcher
+        # is closed, so handle_write() is not called
+        self.assertEqual(self.dispatcher.calls, [('close',), ('read', b'')])
+        self.assertEqual(len(self.loop), 0)
+
+@unittest.skipIf(not hasattr(select, 'epoll'), 'epoll is not available')
+class EpollLoopTest(EventLoopTest, unittest.TestCase):
+    use_epoll = True
+
+class PollLoopTest(EventLoopTest, unittest.TestCase):
+    use_epoll = False
+
+class ServerTest(unittest.TestCase):
+    """
+    Runs a server in a thread, on a Unix socket in a temporary directory.
+    The server stops once it has accepted max_handlers connections and they
+    have all been closed.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.address = os.path.join(self._dir, 'server')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def start(self, max_handlers, **kwargs):
+        server = KVStoreServer(address=self.address, max_handlers=max_handlers, **kwargs)
+        thread = threading.Thread(target=server.run)
+        thread.daemon = True
+        thread.start()
+        # Cleanups run last first, so the clients are closed before this
+        self.addCleanup(self.stop, thread)
+        return server
+
+    def stop(self, thread):
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def connect(self):
+        client = KVStoreClient(address=self.address)
+        self.addCleanup(client.close)
+        return client
+
+class PipelineTest(ServerTest):
+    def test_mget_mput(self):
+        self.start(2)
+        client = self.connect()
+        self.assertEqual(client.pipeline(['MPUT a 1 b 2', 'MGET a b c', 'PUT c 3', 'COMMIT']),
+                         ['Success', '1\n2\nNo such key', 'Success', 'Transaction Completed'])
+        client = self.connect()
+        self.assertEqual(client.get_many(['c', 'b', 'a']), ['3', '2', '1'])
+        self.assertEqual(client.put_many([('a', '4'), ('d', '5')]), 'Success')
+        self.assertEqual(client.get_many(['a', 'd']), ['4', '5'])
+        self.assertEqual(client.commit(), 'Transaction Completed')
+
+class PersistentConnectionTest(ServerTest):
+    def test_transactions_on_one_connection(self):
+        self.start(3)
+        client = self.connect()
+        other = self.connect()
+        # A request that waits for a lock fails instead of hanging the test
+        other._sock.settimeout(5)
+        xids = [client.begin()]
+        self.assertEqual(client.put('k', '1'), 'Success')
+        self.assertEqual(client.commit(), 'Transaction Completed')
+        xids.append(client.begin())
+        self.assertEqual(client.put('k', '2'), 'Success')
+        self.assertEqual(client.commit(), 'Transaction Completed')
+        self.assertEqual(other.get('k'), '2')                     # The X lock on k was released
+        self.assertEqual(other.commit(), 'Transaction Completed')
+        xids.append(client.begin())
+        self.assertEqual(client.put('k', '3'), 'Success')
+        self.assertEqual(client.abort(), 'User Abort')
+        other = self.connect()
+        other._sock.settimeout(5)
+        self.assertEqual(other.put('k', '4'), 'Success')          # And released again on abort
+        self.assertEqual(other.commit(), 'Transaction Completed')
+        self.assertEqual(len(set(xids)), 3)
+        self.assertNotIn(client.begin(), xids)
+        self.assertEqual(client.get('k'), '4')
+        self.assertEqual(client.commit(), 'Transaction Completed')
+
+    def test_pool(self):
+        self.start(1)
+        pool = KVStoreClientPool(address=self.address)
+        self.addCleanup(pool.close)
+        client = pool.begin()
+        first = client._xid
+        self.assertEqual(client.put('k', '1'), 'Success')
+        self.assertEqual(client.commit(), 'Transaction Completed')
+        pool.release(client)
+        again = pool.begin()                                      # The same connection, a new transaction
+        self.assertTrue(again is client)
+        self.assertNotEqual(again._xid, first)
+        self.assertEqual(again.put('k', '2'), 'Success')
+        pool.release(again)                                       # Aborted, releasing its lock
+        client = pool.begin()
+        self.assertEqual(client.get('k'), '1')
+        self.assertEqual(client.commit(), 'Transaction Completed')
+        pool.release(client)
+
+@unittest.skipIf(sys.version_info[0] < 3, 'infra/aioclient.py needs Python 3')
+class AsyncClientTest(ServerTest):
+    def test_deadlock_retry(self):
+        import asyncio
+        from aioclient_scenarios import deadlock_retry
+        self.start(3)
+        attempts, result, other_responses, values = asyncio.run(deadlock_retry(self.address))
+        self.assertEqual(len(attempts), 2)
+        self.assertTrue(attempts[0] < attempts[1])               # Retried in a new transaction
+        self.assertEqual(result, 'Transaction Completed')
+        self.assertEqual(other_responses, ['Success', 'Transaction Completed'])
+        self.assertEqual(values, ['client', 'client'])
+
+    def test_failing_body(self):
+        import asyncio
+        from aioclient_scenarios import failing_body
+        self.start(1)
+        self.assertEqual(asyncio.run(failing_body(self.address)), (1, 'No such key'))
+
+    def test_failing_abort(self):
+        import asyncio
+        from aioclient_scenarios import failing_abort
+        self.start(1)
+        error = asyncio.run(failing_abort(self.address))
+        self.assertTrue(isinstance(error, ValueError))            # Not the error of the abort
+
+class StatsTest(ServerTest):
+    def test_stats(self):
+        self.start(2)
+        client = self.connect()
+        # One request in 16 is sampled: the 16th and 32nd, both GETs
+        responses = client.pipeline(['PUT a 1'] + ['GET a'] * 32 + ['COMMIT'])
+        self.assertEqual(responses, ['Success'] + ['1'] * 32 + ['Transaction Completed'])
+        client = self.connect()
+        stats = client.stats()
+        self.assertEqual(sorted(stats), ['aborts', 'commands', 'commits', 'contended_keys', 'hot_keys', 'lock_queue',
+                                         'lock_waits', 'request_queue', 'sample_every', 'time', 'uptime'])
+        self.assertEqual(stats['commits'], 1)
+        self.assertEqual(stats['aborts'], {})
+        self.assertEqual(stats['sample_every'], 16)
+        self.assertEqual(stats['hot_keys'], [['a', 2]])
+        self.assertEqual(stats['commands']['GET']['count'], 2)
+        self.assertEqual(sorted(stats['commands']['GET']), ['count', 'max', 'mean', 'p50', 'p99'])
+        self.assertEqual(stats['lock_waits'], {'count': 0})
+        self.assertEqual(client.request('STATS now'), 'Bad format for STATS')
+        self.assertEqual(client.commit(), 'Transaction Completed')
+
+if __name__ == '__main__':
+    unittest.main()
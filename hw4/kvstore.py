@@ -1,3 +1,8 @@
+from collections import OrderedDict
+
+from lsm import LSMTree
+from wal import WriteAheadLog, read_checkpoint, write_checkpoint
+
 class InMemoryKVStore:
     def __init__(self):
         self._kv_store = {}
@@ -8,13 +13,445 @@ class InMemoryKVStore:
     def put(self, key, value):
         self._kv_store[key] = value
 
+    def commit(self, xid, writes):
+        """
+        Called when transaction xid commits, with a dict mapping each key it
+        wrote to the value it committed (None if the key does not exist).
+        """
+        pass
+
+    def flush(self):
+        """
+        Called by the server after each poll, before it responds to any
+        request handled during the poll. A durable store makes the commits
+        since the last flush durable here.
+        """
+        pass
+
+    def scan(self, low, high):
+        """
+        @return: the (key, value) pairs with low <= key <= high, sorted by key.
+        """
+        return sorted((key, value) for key, value in self._kv_store.items() if low <= key <= high and value is not None)
+
+    def load(self, data):
+        """
+        Bulk-loads data, a dict of committed values by key, such as a
+        snapshot (see snapshot.py), into the store before it is used. The
+        store may keep data itself.
+        """
+        if self._kv_store:
+            self._kv_store.update(data)
+        else:
+            self._kv_store = data
+
+    def data(self):
+        """
+        @return: the dict of the current values by key, including uncommitted
+        writes, which must not be changed.
+        """
+        return self._kv_store
+
 class DBMStore:
-    def __init__(self):
-        import dbm
-        self._kv_store = dbm.open('cache', 'c')
+    """
+    A store on disk, in a dbm file at path, with the hot keys in memory.
+    Writes stay in memory until they are committed (no-steal), and commit()
+    only adds them to a batch, which flush() writes to the file at once
+    after each poll of the server, or commit() once it holds batch_size
+    keys. Undoing an aborted write, like reading a key written by the
+    transaction, never touches the disk.
+
+    _cache: an LRU cache of up to cache_size committed (key, value) pairs
+    read from the file, least recently used first, with None for keys that
+    do not exist.
+
+    _dirty: maps each key with an uncommitted write to its current value, and
+    _before maps it to its committed value.
+
+    _batch: maps each key committed since the last flush to its value (None
+    for a deletion).
+
+    hits, misses: the number of get() calls answered from memory and from the
+    file.
+    """
+
+    def __init__(self, path='cache', cache_size=10000, batch_size=1000):
+        try:
+            import dbm
+        except ImportError:
+            import anydbm as dbm
+        self._kv_store = dbm.open(path, 'c')
+        self._cache_size = cache_size
+        self._batch_size = batch_size
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._before = {}
+        self._batch = {}
+        self.hits = 0
+        self.misses = 0
 
     def get(self, key):
-        return self._kv_store.get(key, None)
+        if key in self._dirty:
+            self.hits += 1
+            return self._dirty[key]
+        if key in self._batch:
+            self.hits += 1
+            return self._batch[key]
+        cache = self._cache
+        if key in cache:
+            self.hits += 1
+            value = cache.pop(key)
+        else:
+            self.misses += 1
+            value = self.read(key)
+        cache[key] = value
+        if len(cache) > self._cache_size:
+            cache.popitem(last=False)
+        return value
+
+    def read(self, key):
+        """
+        @return: the committed value of key in the file, or None.
+        """
+        value = self._kv_store.get(key, None)
+        if isinstance(value, bytes) and not isinstance(value, str):
+            value = value.decode('utf-8')
+        return value
 
     def put(self, key, value):
+        if key not in self._dirty:
+            # Only the writer of key can put it, so the current value is
+            # committed
+            self._before[key] = self.get(key)
+            self._cache.pop(key, None)
+        elif self._before[key] == value:
+            # Back to the committed value, after an abort
+            del self._dirty[key]
+            self.cache_committed(key, self._before.pop(key))
+            return
+        self._dirty[key] = value
+
+    def cache_committed(self, key, value):
+        if key not in self._batch:
+            self._cache[key] = value
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def commit(self, xid, writes):
+        for key, value in writes.items():
+            self._dirty.pop(key, None)
+            self._before.pop(key, None)
+            self._batch[key] = value
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the batch of committed writes to the file, and moves them to
+        the cache.
+        """
+        if not self._batch:
+            return
+        kv_store = self._kv_store
+        batch = self._batch
+        self._batch = {}
+        for key in sorted(batch):
+            value = batch[key]
+            if value is not None:
+                kv_store[key] = value
+            elif key in kv_store:
+                del kv_store[key]
+            self.cache_committed(key, value)
+        if hasattr(kv_store, 'sync'):
+            kv_store.sync()
+
+    def close(self):
+        self.flush()
+        self._kv_store.close()
+
+    def scan(self, low, high):
+        """
+        @return: the (key, value) pairs with low <= key <= high, sorted by key.
+        Keys read from the file are not added to the cache.
+        """
+        keys = set(self._dirty) | set(self._batch)
+        for key in self._kv_store.keys():
+            if isinstance(key, bytes) and not isinstance(key, str):
+                key = key.decode('utf-8')
+            keys.add(key)
+        pairs = []
+        for key in keys:
+            if low <= key <= high:
+                if key in self._dirty:
+                    value = self._dirty[key]
+                elif key in self._batch:
+                    value = self._batch[key]
+                elif key in self._cache:
+                    value = self._cache[key]
+                else:
+                    value = self.read(key)
+                if value is not None:
+                    pairs.append((key, value))
+        return sorted(pairs)
+
+class LSMKVStore:
+    """
+    A store on disk in an lsm.LSMTree, in the directory at path, for more
+    data than fits in memory. As in DBMStore, uncommitted writes stay in
+    memory, with their before-images. commit() writes them to the tree and its
+    log, and flush(), which the server calls after each poll, makes the
+    commits of the poll durable with one fsync (group commit), then lets the
+    tree write frozen memtables and compact for up to work_per_flush records.
+    The tree recovers the committed writes when the store is opened again.
+    """
+
+    def __init__(self, path='lsm', memtable_size=100000, work_per_flush=1000, fsync=True):
+        self._tree = LSMTree(path, memtable_size=memtable_size, fsync=fsync)
+        self._work_per_flush = work_per_flush
+        self._dirty = {}
+        self._before = {}
+
+    def get(self, key):
+        if key in self._dirty:
+            return self._dirty[key]
+        return self._tree.get(key)
+
+    def put(self, key, value):
+        if key not in self._dirty:
+            self._before[key] = self._tree.get(key)
+        elif self._before[key] == value:
+            # Back to the committed value, after an abort
+            del self._dirty[key]
+            del self._before[key]
+            return
+        self._dirty[key] = value
+
+    def commit(self, xid, writes):
+        for key in writes:
+            self._dirty.pop(key, None)
+            self._before.pop(key, None)
+        if writes:
+            self._tree.write(xid, sorted(writes.items()))
+
+    def flush(self):
+        self._tree.sync()
+        self._tree.work(self._work_per_flush)
+
+    def scan(self, low, high):
+        """
+        @return: the (key, value) pairs with low <= key <= high, sorted by key.
+        """
+        pairs = dict(self._tree.iterate(low, high))
+        for key, value in self._dirty.items():
+            if low <= key <= high:
+                pairs[key] = value
+        return sorted(pair for pair in pairs.items() if pair[1] is not None)
+
+    def close(self):
+        self._tree.close()
+
+class DurableKVStore(InMemoryKVStore):
+    """
+    An in-memory store made durable by a write-ahead log. Transactions write
+    the in-memory store in place under 2PL and log nothing until they commit
+    (no-steal), so the log is redo-only: commit() appends one record with all
+    of the transaction's writes, and an aborted transaction leaves no trace
+    on disk.
+
+    With group_commit, the server's call to flush() after each poll writes
+    the commit records of that poll with a single fsync, before any of the
+    committers is told that it committed. Otherwise commit() flushes its own
+    record.
+
+    Every checkpoint_interval commits, flush() writes the committed state of
+    the store to a checkpoint and empties the log. Uncommitted writes are
+    replaced by their before-images, so the checkpoint is transaction-
+    consistent.
+
+    The constructor recovers the store: it loads the checkpoint, then redoes
+    the commit records that follow it.
+
+    _before: maps each key with an uncommitted write to its committed value.
+
+    _seq: the number of the last commit.
+    """
+
+    def __init__(self, path='kvstore', group_commit=True, fsync=True, checkpoint_interval=10000):
+        InMemoryKVStore.__init__(self)
+        self._checkpoint_path = path + '.checkpoint'
+        self._group_commit = group_commit
+        self._fsync = fsync
+        self._checkpoint_interval = checkpoint_interval
+        self._before = {}
+        self._seq, self._kv_store = read_checkpoint(self._checkpoint_path)
+        self._checkpoint_seq = self._seq
+        self._log = WriteAheadLog(path + '.log', fsync)
+        for seq, xid, writes in self._log.replay():
+            if seq > self._seq:
+                self._kv_store.update(writes)
+                self._seq = seq
+
+    def put(self, key, value):
+        if key not in self._before:
+            # Only the writer of key can put it, so the current value is
+            # committed
+            self._before[key] = self._kv_store.get(key)
+        elif self._before[key] == value:
+            # Back to the committed value, after an abort
+            del self._before[key]
+        self._kv_store[key] = value
+
+    def commit(self, xid, writes):
+        if not writes:
+            return
+        self._seq += 1
+        self._log.append(self._seq, xid, sorted(writes.items()))
+        for key in writes:
+            self._before.pop(key, None)
+        if not self._group_commit:
+            self.flush()
+
+    def flush(self):
+        self._log.flush()
+        if self._seq - self._checkpoint_seq >= self._checkpoint_interval:
+            self.checkpoint()
+
+    def load(self, data):
+        InMemoryKVStore.load(self, data)
+        self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Writes the committed state to the checkpoint and empties the log.
+        """
+        self._log.flush()
+        before = self._before
+        items = ((key, before[key] if key in before else value) for key, value in self._kv_store.items())
+        write_checkpoint(self._checkpoint_path, self._seq, ((key, value) for key, value in items if value is not None), fsync=self._fsync)
+        self._log.truncate()
+        self._checkpoint_seq = self._seq
+
+    def close(self):
+        self._log.close()
+
+class MVCCKVStore(InMemoryKVStore):
+    """
+    An in-memory store that also keeps the committed versions of each key, so
+    that read-only transactions can read a consistent snapshot without taking
+    locks. Writers still use 2PL: get() and put() see the latest value,
+    including uncommitted writes made under an exclusive lock, and commit()
+    publishes a transaction's writes as a new version.
+
+    _commit_ts: the timestamp of the last commit. Each commit gets the next
+    timestamp, and a snapshot taken at ts sees every commit up to ts.
+
+    _versions: maps each key written since it was last collected to its chain
+    of committed versions, a list of (ts, value) pairs, oldest first. The
+    first version has ts 0 and is the value the key had before any write was
+    published. A key without a chain has a single version, its current value.
+
+    _snapshots: maps the ts of each active snapshot to the number of
+    transactions reading it.
+
+    _long_chains: the keys whose chains have more than one version, which are
+    the only candidates for garbage collection.
+    """
+
+    def __init__(self):
+        InMemoryKVStore.__init__(self)
+        self._commit_ts = 0
+        self._versions = {}
+        self._snapshots = {}
+        self._long_chains = set()
+
+    def put(self, key, value):
+        chain = self._versions.get(key)
+        if chain is None:
+            # Keep the committed value for the snapshots. Only the writer of
+            # key can put it, so the current value is committed.
+            current = self._kv_store.get(key)
+            if value != current:
+                self._versions[key] = [(0, current)]
+        elif len(chain) == 1 and chain[0][1] == value:
+            # Back to the committed value, after an abort
+            del self._versions[key]
         self._kv_store[key] = value
+
+    def commit(self, xid, writes):
+        if not writes:
+            return
+        self._commit_ts += 1
+        for key, value in writes.items():
+            chain = self._versions.get(key)
+            if chain is None:
+                # Collected because the write left the committed value as it
+                # was
+                continue
+            chain.append((self._commit_ts, value))
+            self._long_chains.add(key)
+            self.collect(key)
+
+    def snapshot(self):
+        """
+        Starts a snapshot of the committed state of the store.
+
+        @return: the snapshot timestamp, to pass to get_version() and
+        scan_version(), and finally to release_snapshot().
+        """
+        ts = self._commit_ts
+        self._snapshots[ts] = self._snapshots.get(ts, 0) + 1
+        return ts
+
+    def release_snapshot(self, ts):
+        """
+        Ends a snapshot. The versions only it could see are collected.
+        """
+        count = self._snapshots.pop(ts) - 1
+        if count:
+            self._snapshots[ts] = count
+        elif not self._snapshots or ts < min(self._snapshots):
+            for key in list(self._long_chains):
+                self.collect(key)
+
+    def get_version(self, key, ts):
+        """
+        @return: the value of key in the snapshot taken at ts.
+        """
+        chain = self._versions.get(key)
+        if chain is None:
+            return self._kv_store.get(key, None)
+        for version_ts, value in reversed(chain):
+            if version_ts <= ts:
+                return value
+
+    def scan_version(self, low, high, ts):
+        """
+        @return: the (key, value) pairs with low <= key <= high in the
+        snapshot taken at ts, sorted by key.
+        """
+        pairs = []
+        for key in self._kv_store:
+            if low <= key <= high:
+                value = self.get_version(key, ts)
+                if value is not None:
+                    pairs.append((key, value))
+        return sorted(pairs)
+
+    def collect(self, key):
+        """
+        Drops the versions of key that no active snapshot can read: all but
+        the newest version visible to the oldest snapshot.
+        """
+        chain = self._versions[key]
+        oldest = min(self._snapshots) if self._snapshots else self._commit_ts
+        keep = len(chain) - 1
+        while keep > 0 and chain[keep][0] > oldest:
+            keep -= 1
+        if keep > 0:
+            del chain[:keep]
+        if len(chain) == 1:
+            self._long_chains.discard(key)
+            if chain[0][1] == self._kv_store.get(key):
+                # No uncommitted write either, so the current value is the
+                # only version
+                del self._versions[key]
@@ -0,0 +1,524 @@
+import time
+from collections import OrderedDict, deque
+
+"""
+Lock modes, for multiple-granularity locking. Every key in the store lies
+under a single table-level resource, TABLE. Before locking a key in S or X
+mode, a transaction takes an intention lock (IS or IX) on TABLE. A transaction
+may instead lock the whole table in S, SIX (S plus the right to take X locks
+on keys) or X mode, which covers every key.
+
+Modes are small ints, so that they index the tables below and cost nothing to
+store; MODE_NAMES gives their names, for display.
+"""
+INTENTION_SHARED = 0
+INTENTION_EXCLUSIVE = 1
+SHARED = 2
+SHARED_INTENTION_EXCLUSIVE = 3
+EXCLUSIVE = 4
+
+MODE_NAMES = ('IS', 'IX', 'S', 'SIX', 'X')
+
+"""
+The resource name of the table. Keys are never empty, so it cannot collide
+with a key.
+"""
+TABLE = ''
+
+"""
+COMPATIBLE[a] is the set of modes that can be held by other transactions
+while one transaction holds mode a.
+"""
+COMPATIBLE = (
+    frozenset([INTENTION_SHARED, INTENTION_EXCLUSIVE, SHARED, SHARED_INTENTION_EXCLUSIVE]),  # IS
+    frozenset([INTENTION_SHARED, INTENTION_EXCLUSIVE]),                                      # IX
+    frozenset([INTENTION_SHARED, SHARED]),                                                   # S
+    frozenset([INTENTION_SHARED]),                                                           # SIX
+    frozenset(),                                                                             # X
+)
+
+"""
+COVERS[a] is the set of modes whose rights are included in mode a.
+"""
+COVERS = (
+    frozenset([INTENTION_SHARED]),
+    frozenset([INTENTION_SHARED, INTENTION_EXCLUSIVE]),
+    frozenset([INTENTION_SHARED, SHARED]),
+    frozenset([INTENTION_SHARED, INTENTION_EXCLUSIVE, SHARED, SHARED_INTENTION_EXCLUSIVE]),
+    frozenset([INTENTION_SHARED, INTENTION_EXCLUSIVE, SHARED, SHARED_INTENTION_EXCLUSIVE, EXCLUSIVE]),
+)
+
+def covers(held, mode):
+    """
+    Returns True if a lock held in mode held (or None) includes mode.
+    """
+    return held is not None and mode in COVERS[held]
+
+def supremum(held, mode):
+    """
+    Returns the weakest mode that covers both held (or None) and mode. This is
+    the mode a lock is converted to when a transaction asks for mode while
+    holding held.
+    """
+    if held is None or held in COVERS[mode]:
+        return mode
+    if mode in COVERS[held]:
+        return held
+    # The only incomparable pair is IX and S
+    return SHARED_INTENTION_EXCLUSIVE
+
+"""
+Deadlock handling policies. DETECT keeps a waits-for graph and breaks cycles
+after the fact. The others prevent deadlocks without building a graph, using
+xids as timestamps: xids are handed out in increasing order, so a smaller xid
+belongs to an older transaction.
+
+WAIT_DIE: an older requester waits for younger holders; a younger requester is
+aborted (dies).
+WOUND_WAIT: an older requester aborts (wounds) younger holders; a younger
+requester waits.
+TIMEOUT: a transaction that has waited longer than the lock timeout is
+aborted.
+"""
+DETECT = 0
+WAIT_DIE = 1
+WOUND_WAIT = 2
+TIMEOUT = 3
+
+class LockEntry(object):
+    """
+    The lock table entry for a single resource (a key, or TABLE). The global
+    lock table maps each resource to one of these.
+
+    holders: maps the xid of each transaction in the granted group to the mode
+    of its lock. A transaction holds at most one lock per resource; asking for
+    another mode converts it to the supremum of the two.
+
+    counts: the number of holders in each mode, indexed by mode, so that the
+    compatibility of a request is checked in constant time, no matter how many
+    transactions share the lock.
+
+    queue: a FIFO list of (txn, mode) requests waiting to be granted, where
+    txn is the waiting TransactionHandler and mode is the mode it will hold
+    once granted. Conversions of locks already held are pushed onto the front
+    of the queue. Queues are short, and an empty list takes a fraction of
+    the memory of an empty deque.
+
+    An entry with no holders and an empty queue is removed from the lock
+    table as soon as it gets that way (see TransactionHandler.grant_to_queue),
+    except the entry of TABLE, so the table only holds the resources in use.
+    """
+
+    __slots__ = ('holders', 'counts', 'queue')
+
+    def __init__(self):
+        self.holders = {}
+        self.counts = [0, 0, 0, 0, 0]
+        self.queue = []
+
+    def __repr__(self):
+        holders = [(xid, MODE_NAMES[mode]) for xid, mode in sorted(self.holders.items())]
+        return repr([holders, [(txn._xid, MODE_NAMES[mode]) for txn, mode in self.queue]])
+
+    def is_free(self):
+        return not self.holders
+
+    def is_unused(self):
+        return not self.holders and not self.queue
+
+    def mode_of(self, xid):
+        """
+        @return: the mode of the lock held by xid, or None if xid does not
+        hold the lock.
+        """
+        return self.holders.get(xid)
+
+    def holds(self, xid, mode):
+        return self.holders.get(xid) == mode
+
+    def is_sole_holder(self, xid):
+        return len(self.holders) == 1 and xid in self.holders
+
+    def compatible(self, xid, mode):
+        """
+        Returns True if xid can hold the lock in mode alongside the other
+        holders. Any lock already held by xid is ignored, since it is replaced.
+        """
+        own = self.holders.get(xid)
+        allowed = COMPATIBLE[mode]
+        for held, count in enumerate(self.counts):
+            if held == own:
+                count -= 1
+            if count > 0 and held not in allowed:
+                return False
+        return True
+
+    def grant(self, xid, mode):
+        """
+        Adds xid to the granted group in mode, replacing any lock it held.
+        """
+        own = self.holders.get(xid)
+        if own is not None:
+            self.counts[own] -= 1
+        self.holders[xid] = mode
+        self.counts[mode] += 1
+
+    def release(self, xid):
+        own = self.holders.pop(xid, None)
+        if own is not None:
+            self.counts[own] -= 1
+
+    def conflicts(self, xid, mode):
+        """
+        @return: the xids of the holders whose locks conflict with xid
+        acquiring the lock in the given mode.
+        """
+        allowed = COMPATIBLE[mode]
+        return [holder for holder, held in self.holders.items() if holder != xid and held not in allowed]
+
+    def blockers(self, xid, mode, position=None):
+        """
+        @return: the xids of the transactions that a request waiting at the
+        given position of the queue (by default, at the back) waits for: the
+        conflicting holders, and the conflicting requests queued ahead of it.
+        """
+        blockers = self.conflicts(xid, mode)
+        allowed = COMPATIBLE[mode]
+        for txn, queued_mode in self.queue[:position]:
+            if txn._xid != xid and queued_mode not in allowed:
+                blockers.append(txn._xid)
+        return blockers
+
+    def enqueue(self, txn, mode, position=None):
+        if position is None:
+            self.queue.append((txn, mode))
+        else:
+            self.queue.insert(position, (txn, mode))
+
+    def dequeue(self, txn, mode):
+        """
+        Removes a pending request from the queue, if present. A transaction
+        waits for at most one lock at a time, so this only happens when a
+        blocked transaction is aborted.
+        """
+        try:
+            self.queue.remove((txn, mode))
+        except ValueError:
+            pass
+
+
+class GrantScheduler(object):
+    """
+    Decides the order in which the requests for a lock are granted: whether a
+    request is granted right away, where it waits in the queue of the
+    LockEntry otherwise, and which waiting requests are granted when the
+    holders change. With the default arguments, requests are granted in FIFO
+    order, conversions first.
+
+    batch: a request is granted as soon as it is compatible with the holders,
+    wherever it is in the queue, as long as it may overtake the conflicting
+    requests ahead of it (see max_bypass). Otherwise only the longest
+    compatible prefix of the queue is granted, and a new request is only
+    granted right away if nobody waits.
+
+    priorities: a waiting request is placed ahead of the requests of
+    transactions with a lower priority (TransactionHandler.priority, set by
+    the PRIORITY command), instead of at the back of the queue.
+
+    max_bypass: aging, to keep the requests that batch or priorities overtake
+    from starving. A waiting request can be overtaken by at most this many
+    conflicting requests; after that it keeps its place, and the requests
+    that conflict with it wait behind it. None for no limit.
+
+    upgrade_first: conversions of locks already held wait at the front of the
+    queue, and are granted as soon as they are compatible with the other
+    holders. Otherwise they are placed like new requests; a conversion then
+    deadlocks with any request ahead of it that conflicts with the lock it
+    already holds, and the deadlock policy aborts one of them.
+
+    A request is only ever placed ahead of the requests behind it when it
+    is queued, so that the waits-for graph stays accurate: the requests it is
+    placed ahead of and conflicts with wait for it.
+    """
+
+    def __init__(self, batch=False, priorities=False, max_bypass=None, upgrade_first=True):
+        self.batch = batch
+        self.priorities = priorities
+        self.max_bypass = max_bypass
+        self.upgrade_first = upgrade_first
+
+    def may_overtake(self, requests, mode):
+        """
+        Returns True if a request for mode may be granted or placed ahead of
+        the given (txn, mode) requests.
+        """
+        if self.max_bypass is None:
+            return True
+        allowed = COMPATIBLE[mode]
+        for txn, queued_mode in requests:
+            if queued_mode not in allowed and txn._bypassed >= self.max_bypass:
+                return False
+        return True
+
+    def overtake(self, requests, mode):
+        """
+        Counts a request for mode being granted or placed ahead of the given
+        requests against those it conflicts with.
+        """
+        allowed = COMPATIBLE[mode]
+        for txn, queued_mode in requests:
+            if queued_mode not in allowed:
+                txn._bypassed += 1
+
+    def position(self, entry, txn, mode, conversion):
+        """
+        @return: the index in entry.queue at which a request of txn for mode
+        would wait.
+        """
+        queue = entry.queue
+        if conversion and self.upgrade_first:
+            return 0
+        position = len(queue)
+        if self.priorities:
+            while position > 0:
+                other, other_mode = queue[position - 1]
+                if other.priority >= txn.priority or (self.upgrade_first and other._xid in entry.holders):
+                    break
+                if not self.may_overtake([(other, other_mode)], mode):
+                    break
+                position -= 1
+        return position
+
+    def grant_now(self, entry, txn, mode, conversion):
+        """
+        Returns True if the request of txn for mode is granted without
+        waiting.
+        """
+        if not entry.compatible(txn._xid, mode):
+            return False
+        queue = entry.queue
+        position = self.position(entry, txn, mode, conversion)
+        if position > 0 and not (self.batch and self.may_overtake(queue[:position], mode)):
+            return False
+        self.overtake(queue, mode)
+        return True
+
+    def place(self, entry, txn, mode, conversion):
+        """
+        @return: the index in entry.queue at which the request of txn for
+        mode waits, once grant_now() has returned False.
+        """
+        position = self.position(entry, txn, mode, conversion)
+        txn._bypassed = 0
+        self.overtake(entry.queue[position:], mode)
+        return position
+
+    def next_grant(self, entry, start):
+        """
+        Called when the holders of entry change, and again after each grant.
+        Requests ahead of start have already been found not grantable.
+
+        @return: the index in entry.queue of the next request to grant, or
+        None if there is none.
+        """
+        queue = entry.queue
+        if not self.batch:
+            if start == 0 and queue and entry.compatible(queue[0][0]._xid, queue[0][1]):
+                return 0
+            return None
+        for index in range(start, len(queue)):
+            txn, mode = queue[index]
+            if entry.compatible(txn._xid, mode) and self.may_overtake(queue[:index], mode):
+                self.overtake(queue[:index], mode)
+                return index
+        return None
+
+
+class WaitsForGraph(object):
+    """
+    The waits-for graph, maintained incrementally by the transaction handlers
+    as requests are queued, granted and released.
+
+    edges: maps the xid of each waiting transaction to the set of xids of the
+    transactions it waits for: the conflicting lock holders, and the
+    conflicting requests ahead of it in the queue. A transaction waits for one
+    key at a time, so all of its edges belong to the same key.
+
+    pending: the (waiter, holder) edges added since the last deadlock check.
+    Any new cycle must contain one of them.
+    """
+
+    def __init__(self):
+        self.edges = {}
+        self.pending = deque()
+
+    def add_edges(self, waiter, holders):
+        if not holders:
+            return
+        targets = self.edges.setdefault(waiter, set())
+        for holder in holders:
+            if holder not in targets:
+                targets.add(holder)
+                self.pending.append((waiter, holder))
+
+    def remove_edge(self, waiter, holder):
+        targets = self.edges.get(waiter)
+        if targets is not None:
+            targets.discard(holder)
+
+    def remove_waiter(self, waiter):
+        self.edges.pop(waiter, None)
+
+    def has_edge(self, waiter, holder):
+        return holder in self.edges.get(waiter, ())
+
+    def find_path(self, source, target):
+        """
+        Depth-first search for a path of edges from source to target. Only
+        transactions that are waiting have outgoing edges, so the cost depends
+        on the number of waiters, not on the size of the lock table.
+
+        @return: the list of xids on the path, or None if there is none.
+        """
+        parents = {source: None}
+        stack = [source]
+        while stack:
+            node = stack.pop()
+            if node == target:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+                return path
+            for successor in sorted(self.edges.get(node, ()), reverse=True):
+                if successor not in parents:
+                    parents[successor] = node
+                    stack.append(successor)
+        return None
+
+
+class LockTable(dict):
+    """
+    The global lock table, shared by all transaction handlers and the
+    transaction coordinator. Maps each key to a LockEntry, and keeps the state
+    needed by the deadlock handling policy.
+
+    sole_readers: maps each key whose only lock is an S lock, held by a single
+    transaction, to the xid of that transaction, when fast_reads is set. Such
+    keys have no LockEntry: an uncontended GET only costs an item here. The
+    entry is created when another request for the key arrives, with the
+    reader as its holder. None unless fast_reads is set.
+
+    waits_for: the waits-for graph, or None unless the policy is DETECT.
+
+    victims: the xids of transactions that a prevention policy has decided to
+    abort, in the order they were chosen. A victim stays here until it ends.
+
+    waiting_since: for the TIMEOUT policy, maps the xid of each waiting
+    transaction to the time at which it has waited too long, oldest first.
+
+    escalation_threshold: once a transaction holds this many key locks, its
+    next key lock is replaced by a lock on TABLE, if that can be granted right
+    away. None disables escalation.
+
+    versions: for optimistic transactions, which take no locks, maps each key
+    to the version_seq of the last commit that wrote it, and TABLE to that of
+    the last one that inserted or deleted a key, oldest first. Validation
+    only needs to tell versions committed since a transaction started, so
+    the versions older than every open optimistic transaction are dropped
+    (see version()).
+
+    optimistic_starts: maps the xid of each open optimistic transaction to
+    the version_seq when it started.
+
+    scheduler: the GrantScheduler that orders the requests for each lock.
+    """
+
+    def __init__(self, policy=DETECT, lock_timeout=1.0, clock=time.time, escalation_threshold=None, fast_reads=True, scheduler=None):
+        dict.__init__(self)
+        self.scheduler = GrantScheduler() if scheduler is None else scheduler
+        self.sole_readers = {} if fast_reads else None
+        self.policy = policy
+        self.escalation_threshold = escalation_threshold
+        self.lock_timeout = lock_timeout
+        self.clock = clock
+        self.waits_for = WaitsForGraph() if policy == DETECT else None
+        self.victims = OrderedDict()
+        self.waiting_since = OrderedDict()
+        self.versions = OrderedDict()
+        self.version_seq = 0
+        self.optimistic_starts = {}
+
+    def wait_for(self, waiter, holders):
+        """
+        Called when waiter starts waiting for the given lock holders, and again
+        whenever the lock it waits for is granted to new holders.
+        """
+        if self.policy == DETECT:
+            self.waits_for.add_edges(waiter, holders)
+        elif self.policy == WAIT_DIE:
+            if any(holder < waiter for holder in holders):
+                self.victims[waiter] = True
+        elif self.policy == WOUND_WAIT:
+            for holder in holders:
+                if holder > waiter:
+                    self.victims[holder] = True
+        elif waiter not in self.waiting_since:
+            self.waiting_since[waiter] = self.clock() + self.lock_timeout
+
+    def stop_waiting_for(self, waiter, holder):
+        """
+        Called when holder releases the lock that waiter waits for, or
+        withdraws its own request from the queue.
+        """
+        if self.waits_for is not None:
+            self.waits_for.remove_edge(waiter, holder)
+
+    def stop_waiting(self, waiter):
+        """
+        Called when waiter is granted its lock or withdraws its request.
+        """
+        if self.waits_for is not None:
+            self.waits_for.remove_waiter(waiter)
+        self.waiting_since.pop(waiter, None)
+
+    def end_transaction(self, xid):
+        self.victims.pop(xid, None)
+        if self.optimistic_starts.pop(xid, None) is not None:
+            self.drop_versions()
+
+    def start_optimistic(self, xid):
+        self.optimistic_starts[xid] = self.version_seq
+
+    def version(self, xid, key):
+        """
+        @return: the version of key for the open optimistic transaction xid,
+        or 0 if key was last written before xid started.
+        """
+        version = self.versions.get(key, 0)
+        return version if version > self.optimistic_starts[xid] else 0
+
+    def set_versions(self, keys):
+        """
+        Gives keys, which may include TABLE, a new version, as written by a
+        commit.
+        """
+        self.version_seq += 1
+        versions = self.versions
+        for key in keys:
+            # Move the key to the end, to keep the versions in order
+            versions.pop(key, None)
+            versions[key] = self.version_seq
+
+    def drop_versions(self):
+        """
+        Drops the versions that every open optimistic transaction sees as 0.
+        """
+        starts = self.optimistic_starts
+        horizon = min(starts.values()) if starts else self.version_seq
+        versions = self.versions
+        while versions:
+            key = next(iter(versions))
+            if versions[key] > horizon:
+                break
+            del versions[key]
@@ -0,0 +1,153 @@
+from __future__ import print_function
+
+import struct
+import sys
+import time
+from collections import deque
+
+from locktable import EXCLUSIVE, INTENTION_EXCLUSIVE, INTENTION_SHARED, MODE_NAMES, SHARED, SHARED_INTENTION_EXCLUSIVE
+
+"""
+Tracing of the lock manager. A transaction handler given a tracer calls it as
+tracer(event, xid, key, mode) for every change it makes to the lock table;
+without one, each hook costs a single comparison with None. A tracer can be
+any callable: RingBuffer keeps the latest events in memory, TraceWriter
+appends them to a binary trace file, which replay() turns back into the state
+of the lock table.
+
+A trace file is a sequence of records, each a header (the time, the event,
+the mode, the xid and the length of the key) followed by the key, in UTF-8.
+
+    $ python locktrace.py trace_file [events]
+"""
+
+# Events
+GRANT = 0       # xid now holds key in mode, either right away or from the queue
+WAIT = 1        # xid queued a request for key in mode, at the back of the queue
+CONVERT = 2     # xid queued a conversion of its lock on key to mode, at the front
+CANCEL = 3      # xid, aborted while waiting, withdrew its request for key in mode
+RELEASE = 4     # xid released its lock on key
+COMMIT = 5      # xid commits; its releases follow
+ABORT = 6       # xid aborts; its releases follow
+
+EVENT_NAMES = ['GRANT', 'WAIT', 'CONVERT', 'CANCEL', 'RELEASE', 'COMMIT', 'ABORT']
+
+# Modes are stored as their index in this list; 0 stands for no mode
+MODES = [None, INTENTION_SHARED, INTENTION_EXCLUSIVE, SHARED, SHARED_INTENTION_EXCLUSIVE, EXCLUSIVE]
+MODE_CODES = dict((mode, code) for code, mode in enumerate(MODES))
+
+HEADER = struct.Struct('>dBBqH')
+
+class RingBuffer(object):
+    """
+    A tracer that keeps the latest capacity events in memory, as (time,
+    event, xid, key, mode) tuples, oldest first.
+    """
+
+    def __init__(self, capacity=10000):
+        self.events = deque(maxlen=capacity)
+
+    def __call__(self, event, xid, key, mode=None):
+        self.events.append((time.time(), event, xid, key, mode))
+
+class TraceWriter(object):
+    """
+    A tracer that appends events to the trace file at path. Records are
+    buffered and written every buffer_size events, and by flush() and close().
+    """
+
+    def __init__(self, path, buffer_size=4096):
+        self.path = path
+        self._buffer = []
+        self._buffer_size = buffer_size
+        self._file = open(path, 'ab')
+
+    def __call__(self, event, xid, key, mode=None):
+        key = key.encode('utf-8')
+        self._buffer.append(HEADER.pack(time.time(), event, MODE_CODES[mode], xid, len(key)) + key)
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(b''.join(self._buffer))
+            self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+def read_trace(path):
+    """
+    Generates the events of the trace file at path, as (time, event, xid,
+    key, mode) tuples, stopping at a record cut short.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            timestamp, event, mode, xid, length = HEADER.unpack(header)
+            key = f.read(length)
+            if len(key) < length:
+                return
+            yield timestamp, event, xid, key.decode('utf-8'), MODES[mode]
+
+def replay(events):
+    """
+    Rebuilds the lock table from a sequence of events, as returned by
+    read_trace() or kept by a RingBuffer. The trace must start while the lock
+    table is empty.
+
+    @return: a dict mapping each key with holders or waiters to a pair
+    (holders, queue), where holders maps xids to modes and queue is the list
+    of (xid, mode) requests waiting, as in locktable.LockEntry. The order of
+    the queue is that of the default GrantScheduler; the events do not record
+    where a request was placed by a scheduler with priorities.
+    """
+    table = {}
+    for _, event, xid, key, mode in events:
+        if event == COMMIT or event == ABORT:
+            continue
+        holders, queue = table.setdefault(key, ({}, []))
+        if event == GRANT:
+            if (xid, mode) in queue:
+                queue.remove((xid, mode))
+            holders[xid] = mode
+        elif event == WAIT:
+            queue.append((xid, mode))
+        elif event == CONVERT:
+            queue.insert(0, (xid, mode))
+        elif event == CANCEL:
+            if (xid, mode) in queue:
+                queue.remove((xid, mode))
+        elif event == RELEASE:
+            holders.pop(xid, None)
+        if not holders and not queue:
+            del table[key]
+    return table
+
+def format_table(table):
+    lines = []
+    for key in sorted(table):
+        holders, queue = table[key]
+        holders = ['%d: %s' % (xid, MODE_NAMES[mode]) for xid, mode in sorted(holders.items())]
+        queue = ['%d: %s' % (xid, MODE_NAMES[mode]) for xid, mode in queue]
+        lines.append('%r: holders [%s], queue [%s]' % (key, ', '.join(holders), ', '.join(queue)))
+    return '\n'.join(lines)
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python locktrace.py trace_file [events]')
+        sys.exit(1)
+    events = list(read_trace(sys.argv[1]))
+    if len(sys.argv) > 2:
+        events = events[:int(sys.argv[2])]
+    for timestamp, event, xid, key, mode in events[-20:]:
+        print('%.6f %-8s %6d %-4s %r' % (timestamp, EVENT_NAMES[event], xid, '' if mode is None else MODE_NAMES[mode], key))
+    print('Lock table after %d events:' % (len(events)))
+    print(format_table(replay(events)))
+
+if __name__ == '__main__':
+    main()
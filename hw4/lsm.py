@@ -0,0 +1,613 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import re
+import struct
+
+from infra.utils import to_bytes, to_str
+from wal import WriteAheadLog, fsync_directory, read_records
+
+"""
+A log-structured merge tree: a key-value map for more data than fits in
+memory, with cheap writes and ordered iteration.
+
+Writes go to a commit log and to the memtable, a dict. Once the memtable holds
+memtable_size keys, it is frozen, a new log is started, and the frozen
+memtable is written to an SSTable at level 0. An SSTable is an immutable file
+of sorted (key, value) records, in blocks of about block_size bytes, followed
+by a sparse index (the first key of each block), a bloom filter of its keys,
+and a footer. A deleted key is written as a tombstone, with no value.
+
+Level 0 holds SSTables with overlapping key ranges, newest first. Each deeper
+level holds SSTables with disjoint key ranges, sorted by key, and may hold
+level_ratio times more bytes than the one above it (level_size bytes for level
+1). When level 0 has level0_limit tables, or a deeper level is too large,
+some of its tables are merged with the tables they overlap in the next level
+(leveled compaction). Tombstones are dropped once no deeper level can hold an
+older value of their key.
+
+The tree is used by a single thread, so writing a frozen memtable and
+compacting are done incrementally: work() advances them by a number of
+records, and the server calls it after each poll. Until a job finishes,
+reads use the tables it started from, and its output is not visible. If the
+memtable fills up again before the frozen one has been written, or while
+level 0 has twice level0_limit tables, the writer waits for the jobs to
+finish.
+
+The MANIFEST file lists the tables of each level, and the number of the
+oldest log whose writes are not in a table; it is replaced atomically when a
+job finishes. On opening, the tree replays those logs into the memtable, and
+deletes the files a crash left behind.
+"""
+
+MANIFEST = 'MANIFEST'
+TABLE_FILE = re.compile(r'^(\d+)\.(sst|log)$')
+
+# Key length and value length of a record, TOMBSTONE for a deleted key
+RECORD = struct.Struct('>HI')
+TOMBSTONE = 0xffffffff
+# Length of an index key, and offset of its block
+INDEX_ENTRY = struct.Struct('>HQ')
+# Offsets of the index and the bloom filter, number of blocks and records
+FOOTER = struct.Struct('>QQQQ')
+BLOOM_HEADER = struct.Struct('>QB')
+
+class BloomFilter(object):
+    """
+    A set of keys that may answer yes for keys it does not hold, but never
+    no for a key it holds. With bits_per_key bits per key, false positives
+    are about 0.6 ** bits_per_key.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    @classmethod
+    def for_keys(cls, keys, bits_per_key=10):
+        bloom = cls(max(64, len(keys) * bits_per_key), max(1, int(bits_per_key * 0.69)))
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def positions(self, key):
+        # Double hashing: the positions are h1 + i * h2 for i < num_hashes
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return BLOOM_HEADER.pack(self.num_bits, self.num_hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        num_bits, num_hashes = BLOOM_HEADER.unpack(data[:BLOOM_HEADER.size])
+        return cls(num_bits, num_hashes, bytearray(data[BLOOM_HEADER.size:]))
+
+class TableWriter(object):
+    """
+    Writes an SSTable to path. Records must be added in increasing key order.
+    Keys and values are bytes; a value of None is a tombstone.
+    """
+
+    def __init__(self, path, number, block_size=1024, bits_per_key=10):
+        self.path = path
+        self.number = number
+        self.size = 0
+        self._file = open(path, 'wb')
+        self._block_size = block_size
+        self._bits_per_key = bits_per_key
+        self._block = []
+        self._block_bytes = 0
+        self._index = []
+        self._keys = []
+
+    def add(self, key, value):
+        if not self._block:
+            self._index.append((key, self.size))
+        if value is None:
+            record = RECORD.pack(len(key), TOMBSTONE) + key
+        else:
+            record = RECORD.pack(len(key), len(value)) + key + value
+        self._block.append(record)
+        self._block_bytes += len(record)
+        self.size += len(record)
+        self._keys.append(key)
+        if self._block_bytes >= self._block_size:
+            self.end_block()
+
+    def end_block(self):
+        self._file.write(b''.join(self._block))
+        self._block = []
+        self._block_bytes = 0
+
+    def count(self):
+        return len(self._keys)
+
+    def finish(self, fsync=True):
+        """
+        Writes the index, the bloom filter and the footer, and closes the
+        file.
+
+        @return: the SSTable, open for reading.
+        """
+        if self._block:
+            self.end_block()
+        index_offset = self.size
+        index = []
+        for key, offset in self._index + [(self._keys[-1], 0)]:
+            index.append(INDEX_ENTRY.pack(len(key), offset) + key)
+        index = b''.join(index)
+        bloom = BloomFilter.for_keys(self._keys, self._bits_per_key).to_bytes()
+        self._file.write(index)
+        self._file.write(bloom)
+        self._file.write(FOOTER.pack(index_offset, index_offset + len(index), len(self._index), len(self._keys)))
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        return SSTable(self.path, self.number)
+
+    def close(self):
+        """
+        Closes the file without finishing the table, which is left for the
+        tree to remove when it is next opened.
+        """
+        self._file.close()
+
+    def abandon(self):
+        self._file.close()
+        os.remove(self.path)
+
+class SSTable(object):
+    """
+    An SSTable open for reading. The sparse index and the bloom filter are
+    kept in memory, so a lookup reads at most one block, and none for most
+    keys the table does not hold.
+
+    min_key, max_key: the smallest and largest keys of the table.
+
+    size: the size of the file, in bytes.
+    """
+
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        self._file = open(path, 'rb')
+        self._file.seek(0, os.SEEK_END)
+        self.size = self._file.tell()
+        self._file.seek(self.size - FOOTER.size)
+        index_offset, bloom_offset, blocks, self.count = FOOTER.unpack(self._file.read(FOOTER.size))
+        self._file.seek(index_offset)
+        index = self._file.read(bloom_offset - index_offset)
+        self._first_keys = []
+        self._offsets = []
+        position = 0
+        for _ in range(blocks + 1):
+            length, offset = INDEX_ENTRY.unpack(index[position:position + INDEX_ENTRY.size])
+            position += INDEX_ENTRY.size
+            self._first_keys.append(index[position:position + length])
+            self._offsets.append(offset)
+            position += length
+        self.max_key = self._first_keys.pop()
+        self._offsets[-1] = index_offset
+        self.min_key = self._first_keys[0]
+        self._bloom = BloomFilter.from_bytes(self._file.read(self.size - FOOTER.size - bloom_offset))
+
+    def read_data(self, i):
+        self._file.seek(self._offsets[i])
+        return self._file.read(self._offsets[i + 1] - self._offsets[i])
+
+    def read_block(self, i):
+        """
+        @return: the (key, value) records of block i.
+        """
+        data = self.read_data(i)
+        records = []
+        position = 0
+        while position < len(data):
+            key_length, value_length = RECORD.unpack_from(data, position)
+            position += RECORD.size
+            key = data[position:position + key_length]
+            position += key_length
+            if value_length == TOMBSTONE:
+                records.append((key, None))
+            else:
+                records.append((key, data[position:position + value_length]))
+                position += value_length
+        return records
+
+    def get(self, key):
+        """
+        @return: (True, value) if the table has a record for key, where value
+        is None for a tombstone, or (False, None).
+        """
+        if key < self.min_key or key > self.max_key or not self._bloom.might_contain(key):
+            return False, None
+        data = self.read_data(bisect.bisect_right(self._first_keys, key) - 1)
+        # Records are sorted, so stop at the first key past the one we want
+        position = 0
+        while position < len(data):
+            key_length, value_length = RECORD.unpack_from(data, position)
+            position += RECORD.size
+            record_key = data[position:position + key_length]
+            position += key_length
+            if record_key >= key:
+                if record_key > key:
+                    return False, None
+                if value_length == TOMBSTONE:
+                    return True, None
+                return True, data[position:position + value_length]
+            if value_length != TOMBSTONE:
+                position += value_length
+        return False, None
+
+    def iterate(self, low=None):
+        """
+        Generates the records of the table with keys of at least low, in key
+        order.
+        """
+        start = 0 if low is None else max(0, bisect.bisect_right(self._first_keys, low) - 1)
+        for i in range(start, len(self._first_keys)):
+            for key, value in self.read_block(i):
+                if low is None or key >= low:
+                    yield key, value
+
+    def close(self):
+        self._file.close()
+
+def tag(records, rank):
+    for key, value in records:
+        yield key, rank, value
+
+def merge(sources):
+    """
+    Merges iterators of (key, value) records in key order, each holding a
+    key at most once. For a key in several of them, only the record of the
+    first one, the newest, is generated.
+    """
+    last = None
+    for key, _, value in heapq.merge(*[tag(source, rank) for rank, source in enumerate(sources)]):
+        if key != last:
+            last = key
+            yield key, value
+
+def find_table(tables, key):
+    """
+    @return: the index of the first of the sorted, disjoint tables whose
+    largest key is at least key, or len(tables).
+    """
+    low, high = 0, len(tables)
+    while low < high:
+        middle = (low + high) // 2
+        if tables[middle].max_key < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def iterate_memtable(memtable, keys, low):
+    """
+    Generates the records of memtable with keys of at least low, in key
+    order, as bytes. keys are the keys of memtable, sorted.
+    """
+    for i in range(bisect.bisect_left(keys, low), len(keys)):
+        value = memtable[keys[i]]
+        yield to_bytes(keys[i]), None if value is None else to_bytes(value)
+
+def iterate_level(tables, low):
+    for i in range(find_table(tables, low), len(tables)):
+        for record in tables[i].iterate(low):
+            yield record
+
+class LSMTree(object):
+    """
+    The tree in the directory at path. Keys and values are strings; get()
+    and iterate() return None for keys that do not exist.
+
+    levels: the SSTables of each level. Level 0 is newest first; the others
+    are sorted by key.
+    """
+
+    def __init__(self, path, memtable_size=100000, table_size=2 * 1024 * 1024, level0_limit=4, level_size=10 * 1024 * 1024, level_ratio=10, block_size=1024, fsync=True):
+        self.path = path
+        self.memtable_size = memtable_size
+        self.table_size = table_size
+        self.level0_limit = level0_limit
+        self.level_size = level_size
+        self.level_ratio = level_ratio
+        self.block_size = block_size
+        self.fsync = fsync
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        manifest = {'next': 1, 'log': 0, 'levels': [[]]}
+        if os.path.exists(self.file_path(MANIFEST)):
+            with open(self.file_path(MANIFEST)) as f:
+                manifest = json.load(f)
+        self._next = manifest['next']
+        self._log_number = manifest['log']
+        live = set(number for level in manifest['levels'] for number in level)
+        logs = []
+        for name in os.listdir(path):
+            match = TABLE_FILE.match(name)
+            if match is None:
+                continue
+            number = int(match.group(1))
+            self._next = max(self._next, number + 1)
+            if match.group(2) == 'log' and number >= self._log_number:
+                logs.append(number)
+            elif number not in live:
+                os.remove(self.file_path(name))
+        self.levels = [[SSTable(self.table_path(number), number) for number in level] for level in manifest['levels']]
+
+        self.memtable = {}
+        self._sorted_keys = None
+        self.frozen = None
+        self._frozen_keys = None
+        self._job = None
+        # The key after which the next compaction of each level starts
+        self._pointers = {}
+        self._seq = 0
+        for number in sorted(logs):
+            for seq, xid, writes in read_records(self.log_path(number)):
+                self.memtable.update(writes)
+                self._seq = max(self._seq, seq)
+        self._logs = sorted(logs)
+        self.new_log()
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def table_path(self, number):
+        return self.file_path('%06d.sst' % (number))
+
+    def log_path(self, number):
+        return self.file_path('%06d.log' % (number))
+
+    def new_number(self):
+        number = self._next
+        self._next += 1
+        return number
+
+    def new_log(self):
+        number = self.new_number()
+        self._log = WriteAheadLog(self.log_path(number), self.fsync)
+        self._logs.append(number)
+
+    def write_manifest(self):
+        manifest = {
+            'next': self._next,
+            'log': self._log_number,
+            'levels': [[table.number for table in level] for level in self.levels],
+        }
+        tmp_path = self.file_path(MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp_path, self.file_path(MANIFEST))
+        if self.fsync:
+            fsync_directory(tmp_path)
+
+    def write(self, xid, writes):
+        """
+        Applies the (key, value) pairs committed by xid, where a value of None
+        deletes the key. They are durable after the next sync().
+        """
+        self._seq += 1
+        self._log.append(self._seq, xid, writes)
+        memtable = self.memtable
+        for key, value in writes:
+            if key not in memtable:
+                self._sorted_keys = None
+            memtable[key] = value
+        if len(memtable) >= self.memtable_size:
+            self.freeze()
+
+    def sync(self):
+        self._log.flush()
+
+    def freeze(self):
+        """
+        Freezes the memtable and starts a new one, with a new log.
+        """
+        while self.frozen is not None or len(self.levels[0]) >= 2 * self.level0_limit:
+            self.work(self.memtable_size)
+        self._log.close()
+        self.frozen = self.memtable
+        self._frozen_keys = self.sorted_keys()
+        self.memtable = {}
+        self._sorted_keys = None
+        self.new_log()
+
+    def sorted_keys(self):
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self.memtable)
+        return self._sorted_keys
+
+    def get(self, key):
+        if key in self.memtable:
+            return self.memtable[key]
+        if self.frozen is not None and key in self.frozen:
+            return self.frozen[key]
+        key = to_bytes(key)
+        for table in self.levels[0]:
+            found, value = table.get(key)
+            if found:
+                return value if value is None else to_str(value)
+        for level in self.levels[1:]:
+            i = find_table(level, key)
+            if i < len(level):
+                found, value = level[i].get(key)
+                if found:
+                    return value if value is None else to_str(value)
+        return None
+
+    def iterate(self, low, high):
+        """
+        Generates the (key, value) pairs with low <= key <= high, in key
+        order.
+        """
+        sources = []
+        for memtable, keys in [(self.memtable, self.sorted_keys()), (self.frozen, self._frozen_keys)]:
+            if memtable is not None:
+                sources.append(iterate_memtable(memtable, keys, low))
+        low, high = to_bytes(low), to_bytes(high)
+        sources.extend(table.iterate(low) for table in self.levels[0])
+        sources.extend(iterate_level(level, low) for level in self.levels[1:])
+        for key, value in merge(sources):
+            if key > high:
+                return
+            if value is not None:
+                yield to_str(key), to_str(value)
+
+    def work(self, budget=None):
+        """
+        Advances the writing of the frozen memtable and compactions by up to
+        budget records, or until there is nothing left to do.
+        """
+        while budget is None or budget > 0:
+            if self._job is None:
+                self._job = self.next_job()
+                if self._job is None:
+                    return
+            try:
+                next(self._job)
+            except StopIteration:
+                self._job = None
+            if budget is not None:
+                budget -= 1
+
+    def next_job(self):
+        if self.frozen is not None:
+            return self.flush_frozen()
+        if len(self.levels[0]) >= self.level0_limit:
+            inputs = list(self.levels[0])
+            low = min(table.min_key for table in inputs)
+            high = max(table.max_key for table in inputs)
+            return self.compact(0, inputs, self.overlapping(1, low, high))
+        for level in range(1, len(self.levels)):
+            tables = self.levels[level]
+            if sum(table.size for table in tables) > self.level_size * self.level_ratio ** (level - 1):
+                # Take turns through the key range of the level
+                pointer = self._pointers.get(level)
+                i = 0 if pointer is None else find_table(tables, pointer + b'\0') % len(tables)
+                table = tables[i]
+                self._pointers[level] = table.max_key
+                return self.compact(level, [table], self.overlapping(level + 1, table.min_key, table.max_key))
+        return None
+
+    def overlapping(self, level, low, high):
+        if level >= len(self.levels):
+            return []
+        return [table for table in self.levels[level] if table.max_key >= low and table.min_key <= high]
+
+    def new_writer(self):
+        number = self.new_number()
+        return TableWriter(self.table_path(number), number, self.block_size)
+
+    def flush_frozen(self):
+        """
+        The job that writes the frozen memtable to level 0. Generates once
+        per record.
+        """
+        frozen = self.frozen
+        writer = self.new_writer()
+        try:
+            for key in self._frozen_keys:
+                value = frozen[key]
+                writer.add(to_bytes(key), None if value is None else to_bytes(value))
+                yield
+        except GeneratorExit:
+            # The tree was closed in the middle of the job
+            writer.close()
+            raise
+        if writer.count():
+            self.levels[0].insert(0, writer.finish(self.fsync))
+        else:
+            writer.abandon()
+        self.frozen = None
+        self._frozen_keys = None
+        self._log_number = self._logs[-1]
+        self.write_manifest()
+        for number in self._logs[:-1]:
+            os.remove(self.log_path(number))
+        self._logs = self._logs[-1:]
+
+    def compact(self, level, inputs, overlapping):
+        """
+        The job that merges the input tables of level with the overlapping
+        tables of the next level, into new tables of at most about
+        table_size bytes in the next level. Generates once per record.
+        """
+        output_level = level + 1
+        if level == 0:
+            sources = [table.iterate() for table in inputs]
+        else:
+            sources = [inputs[0].iterate()]
+        sources.append(itertools.chain(*[table.iterate() for table in overlapping]))
+        drop_tombstones = not any(self.levels[output_level + 1:])
+        outputs = []
+        writer = None
+        try:
+            for key, value in merge(sources):
+                if value is None and drop_tombstones:
+                    yield
+                    continue
+                if writer is None:
+                    writer = self.new_writer()
+                writer.add(key, value)
+                if writer.size >= self.table_size:
+                    outputs.append(writer.finish(self.fsync))
+                    writer = None
+                yield
+        except GeneratorExit:
+            # The tree was closed in the middle of the job. The outputs are
+            # not in the manifest yet, so they are removed on the next open
+            if writer is not None:
+                writer.close()
+            for table in outputs:
+                table.close()
+            raise
+        if writer is not None:
+            outputs.append(writer.finish(self.fsync))
+
+        if output_level == len(self.levels):
+            self.levels.append([])
+        removed = set(table.number for table in inputs + overlapping)
+        self.levels[level] = [table for table in self.levels[level] if table.number not in removed]
+        kept = [table for table in self.levels[output_level] if table.number not in removed]
+        self.levels[output_level] = sorted(kept + outputs, key=lambda table: table.min_key)
+        self.write_manifest()
+        for table in inputs + overlapping:
+            table.close()
+            os.remove(table.path)
+
+    def close(self):
+        """
+        Closes the log and the tables, stopping any job in progress.
+        Committed writes not yet synced are written to the log first.
+        """
+        if self._job is not None:
+            self._job.close()
+            self._job = None
+        self._log.close()
+        for level in self.levels:
+            for table in level:
+                table.close()
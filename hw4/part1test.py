@@ -1,12 +1,16 @@
+import os
+import tempfile
 import unittest
 
-from kvstore import InMemoryKVStore
-from student import USER, TransactionHandler
+from kvstore import InMemoryKVStore, MVCCKVStore
+from locktable import EXCLUSIVE, INTENTION_SHARED, SHARED, SHARED_INTENTION_EXCLUSIVE, TABLE, GrantScheduler, LockTable
+from locktrace import RingBuffer, TraceWriter, read_trace, replay
+from student import USER, OptimisticTransactionHandler, TransactionHandler
 
 class Part1Test(unittest.TestCase):
     def test_commit(self):
         # Sanity check
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         self.assertEqual(t0.perform_get('a'), 'No such key')
@@ -17,7 +21,7 @@ class Part1Test(unittest.TestCase):
 
     def test_abort(self):
         # Sanity check
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         self.assertEqual(t0.perform_get('a'), 'No such key')
@@ -28,7 +32,7 @@ class Part1Test(unittest.TestCase):
 
     def test_multiple_read(self):
         # Sanity check
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         store.put('a', '0')
         t0 = TransactionHandler(lock_table, 0, store)
@@ -43,7 +47,7 @@ class Part1Test(unittest.TestCase):
 
     def test_rw(self):
         # Should pass after 1.1
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -55,7 +59,7 @@ class Part1Test(unittest.TestCase):
 
     def test_wr(self):
         # Should pass after 1.1
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -67,7 +71,7 @@ class Part1Test(unittest.TestCase):
 
     def test_ww(self):
         # Should pass after 1.1
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -79,7 +83,7 @@ class Part1Test(unittest.TestCase):
 
     def test_commit_commit(self):
         # Should pass after 1.2
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -95,7 +99,7 @@ class Part1Test(unittest.TestCase):
 
     def test_abort_commit(self):
         # Should pass after 1.2
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -109,9 +113,66 @@ class Part1Test(unittest.TestCase):
         self.assertEqual(t1.commit(), 'Transaction Completed')
         self.assertEqual(store.get('a'), '1')
 
+    def test_lock_table_gc(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')        # T0 W(a)
+        self.assertEqual(t0.perform_put('b', '0'), 'Success')        # T0 W(b)
+        self.assertEqual(t1.perform_put('a', '1'), None)             # T1 W(a)
+        self.assertEqual(t2.perform_put('b', '2'), None)             # T2 W(b)
+        self.assertEqual(t2.abort(USER), 'User Abort')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(sorted(lock_table), [TABLE, 'a'])           # b has no holders and no waiters
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(sorted(lock_table), [TABLE])
+        self.assertEqual(lock_table[TABLE].is_unused(), True)
+
+    def test_batch_scheduler(self):
+        lock_table = LockTable(scheduler=GrantScheduler(batch=True, max_bypass=1))
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        t3 = TransactionHandler(lock_table, 3, store)
+        self.assertEqual(t0.perform_get('a'), 'No such key')         # T0 R(a)
+        self.assertEqual(t1.perform_put('a', '1'), None)             # T1 W(a)
+        self.assertEqual(t2.perform_get('a'), 'No such key')         # T2 R(a), overtakes T1
+        self.assertEqual(t3.perform_get('a'), None)                  # T3 R(a), T1 has been overtaken once
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), None)
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t3.check_lock(), '1')
+
+    def test_priority_scheduler(self):
+        lock_table = LockTable(scheduler=GrantScheduler(priorities=True, max_bypass=1))
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        t3 = TransactionHandler(lock_table, 3, store)
+        t2.priority = t3.priority = 1
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')        # T0 W(a)
+        self.assertEqual(t1.perform_put('a', '1'), None)             # T1 W(a)
+        self.assertEqual(t2.perform_put('a', '2'), None)             # T2 W(a), ahead of T1
+        self.assertEqual(t3.perform_put('a', '3'), None)             # T3 W(a), T1 has been overtaken once
+        self.assertEqual([txn._xid for txn, _ in lock_table['a'].queue], [2, 1, 3])
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), 'Success')
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t3.check_lock(), 'Success')
+        self.assertEqual(store.get('a'), '3')
+
     def test_commit_abort_commit(self):
         # Should pass after 1.2
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -132,7 +193,7 @@ class Part1Test(unittest.TestCase):
 
     def test_unlock_rw(self):
         # Should pass after 1.3
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -147,7 +208,7 @@ class Part1Test(unittest.TestCase):
 
     def test_unlock_wr(self):
         # Should pass after 1.3
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -162,7 +223,7 @@ class Part1Test(unittest.TestCase):
 
     def test_unlock_ww(self):
         # Should pass after 1.3
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -175,5 +236,241 @@ class Part1Test(unittest.TestCase):
         self.assertEqual(t1.check_lock(), 'Success')
         self.assertEqual(t1.perform_get('a'), '1')
 
+    def test_upgrade_jumps_queue(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_get('a'), 'No such key')         # T0 R(a)
+        self.assertEqual(t1.perform_get('a'), 'No such key')         # T1 R(a)
+        self.assertEqual(t2.perform_put('a', '2'), None)             # T2 W(a)
+        self.assertEqual(t1.perform_put('a', '1'), None)             # T1 W(a), upgrade
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), None)
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), 'Success')
+        self.assertEqual(store.get('a'), '2')
+
+    def test_abort_while_waiting(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')        # T0 W(a)
+        self.assertEqual(t1.perform_put('a', '1'), None)             # T1 W(a)
+        self.assertEqual(t2.perform_get('a'), None)                  # T2 R(a)
+        self.assertEqual(t1.abort(USER), 'User Abort')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), '0')
+        self.assertEqual(lock_table['a'].queue, [])
+
+    def test_grant_notifies_waiter(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        granted = []
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store, lambda: granted.append(1))
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')        # T0 W(a)
+        self.assertEqual(t1.perform_get('a'), None)                  # T1 R(a)
+        self.assertEqual(granted, [])
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(granted, [1])
+        self.assertEqual(t1.check_lock(), '0')
+
+    def test_shared_waits_behind_queue(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_get('a'), 'No such key')         # T0 R(a)
+        self.assertEqual(t1.perform_put('a', '1'), None)             # T1 W(a)
+        self.assertEqual(t2.perform_get('a'), None)                  # T2 R(a)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t2.check_lock(), None)
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), '1')
+
+    def test_scan(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')        # T0 W(a)
+        self.assertEqual(t0.perform_put('c', '0'), 'Success')        # T0 W(c)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.perform_get('a'), '0')                   # T1 R(a)
+        self.assertEqual(t1.perform_scan('a', 'b'), 'a 0')           # T1 R(a..b)
+        self.assertEqual(t2.perform_put('b', '2'), None)             # T2 W(b), blocked by the scan
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), 'Success')
+        self.assertEqual(t2.perform_scan('a', 'z'), 'a 0 b 2 c 0')   # T2 R(a..z)
+        self.assertEqual(lock_table[TABLE].mode_of(2), SHARED_INTENTION_EXCLUSIVE)
+
+    def test_escalation(self):
+        lock_table = LockTable(escalation_threshold=3)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        for key in 'abc':
+            self.assertEqual(t0.perform_put(key, '0'), 'Success')
+        self.assertEqual(t1.perform_get('z'), 'No such key')         # T1 R(z), IS on the table
+        self.assertEqual(t0.perform_get('d'), 'No such key')         # T0 cannot escalate past T1
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t0.perform_get('e'), 'No such key')         # T0 escalates to X
+        self.assertEqual(t0._acquired_locks, {TABLE: EXCLUSIVE})
+        self.assertNotIn('a', lock_table)
+        self.assertEqual(t0.perform_put('f', '0'), 'Success')
+        self.assertEqual(t2.perform_get('a'), None)                  # T2 R(a)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), '0')
+
+    def test_escalation_waits_for_queue(self):
+        lock_table = LockTable(escalation_threshold=3)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        for key in 'abc':
+            self.assertEqual(t0.perform_get(key), 'No such key')
+        self.assertEqual(t1.perform_scan('a', 'z'), 'No such key')   # T1 S on the table
+        self.assertEqual(t2.perform_put('z', '2'), None)             # T2 waits for IX on the table
+        self.assertEqual(t0.perform_get('d'), 'No such key')         # T0 cannot escalate past T2
+        self.assertEqual(t0.has_lock(TABLE), INTENTION_SHARED)
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t2.check_lock(), 'Success')
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(t0.perform_get('e'), 'No such key')         # T0 escalates to S
+        self.assertEqual(t0._acquired_locks, {TABLE: SHARED})
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+
+    def test_read_only(self):
+        lock_table = LockTable()
+        store = MVCCKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')        # T0 W(a)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.begin_read_only(), 'Read-only transaction started')
+        self.assertEqual(t2.perform_put('a', '2'), 'Success')        # T2 W(a), not blocked by T1
+        self.assertEqual(t2.perform_put('b', '2'), 'Success')        # T2 W(b)
+        self.assertEqual(t1.perform_get('a'), '0')                   # T1 R(a), not blocked by T2
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(t1.perform_get('b'), 'No such key')         # T1 R(b), from its snapshot
+        self.assertEqual(t1.perform_scan('a', 'z'), 'a 0')
+        self.assertEqual(t1.perform_put('a', '1'), 'Read-only transaction')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(list(lock_table[TABLE].holders), [])
+        self.assertEqual(TransactionHandler(lock_table, 3, InMemoryKVStore()).begin_read_only(), 'Store does not support snapshots')
+
+    def test_trace_replay(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        ring = RingBuffer()
+        path = os.path.join(tempfile.mkdtemp(), 'trace')
+        writer = TraceWriter(path)
+        def tracer(*event):
+            ring(*event)
+            writer(*event)
+        t0 = TransactionHandler(lock_table, 0, store, tracer=tracer)
+        t1 = TransactionHandler(lock_table, 1, store, tracer=tracer)
+        t2 = TransactionHandler(lock_table, 2, store, tracer=tracer)
+        self.assertEqual(t0.perform_get('a'), 'No such key')         # T0 R(a)
+        self.assertEqual(t1.perform_get('a'), 'No such key')         # T1 R(a)
+        self.assertEqual(t2.perform_put('a', '2'), None)             # T2 W(a)
+        self.assertEqual(t0.perform_put('a', '0'), None)             # T0 upgrade, ahead of T2
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t0.check_lock(), 'Success')
+        writer.close()
+        state = dict((key, [sorted(entry.holders.items()), [(txn._xid, mode) for txn, mode in entry.queue]])
+                     for key, entry in lock_table.items() if entry.holders or entry.queue)
+        for events in [ring.events, read_trace(path)]:
+            traced = dict((key, [sorted(holders.items()), queue]) for key, (holders, queue) in replay(events).items())
+            self.assertEqual(traced, state)
+        self.assertEqual(state['a'], [[(0, EXCLUSIVE)], [(2, EXCLUSIVE)]])
+
+    def test_fast_reads(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_get('a'), 'No such key')         # T0 R(a)
+        self.assertEqual(t0.perform_get('b'), 'No such key')         # T0 R(b)
+        self.assertEqual(sorted(lock_table), [TABLE])
+        self.assertEqual(lock_table.sole_readers, {'a': 0, 'b': 0})
+        self.assertEqual(t1.perform_put('a', '1'), None)             # T1 W(a) creates the entry
+        self.assertEqual(lock_table['a'].holders, {0: SHARED})
+        self.assertEqual(lock_table.sole_readers, {'b': 0})
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table.sole_readers, {})
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(t1.perform_get('a'), '1')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+
+    def test_optimistic(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        store.put('a', '0')
+        t0 = OptimisticTransactionHandler(lock_table, 0, store)
+        t1 = OptimisticTransactionHandler(lock_table, 1, store)
+        t2 = OptimisticTransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_get('a'), '0')                   # T0 R(a)
+        self.assertEqual(t1.perform_put('a', '1'), 'Success')        # T1 W(a), not blocked
+        self.assertEqual(t1.perform_get('a'), '1')                   # T1 reads its own write
+        self.assertEqual(t2.perform_get('b'), 'No such key')         # T2 R(b)
+        self.assertEqual(store.get('a'), '0')
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(store.get('a'), '1')
+        self.assertEqual(t2.perform_put('c', '2'), 'Success')
+        self.assertEqual(t2.commit(), 'Transaction Completed')       # b was not written
+        self.assertEqual(t0.perform_put('b', '0'), 'Success')
+        self.assertEqual(t0.commit(), 'Validation Abort')            # a changed since T0 read it
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(len(lock_table), 0)
+
+    def test_optimistic_scan(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = OptimisticTransactionHandler(lock_table, 0, store)
+        t1 = OptimisticTransactionHandler(lock_table, 1, store)
+        t2 = OptimisticTransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_scan('a', 'z'), 'No such key')
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t0.perform_scan('a', 'z'), 'a 0')
+        self.assertEqual(t1.perform_scan('a', 'z'), 'No such key')
+        self.assertEqual(t2.perform_put('m', '2'), 'Success')        # Phantom in T0's and T1's range
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(t0.commit(), 'Validation Abort')
+        self.assertEqual(t1.commit(), 'Validation Abort')
+
+    def test_optimistic_versions_dropped(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = OptimisticTransactionHandler(lock_table, 0, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(lock_table.versions, {})                    # No one can see it
+        t1 = OptimisticTransactionHandler(lock_table, 1, store)
+        self.assertEqual(t1.perform_get('a'), '0')                   # Written before T1 started
+        self.assertEqual(t1.perform_get('b'), 'No such key')
+        t2 = OptimisticTransactionHandler(lock_table, 2, store)
+        self.assertEqual(t2.perform_put('b', '2'), 'Success')
+        self.assertEqual(t2.commit(), 'Transaction Completed')
+        self.assertEqual(sorted(lock_table.versions), ['', 'b'])     # T1 started before it
+        t3 = OptimisticTransactionHandler(lock_table, 3, store)
+        self.assertEqual(t3.perform_get('b'), '2')
+        self.assertEqual(t1.commit(), 'Validation Abort')            # b changed since T1 read it
+        self.assertEqual(lock_table.versions, {})
+        self.assertEqual(t3.perform_put('a', '3'), 'Success')
+        self.assertEqual(t3.commit(), 'Transaction Completed')       # b was written before T3 started
+        self.assertEqual((lock_table.versions, lock_table.optimistic_starts), ({}, {}))
+
 if __name__ == '__main__':
     unittest.main()
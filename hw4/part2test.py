@@ -1,12 +1,14 @@
 import unittest
 
+from infra.sharding import global_deadlock_victims
 from kvstore import InMemoryKVStore
+from locktable import TIMEOUT, WAIT_DIE, WOUND_WAIT, LockTable
 from student import DEADLOCK, USER, TransactionCoordinator, TransactionHandler
 
 class Part2Test(unittest.TestCase):
     def test_deadlock_rw_rw(self):
         # Should pass after 2
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -31,7 +33,7 @@ class Part2Test(unittest.TestCase):
 
     def test_deadlock_wr_rw(self):
         # Should pass after 2
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -56,7 +58,7 @@ class Part2Test(unittest.TestCase):
 
     def test_deadlock_ww_rw(self):
         # Should pass after 2
-        lock_table = {}
+        lock_table = LockTable()
         store = InMemoryKVStore()
         t0 = TransactionHandler(lock_table, 0, store)
         t1 = TransactionHandler(lock_table, 1, store)
@@ -79,5 +81,115 @@ class Part2Test(unittest.TestCase):
         abort_id = coordinator.detect_deadlocks()
         self.assertTrue(abort_id == 1 or abort_id == 2)
 
+    def test_deadlock_cycle_of_three(self):
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')       # T0 W(a)
+        self.assertEqual(t1.perform_put('b', 'b1'), 'Success')       # T1 W(b)
+        self.assertEqual(t2.perform_put('c', 'c2'), 'Success')       # T2 W(c)
+        self.assertEqual(t0.perform_get('b'), None)                  # T0 R(b)
+        self.assertEqual(t1.perform_get('c'), None)                  # T1 R(c)
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t2.perform_get('a'), None)                  # T2 R(a)
+        self.assertEqual(coordinator.detect_deadlocks(), 2)
+        self.assertEqual(coordinator.detect_deadlocks(), 2)
+        self.assertEqual(t2.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t1.check_lock(), 'No such key')
+
+    def test_deadlock_with_new_holder(self):
+        # T2 only starts waiting for T1 once T1 is granted the lock on a
+        lock_table = LockTable()
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')       # T0 W(a)
+        self.assertEqual(t2.perform_put('b', 'b2'), 'Success')       # T2 W(b)
+        self.assertEqual(t1.perform_put('a', 'a1'), None)            # T1 W(a)
+        self.assertEqual(t2.perform_put('a', 'a2'), None)            # T2 W(a)
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), 'Success')
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t1.perform_get('b'), None)                  # T1 R(b)
+        self.assertEqual(coordinator.detect_deadlocks(), 2)
+
+    def test_wait_die(self):
+        lock_table = LockTable(WAIT_DIE)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t1.perform_put('a', 'a1'), 'Success')       # T1 W(a)
+        self.assertEqual(t0.perform_get('a'), None)                  # T0 R(a), older waits
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t2.perform_get('a'), None)                  # T2 R(a), younger dies
+        self.assertEqual(coordinator.detect_deadlocks(), 2)
+        self.assertEqual(t2.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t1.commit(), 'Transaction Completed')
+        self.assertEqual(t0.check_lock(), 'a1')
+
+    def test_wound_wait(self):
+        lock_table = LockTable(WOUND_WAIT)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t1.perform_put('a', 'a1'), 'Success')       # T1 W(a)
+        self.assertEqual(t2.perform_get('a'), None)                  # T2 R(a), younger waits
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t0.perform_put('a', 'a0'), None)            # T0 W(a), wounds T1
+        self.assertEqual(coordinator.detect_deadlocks(), 1)
+        self.assertEqual(t1.abort(DEADLOCK), 'Deadlock Abort')
+        # T2 is younger and queued ahead of T0, so T0 wounded it too
+        self.assertEqual(coordinator.detect_deadlocks(), 2)
+        self.assertEqual(t2.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t0.check_lock(), 'Success')
+
+    def test_lock_timeout(self):
+        now = [0.0]
+        lock_table = LockTable(TIMEOUT, 1.0, lambda: now[0])
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')       # T0 W(a)
+        self.assertEqual(t1.perform_put('a', 'a1'), None)            # T1 W(a)
+        now[0] = 0.5
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        now[0] = 1.5
+        self.assertEqual(coordinator.detect_deadlocks(), 1)
+        self.assertEqual(t1.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+
+    def test_global_deadlock(self):
+        # A cycle across two shards, which neither shard can see by itself
+        shards = [LockTable(), LockTable()]
+        stores = [InMemoryKVStore(), InMemoryKVStore()]
+        t1 = [TransactionHandler(shards[i], 1, stores[i]) for i in range(2)]
+        t2 = [TransactionHandler(shards[i], 2, stores[i]) for i in range(2)]
+        self.assertEqual(t1[0].perform_put('a', 'a1'), 'Success')    # T1 W(a) on shard 0
+        self.assertEqual(t2[1].perform_put('b', 'b2'), 'Success')    # T2 W(b) on shard 1
+        self.assertEqual(t1[1].perform_get('b'), None)               # T1 R(b) on shard 1
+        self.assertEqual(t2[0].perform_get('a'), None)               # T2 R(a) on shard 0
+        edges = []
+        for lock_table in shards:
+            self.assertEqual(TransactionCoordinator(lock_table).detect_deadlocks(), None)
+            edges.extend((waiter, holder) for waiter, holders in lock_table.waits_for.edges.items() for holder in holders)
+        self.assertEqual(global_deadlock_victims(edges), [2])
+        self.assertEqual(t2[0].abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(t2[1].abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(t1[1].check_lock(), 'No such key')
+
 if __name__ == '__main__':
     unittest.main()
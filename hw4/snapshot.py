@@ -0,0 +1,203 @@
+import mmap
+import os
+import struct
+import sys
+import time
+import traceback
+import zlib
+
+from infra.utils import to_bytes
+from wal import fsync_directory
+
+"""
+Binary snapshots of an in-memory store, to warm-start a server with a large
+dataset. A snapshot is a header, then every key of the store, then every
+value in the same order, each block being the strings joined by NUL bytes,
+so that writing or loading a snapshot is a join() or a split() per block
+rather than a loop over records. The header holds the number of pairs, the
+sizes of the two blocks and their CRC-32. Keys and values cannot contain NUL,
+which the protocol of the server never sends.
+
+A snapshot is written to a temporary file and renamed, so it is never torn.
+It is read through mmap, and the blocks are decoded straight from the
+mapping, without first copying the file into memory.
+
+Checkpointer writes snapshots in the background: it forks, and the child
+writes the snapshot from its copy-on-write image of the store while the
+parent goes on. The child updates the reference count of every key and
+value it writes, so the pages holding them are copied: memory use can
+double while a snapshot is being written.
+"""
+
+MAGIC = b'KVS1'
+
+# Magic, number of pairs, bytes of keys, bytes of values, CRC-32 of both
+HEADER = struct.Struct('>4sQQQI')
+
+def write_snapshot(path, data, overrides=None, fsync=True):
+    """
+    Atomically replaces the snapshot at path with data, a dict mapping keys
+    to values, in which the keys of overrides have the values of overrides
+    instead. Keys whose value is None are left out.
+
+    @return: the number of pairs written.
+    """
+    keys = list(data)
+    values = list(data.values())
+    if overrides:
+        values = [overrides.get(key, value) for key, value in zip(keys, values)]
+    if None in values:
+        keys = [key for key, value in zip(keys, values) if value is not None]
+        values = [value for value in values if value is not None]
+    key_block = to_bytes('\0'.join(keys))
+    value_block = to_bytes('\0'.join(values))
+    if keys and (key_block.count(b'\0') != len(keys) - 1 or value_block.count(b'\0') != len(values) - 1):
+        raise ValueError('Keys and values of a snapshot cannot contain NUL')
+    checksum = zlib.crc32(value_block, zlib.crc32(key_block)) & 0xffffffff
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys), len(key_block), len(value_block), checksum))
+        f.write(key_block)
+        f.write(value_block)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    if fsync:
+        fsync_directory(path)
+    return len(keys)
+
+def read_snapshot(path):
+    """
+    @return: the dict of the pairs of the snapshot at path.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            raise ValueError('%s is not a snapshot' % (path))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, count, key_size, value_size, checksum = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or size != HEADER.size + key_size + value_size:
+            raise ValueError('%s is not a snapshot, or is truncated' % (path))
+        if not count:
+            return {}
+        middle = HEADER.size + key_size
+        try:
+            views = [memoryview(mapped)]
+        except TypeError:
+            # Python 2's mmap only has the old buffer interface: slicing it
+            # copies, and the copy is already a str
+            views = []
+        if views:
+            views += [views[0][HEADER.size:middle], views[0][middle:size]]
+            blocks = views[1:]
+        else:
+            blocks = [mapped[HEADER.size:middle], mapped[middle:size]]
+        try:
+            if zlib.crc32(blocks[1], zlib.crc32(blocks[0])) & 0xffffffff != checksum:
+                raise ValueError('%s fails its checksum' % (path))
+            if views:
+                blocks = [str(block, 'utf-8') for block in blocks]
+        finally:
+            for view in reversed(views):
+                view.release()
+        keys = blocks[0].split('\0')
+        values = blocks[1].split('\0')
+        if len(keys) != count or len(values) != count:
+            raise ValueError('%s holds %d keys and %d values instead of %d' % (path, len(keys), len(values), count))
+        return dict(zip(keys, values))
+    finally:
+        mapped.close()
+
+class Checkpointer(object):
+    """
+    Writes snapshots to path, one at a time, in a forked child, so that the
+    caller is not stalled while the snapshot is written. Without os.fork(),
+    snapshots are written in the foreground.
+
+    written: the number of snapshots written, and failed the number of
+    children that exited with an error.
+
+    duration: the number of seconds the last snapshot took, from the fork to
+    the exit of the child.
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.pid = None
+        self.started = None
+        self.written = 0
+        self.failed = 0
+        self.duration = None
+
+    def write(self, state):
+        """
+        Writes the snapshot of state(), which returns the arguments data and
+        overrides of write_snapshot(), in the foreground.
+        """
+        start = time.time()
+        data, overrides = state()
+        write_snapshot(self.path, data, overrides, self.fsync)
+        self.written += 1
+        self.duration = time.time() - start
+
+    def start(self, state):
+        """
+        Starts writing the snapshot of state(), which is called in the child,
+        unless a snapshot is already being written.
+
+        @return: True if a snapshot was started.
+        """
+        if self.poll():
+            return False
+        if not hasattr(os, 'fork'):
+            self.write(state)
+            return True
+        self.started = time.time()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                data, overrides = state()
+                write_snapshot(self.path, data, overrides, self.fsync)
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+                sys.stderr.flush()
+            finally:
+                # Skip the cleanup of the parent's objects, such as its
+                # sockets and buffered files
+                os._exit(status)
+        self.pid = pid
+        return True
+
+    def poll(self):
+        """
+        Reaps the child if it has exited.
+
+        @return: True while a snapshot is being written.
+        """
+        if self.pid is None:
+            return False
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid == 0:
+            return True
+        self.reaped(status)
+        return False
+
+    def wait(self):
+        """
+        Waits for the snapshot being written, if any.
+        """
+        if self.pid is not None:
+            self.reaped(os.waitpid(self.pid, 0)[1])
+
+    def reaped(self, status):
+        self.pid = None
+        if status == 0:
+            self.written += 1
+            self.duration = time.time() - self.started
+        else:
+            self.failed += 1
@@ -0,0 +1,356 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from infra.eventloop import EventLoop
+from infra.replication import CommitLog, Primary, Replica
+from infra.server import listen
+from infra.utils import KVStoreError
+from kvstore import DBMStore, DurableKVStore, InMemoryKVStore, LSMKVStore, MVCCKVStore
+from lsm import LSMTree
+from snapshot import Checkpointer, read_snapshot, write_snapshot
+
+class MVCCKVStoreTest(unittest.TestCase):
+    def write(self, store, xid, key, value):
+        store.put(key, value)
+        store.commit(xid, {key: value})
+
+    def test_versions(self):
+        store = MVCCKVStore()
+        self.write(store, 0, 'a', '0')
+        before = store.snapshot()
+        store.put('a', '1')
+        self.assertEqual(store.get('a'), '1')
+        self.assertEqual(store.get_version('a', before), '0')
+        store.commit(1, {'a': '1'})
+        after = store.snapshot()
+        store.put('a', '2')
+        store.put('b', '2')
+        self.assertEqual(store.get_version('a', before), '0')
+        self.assertEqual(store.get_version('a', after), '1')
+        self.assertEqual(store.get_version('b', after), None)
+        self.assertEqual(store.scan_version('a', 'z', after), [('a', '1')])
+        self.assertEqual(store.scan('a', 'z'), [('a', '2'), ('b', '2')])
+
+    def test_garbage_collection(self):
+        store = MVCCKVStore()
+        self.write(store, 0, 'a', '0')
+        self.assertEqual(store._versions, {})
+        first = store.snapshot()
+        for xid in range(1, 4):
+            self.write(store, xid, 'a', str(xid))
+        second = store.snapshot()
+        self.assertEqual(len(store._versions['a']), 4)
+        self.write(store, 4, 'a', '4')
+        store.release_snapshot(first)
+        self.assertEqual(store._versions['a'], [(4, '3'), (5, '4')])
+        self.assertEqual(store.get_version('a', second), '3')
+        store.release_snapshot(second)
+        self.assertEqual(store._versions, {})
+        self.assertEqual(store.get_version('a', store.snapshot()), '4')
+
+    def test_abort(self):
+        store = MVCCKVStore()
+        self.write(store, 0, 'a', '0')
+        snapshot = store.snapshot()
+        store.put('a', '1')
+        self.assertEqual(store.get_version('a', snapshot), '0')
+        store.put('a', '0')
+        self.assertEqual(store._versions, {})
+
+class DurableKVStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'kvstore')
+        # Cleanups run last first, so the stores are closed before this
+        self.addCleanup(shutil.rmtree, self._dir)
+
+    def open(self, **kwargs):
+        store = DurableKVStore(self._path, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_recovery(self):
+        store = self.open()
+        store.put('a', '0')
+        store.put('b', '0')
+        store.commit(0, {'a': '0', 'b': '0'})
+        store.put('a', '1')
+        store.commit(1, {'a': '1'})
+        store.flush()
+        store.put('b', '2')                     # Uncommitted
+        store.put('c', '3')
+        store.commit(3, {'c': '3'})             # Committed, but not flushed
+        # Crash, without closing the store
+        store = self.open()
+        self.assertEqual(store.scan('a', 'z'), [('a', '1'), ('b', '0')])
+
+    def test_torn_record(self):
+        store = self.open()
+        store.put('a', '0')
+        store.commit(0, {'a': '0'})
+        store.put('a', '1')
+        store.commit(1, {'a': '1'})
+        store.close()
+        with open(self._path + '.log', 'rb+') as f:
+            f.truncate(os.path.getsize(self._path + '.log') - 1)
+        store = self.open()
+        self.assertEqual(store.get('a'), '0')
+
+    def test_checkpoint(self):
+        store = self.open(checkpoint_interval=2)
+        store.put('a', '0')
+        store.commit(0, {'a': '0'})
+        store.put('b', '1')
+        store.commit(1, {'b': '1'})
+        store.put('a', '2')                     # Uncommitted at the checkpoint
+        store.flush()
+        self.assertEqual(os.path.getsize(self._path + '.log'), 0)
+        store.put('c', '3')
+        store.commit(3, {'c': '3'})
+        store.flush()
+        store = self.open(checkpoint_interval=2)
+        self.assertEqual(store.scan('a', 'z'), [('a', '0'), ('b', '1'), ('c', '3')])
+
+class DBMStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_batched_writes(self):
+        store = DBMStore(self._path)
+        store.put('a', '0')
+        store.put('b', '0')
+        store.commit(0, {'a': '0', 'b': '0'})
+        self.assertEqual(store.read('a'), None)         # Committed, but not flushed
+        store.flush()
+        self.assertEqual(store.read('a'), '0')
+        store.put('a', '1')                             # Uncommitted
+        store.put('b', None)
+        store.commit(1, {'b': None})
+        self.assertEqual(store.scan('a', 'z'), [('a', '1')])
+        store.close()
+        store = DBMStore(self._path)
+        self.assertEqual(store.scan('a', 'z'), [('a', '0')])
+        store.close()
+
+    def test_cache(self):
+        store = DBMStore(self._path, cache_size=2)
+        for key in ['a', 'b', 'c']:
+            store.put(key, key)
+            store.commit(0, {key: key})
+        store.flush()
+        self.assertEqual(list(store._cache), ['b', 'c'])
+        self.assertEqual(store.get('b'), 'b')           # Hit
+        self.assertEqual(store.get('a'), 'a')           # Miss, evicts c
+        self.assertEqual(list(store._cache), ['b', 'a'])
+        store.put('b', '1')
+        store.put('b', 'b')                             # Undone, in memory
+        self.assertEqual(store._dirty, {})
+        self.assertEqual(store.get('b'), 'b')
+        self.assertEqual((store.hits, store.misses), (3, 4))
+        store.close()
+
+class LSMTreeTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'lsm')
+        # Cleanups run last first, so the trees are closed before this
+        self.addCleanup(shutil.rmtree, self._dir)
+
+    def open(self):
+        tree = LSMTree(self._path, memtable_size=10, table_size=200, level0_limit=2, level_size=400, level_ratio=2, block_size=64, fsync=False)
+        self.addCleanup(tree.close)
+        return tree
+
+    def test_compaction(self):
+        tree = self.open()
+        expected = {}
+        for i in range(300):
+            key = 'k%03d' % ((i * 37) % 100)
+            value = None if i % 7 == 0 else str(i)
+            tree.write(i, [(key, value)])
+            expected[key] = value
+            tree.work(5)
+        tree.work()
+        self.assertTrue(len(tree.levels) > 2)
+        for level in tree.levels[1:]:
+            for left, right in zip(level, level[1:]):
+                self.assertTrue(left.max_key < right.min_key)
+        for key, value in expected.items():
+            self.assertEqual(tree.get(key), value)
+        self.assertEqual(tree.get('missing'), None)
+        live = sorted((key, value) for key, value in expected.items() if value is not None)
+        self.assertEqual(list(tree.iterate('k', 'l')), live)
+        self.assertEqual(list(tree.iterate('k010', 'k019')), [pair for pair in live if 'k010' <= pair[0] <= 'k019'])
+
+    def test_recovery(self):
+        tree = self.open()
+        for i in range(25):
+            tree.write(i, [('k%02d' % i, str(i))])
+            tree.work(3)
+        tree.write(25, [('k00', None)])
+        tree.sync()
+        # Crash in the middle of a job, without closing the tree
+        tree = self.open()
+        self.assertEqual(tree.get('k00'), None)
+        self.assertEqual(list(tree.iterate('k', 'l')), [('k%02d' % i, str(i)) for i in range(1, 25)])
+        self.assertEqual(sorted(os.listdir(self._path)), sorted(['MANIFEST'] + ['%06d.%s' % (table.number, 'sst') for level in tree.levels for table in level] + ['%06d.log' % (number) for number in tree._logs]))
+
+class LSMKVStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'lsm')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_abort(self):
+        store = LSMKVStore(self._path, memtable_size=2, fsync=False)
+        for xid, key in enumerate(['a', 'b', 'c']):
+            store.put(key, '0')
+            store.commit(xid, {key: '0'})
+            store.flush()
+        store.put('a', '1')
+        store.put('d', '1')
+        self.assertEqual(store.scan('a', 'z'), [('a', '1'), ('b', '0'), ('c', '0'), ('d', '1')])
+        store.put('d', None)                            # Undone
+        store.put('a', '0')
+        self.assertEqual(store._dirty, {})
+        store.close()
+        store = LSMKVStore(self._path, fsync=False)
+        self.assertEqual(store.scan('a', 'z'), [('a', '0'), ('b', '0'), ('c', '0')])
+        store.close()
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_round_trip(self):
+        data = dict(('k%d' % (i), 'v%d' % (i)) for i in range(1000))
+        data['gone'] = None
+        self.assertEqual(write_snapshot(self._path, data, {'k1': None, 'k2': 'x'}, fsync=False), 999)
+        del data['gone'], data['k1']
+        data['k2'] = 'x'
+        self.assertEqual(read_snapshot(self._path), data)
+        write_snapshot(self._path, {}, fsync=False)
+        self.assertEqual(read_snapshot(self._path), {})
+        self.assertRaises(ValueError, write_snapshot, self._path, {'a\0b': 'c'}, fsync=False)
+
+    def test_corruption(self):
+        write_snapshot(self._path, {'a': '1', 'b': '2'}, fsync=False)
+        with open(self._path, 'rb') as f:
+            contents = f.read()
+        for corrupt in [contents[:-1], contents[:-1] + b'3']:
+            with open(self._path, 'wb') as f:
+                f.write(corrupt)
+            self.assertRaises(ValueError, read_snapshot, self._path)
+
+    def test_checkpointer(self):
+        store = InMemoryKVStore()
+        store.load({'a': '1', 'b': '2'})
+        store.put('b', '3')                             # Uncommitted
+        checkpointer = Checkpointer(self._path, fsync=False)
+        self.assertTrue(checkpointer.start(lambda: (store.data(), {'b': '2'})))
+        checkpointer.wait()
+        self.assertEqual((checkpointer.written, checkpointer.failed), (1, 0))
+        loaded = MVCCKVStore()
+        loaded.load(read_snapshot(self._path))
+        self.assertEqual(loaded.scan('a', 'z'), [('a', '1'), ('b', '2')])
+
+class ReplicationTest(unittest.TestCase):
+    def test_commit_log(self):
+        log = CommitLog(InMemoryKVStore(), retain=2)
+        for xid, key in enumerate(['a', 'b', 'c']):
+            log.put(key, str(xid))
+            log.commit(xid, {key: str(xid)})
+        log.commit(3, {})                               # Read-only, not logged
+        self.assertEqual(log.seq, 3)
+        self.assertEqual(log.get('c'), '2')
+        self.assertEqual([entry[0] for entry in log.since(1)], [2, 3])
+        self.assertEqual(log.since(3), [])
+        self.assertEqual(log.since(0), None)            # Entry 1 was dropped
+
+    def test_replica(self):
+        loop = EventLoop()
+        replica = Replica(loop, MVCCKVStore(), os.path.join(tempfile.gettempdir(), 'no_primary'), logging.CRITICAL)
+        self.assertFalse(replica.is_connected())
+        store = replica.store
+        # A copy of the store, sent in two parts, then entries decoded as the
+        # connection would
+        replica.apply({'epoch': 7, 'seq': 2, 'snapshot': [['a', '1']], 'done': False})
+        self.assertEqual(store.get('a'), None)
+        replica.apply({'epoch': 7, 'seq': 2, 'snapshot': [['b', '2']], 'done': True})
+        before = store.snapshot()
+        replica.apply(json.loads(json.dumps({'seq': 4, 'entries': [[3, 0, {'a': '3', 'c': '3'}], [4, 0, {'b': None}]]})))
+        self.assertEqual((replica.epoch, replica.applied_seq, replica.primary_seq), (7, 4, 4))
+        self.assertEqual(store.scan_version('a', 'z', before), [('a', '1'), ('b', '2')])
+        self.assertEqual(store.scan('a', 'z'), [('a', '3'), ('c', '3')])
+        store.release_snapshot(before)
+        self.assertRaises(KVStoreError, replica.apply, {'seq': 6, 'entries': [[6, 0, {'a': '6'}]]})
+        # A new copy replaces everything
+        replica.apply({'epoch': 8, 'seq': 1, 'snapshot': [['d', '1']], 'done': True})
+        self.assertEqual(store.scan('a', 'z'), [('d', '1')])
+        self.assertEqual(replica.snapshot()['lag']['count'], 2)
+        loop.close()
+
+    def test_catch_up_copies_data(self):
+        # Data in the store before the log, as recovered or loaded at start
+        store = InMemoryKVStore()
+        store.load({'a': '0', 'b': '0'})
+        log = CommitLog(store)
+        log.put('c', '1')
+        log.commit(0, {'c': '1'})
+        log.put('a', 'uncommitted')
+
+        class Follower(object):
+            copied_seq = 0
+            sent_seq = None
+
+            def __init__(self):
+                self.messages = []
+
+            def send_message(self, message):
+                self.messages.append(json.loads(json.dumps(message)))
+
+            def send_entries(self, entries, seq):
+                self.send_message({'seq': seq, 'entries': entries})
+
+            def fail(self, message):
+                self.send_message({'error': message})
+
+        loop = EventLoop()
+        directory = tempfile.mkdtemp()
+        try:
+            primary = Primary(loop, listen(os.path.join(directory, 'primary')), log, logging.CRITICAL,
+                              lambda: (store.data(), {'a': '0'}))
+            follower = Follower()
+            primary.catch_up(follower, 0, 0)
+            replica = Replica(loop, MVCCKVStore(), os.path.join(directory, 'no_primary'), logging.CRITICAL)
+            for message in follower.messages:
+                replica.apply(message)
+            self.assertEqual(replica.store.scan('a', 'z'), [('a', '0'), ('b', '0'), ('c', '1')])
+            self.assertEqual(replica.applied_seq, 1)
+            primary.close()
+            # Without a way to copy the store, the replica is refused
+            primary = Primary(loop, listen(os.path.join(directory, 'primary2')), log, logging.CRITICAL)
+            follower = Follower()
+            primary.catch_up(follower, 0, 0)
+            self.assertEqual(list(follower.messages[0]), ['error'])
+            primary.close()
+        finally:
+            loop.close()
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
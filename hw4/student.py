@@ -1,30 +1,45 @@
 import logging
 
-from kvstore import DBMStore, InMemoryKVStore
+from kvstore import DBMStore, DurableKVStore, InMemoryKVStore, LSMKVStore, MVCCKVStore
+from locktable import (COMPATIBLE, DETECT, EXCLUSIVE, INTENTION_EXCLUSIVE, INTENTION_SHARED, SHARED, TABLE,
+                       TIMEOUT, WAIT_DIE, WOUND_WAIT, LockEntry, LockTable, covers, supremum)
+from locktrace import ABORT, CANCEL, COMMIT, CONVERT, GRANT, RELEASE, WAIT
 
 LOG_LEVEL = logging.WARNING
 
 KVSTORE_CLASS = InMemoryKVStore
 
+# Number of key locks a transaction may hold before they are escalated to a
+# single table lock. None disables escalation.
+ESCALATION_THRESHOLD = 1000
+
 """
 Possible abort modes.
 """
 USER = 0
 DEADLOCK = 1
+VALIDATION = 2
 
 """
 Part I: Implementing request handling methods for the transaction handler
 
 The transaction handler has access to the following objects:
 
-self._lock_table: the global lock table. More information in the README.
+self._lock_table: the global lock table, a locktable.LockTable mapping each
+key, and the table-level resource locktable.TABLE, to a locktable.LockEntry.
+It also holds the waits-for graph, which the handler keeps up to date as it
+queues, grants and releases locks. More information in the README.
 
-self._acquired_locks: a list of locks acquired by the transaction. Used to
-release locks when the transaction commits or aborts. This list is initially
-empty.
+self._acquired_locks: a dict mapping each key (or TABLE) locked by the
+transaction to the mode of its lock. Used to release locks when the
+transaction commits or aborts. This dict is initially empty.
 
 self._desired_lock: the lock that the transaction is waiting to acquire as well
-as the operation to perform. This is initialized to None.
+as the operation to perform, as a tuple (key, mode, method, args). This is
+initialized to None.
+
+self._on_grant: called with no arguments when a lock the transaction is waiting
+for is granted by another transaction's commit or abort, or None.
 
 self._xid: this transaction's ID. You may assume each transaction is assigned a
 unique transaction ID.
@@ -36,24 +51,66 @@ self._undo_log: a list of undo operations to be performed when the transaction
 is aborted. The undo operation is a tuple of the form (@key, @value). This list
 is initially empty.
 
+self._snapshot: for a read-only transaction, the timestamp of the snapshot of
+the store that it reads, without taking locks. None for other transactions.
+
+self._trace: called as self._trace(event, xid, key, mode) for every change the
+transaction makes to the lock table, or None. See locktrace.py.
+
+self.priority: the priority of the transaction, 0 unless set by the client
+with PRIORITY. Only used by a GrantScheduler with priorities.
+
+self._bypassed: the number of conflicting requests granted or placed ahead of
+the request this transaction waits for. Kept by the GrantScheduler, for aging.
+
 You may assume that the key/value inputs to these methods are already type-
 checked and are valid.
 """
 
 class TransactionHandler:
 
-    def __init__(self, lock_table, xid, store):
-        # Lock table, value = list of 2 things
-            # First = list of tuples, (xid, lock)
-            # 2nd = FIFO queue for the id
+    def __init__(self, lock_table, xid, store, on_grant=None, tracer=None):
+        # Lock table maps each key to a locktable.LockEntry
         self._lock_table = lock_table
-        self._acquired_locks = []
+        # Maps each key locked by this transaction (and TABLE) to the mode of
+        # the lock
+        self._acquired_locks = {}
         self._desired_lock = None
         self._xid = xid
         self._store = store
         self._undo_log = []
+        self._on_grant = on_grant
+        self._snapshot = None
+        self._trace = tracer
+        self.priority = 0
+        self._bypassed = 0
+
+    def waiting_for(self):
+        """
+        @return: the key (or TABLE) whose lock the transaction is waiting
+        for, or None.
+        """
+        if self._desired_lock is None:
+            return None
+        return self._desired_lock[0]
 
-        # self._queue_table = {} # Added, myself.
+    def begin_read_only(self):
+        """
+        Makes this a read-only transaction, which reads a snapshot of the
+        committed state of the store instead of taking locks. Readers never
+        block writers, and writers never block readers. The store must keep
+        versions, like kvstore.MVCCKVStore.
+
+        @return: 'Read-only transaction started', or an error message if the
+        store does not keep versions or the transaction has already run a
+        command.
+        """
+        if not hasattr(self._store, 'snapshot'):
+            return 'Store does not support snapshots'
+        if self._acquired_locks or self._desired_lock is not None or self._snapshot is not None:
+            return 'Transaction already started'
+        self._snapshot = self._store.snapshot()
+        return 'Read-only transaction started'
 
     def perform_put(self, key, value):
         """
@@ -75,109 +132,158 @@ class TransactionHandler:
         @return: if the transaction successfully acquires the lock and performs
         the insertion/update, returns 'Success'. If the transaction cannot
         acquire the lock, returns None, and saves the lock that the transaction
-        is waiting to acquire in self._desired_lock.
+        is waiting to acquire in self._desired_lock. If the transaction is
+        read-only, returns 'Read-only transaction'.
         """
-        # Part 1.1: your code here!
-
-	    # Acquire exclusive lock (includes if you already have the X lock).
+        if self._snapshot is not None:
+            return 'Read-only transaction'
         if not self.acquire_Xlock(key):
-            self._desired_lock = (key, value, "X")
+            self._desired_lock += (self.perform_put, (key, value))
             return None
-	 
-
-	    # If got lock, can insert pair into store.
 
-        # Need to grab old values!
         old_value = self._store.get(key)
-
         self._store.put(key, value)
-
-        # Update undo log
         self._undo_log.append((key, old_value))
-        
-        #print("end of put, lock_table = " + str(self._lock_table))
         return 'Success'
 
-
     def acquire_Xlock(self, key):
         """
-        Acquires exclusive lock, if possible. 
+        Acquires exclusive lock on key, after an IX lock on the table, unless
+        the transaction already holds X on the whole table.
 
         @param self: the transaction handler
         @param key: key to acquire lock for
-        @return: True if Xlock acquired. False if not. 
+        @return: True if Xlock acquired. False if not.
+        """
+        if self.has_lock(TABLE) == EXCLUSIVE:
+            return True
+        if not self.acquire_lock(TABLE, INTENTION_EXCLUSIVE):
+            return False
+        if self.has_lock(key) != EXCLUSIVE and self.escalate(EXCLUSIVE):
+            return True
+        return self.acquire_lock(key, EXCLUSIVE)
+
+    def acquire_lock(self, key, mode):
+        """
+        Acquires a lock on key in mode, converting any lock already held to
+        cover both. The scheduler of the lock table decides whether the
+        request is granted now or waits, and where in the queue. By default,
+        a new request is granted if it is compatible with the holders and
+        nobody is queued; otherwise it waits at the back of the queue. A
+        conversion is granted if it is compatible with the other holders;
+        otherwise it waits at the front of the queue. The requests queued
+        behind a waiting request also wait for it, if they conflict.
+
+        @return: True if the lock was acquired. False if not, in which case
+        the request is saved in self._desired_lock.
         """
-        # If already have lock, done.
         own_lock = self.has_lock(key)
-        if own_lock is not None and own_lock[1] == "X":
-            print("1")
+        if covers(own_lock, mode):
             return True
+        mode = supremum(own_lock, mode)
 
-        # If no one locking it, OR you're the only one locking it, just get it. 
-        if key not in self._lock_table:
-            self._lock_table[key] = [[(self._xid, "X")], []]
-            self._acquired_locks.append((key, "X"))
+        lock_table = self._lock_table
+        entry = lock_table.get(key)
+        if entry is None:
+            entry = self.fast_lock(key, mode)
+            if entry is None:
+                return True
+        scheduler = lock_table.scheduler
+        if scheduler.grant_now(entry, self, mode, own_lock is not None):
+            entry.grant(self._xid, mode)
+            self._acquired_locks[key] = mode
+            if self._trace is not None:
+                self._trace(GRANT, self._xid, key, mode)
+            # The queued requests that conflict with the new mode now wait
+            # for us
+            self.wait_behind(entry, mode)
             return True
-        if len(self._lock_table[key][0]) == 0:
-            print("2")
-            self._lock_table[key][0] = [(self._xid, "X")]
-            self._acquired_locks.append((key, "X"))
-            return True  
-
-        # Only one looking
-        lt_entry = self._lock_table[key][0] # List 
-        if len(lt_entry) == 1 and lt_entry[0][0] == self._xid:
-            print("3")
-            #lt_entry = [(self._xid, "X")]
-            self._lock_table[key][0] = [(self._xid, "X")]
-            self.upgrade_lock(key)
-            return True 
-	     
-        
-        # curr_queue = []
-        # if key in self._queue_table:
-        #     curr_queue = self._queue_table[key]
-        curr_queue = self._lock_table[key][1]
-
-        # If you want to upgrade, but other shares, cut queue.
-        if len(lt_entry) > 1 and own_lock is not None and own_lock[1] == "S":
-            print("4")
-            self._lock_table[key][1] = [(self._xid, "X")] + curr_queue
-            return False
 
-        # Else, just get in the queue.
-        print("5")
-        self._lock_table[key][1] = curr_queue + [(self._xid, "X")]
+        position = scheduler.place(entry, self, mode, own_lock is not None)
+        lock_table.wait_for(self._xid, entry.blockers(self._xid, mode, position))
+        self.wait_behind(entry, mode, position)
+        entry.enqueue(self, mode, position)
+        if self._trace is not None:
+            self._trace(WAIT if own_lock is None else CONVERT, self._xid, key, mode)
+        self._desired_lock = (key, mode)
         return False
 
-    def has_lock(self, key):
+    def fast_lock(self, key, mode):
         """
-        Returns lock, if has it.
+        Called when key has no LockEntry. An S lock on a key that nobody has
+        locked is recorded in lock_table.sole_readers only. Otherwise, the
+        entry is created, with the sole reader of the key, if any, as its
+        holder.
 
-        @return: lock, if has it. None if does not. 
-        
+        @return: the new entry, or None if the lock was granted without one.
         """
-        for i in range(len(self._acquired_locks)):
-            if self._acquired_locks[i][0] == key:
-                return self._acquired_locks[i]
-        return None
+        lock_table = self._lock_table
+        readers = lock_table.sole_readers
+        if readers is None:
+            entry = lock_table[key] = LockEntry()
+            return entry
+        reader = readers.pop(key, None)
+        if reader is None and mode == SHARED:
+            readers[key] = self._xid
+            self._acquired_locks[key] = SHARED
+            if self._trace is not None:
+                self._trace(GRANT, self._xid, key, SHARED)
+            return None
+        entry = lock_table[key] = LockEntry()
+        if reader is not None:
+            entry.grant(reader, SHARED)
+        return entry
 
+    def wait_behind(self, entry, mode, position=0):
+        """
+        Makes the requests queued on entry from position on that conflict
+        with mode wait for this transaction.
+        """
+        allowed = COMPATIBLE[mode]
+        for txn, lock_type in entry.queue[position:]:
+            if lock_type not in allowed:
+                self._lock_table.wait_for(txn._xid, [self._xid])
 
-    def upgrade_lock(self, key):
-        """ 
-        Updates self._acquired_locks, from "S" to "X"
+    def escalate(self, mode):
+        """
+        Once the transaction holds escalation_threshold key locks, replaces
+        them with a single lock on the table: X if the transaction writes, S
+        otherwise (or SIX, if it also holds IX). Escalation never waits; if the
+        table lock cannot be granted right away, we keep locking keys. Nor does
+        it go ahead of a conflicting request queued for the table, which it
+        could otherwise starve.
+
+        @return: True if the table lock now covers mode on every key.
+        """
+        threshold = self._lock_table.escalation_threshold
+        if threshold is None or len(self._acquired_locks) <= threshold:
+            return False
+        if mode != EXCLUSIVE and EXCLUSIVE in self._acquired_locks.values():
+            mode = EXCLUSIVE
+        table_mode = supremum(self.has_lock(TABLE), mode)
+        entry = self._lock_table[TABLE]
+        if entry.blockers(self._xid, table_mode):
+            return False
 
+        entry.grant(self._xid, table_mode)
+        if self._trace is not None:
+            self._trace(GRANT, self._xid, TABLE, table_mode)
+        self.wait_behind(entry, table_mode)
+        for key in [key for key in self._acquired_locks if key != TABLE]:
+            del self._acquired_locks[key]
+            self.release_lock(key)
+        self._acquired_locks[TABLE] = table_mode
+        return True
+
+    def has_lock(self, key):
+        """
+        @return: the mode of the lock this transaction holds on key, or None
+        if it does not hold one.
         """
-        for i in range(len(self._acquired_locks)):
-            #print("here" + str(self._acquired_locks[i][0]))
-            #print("here2" + str(self._acquired_locks[i][1]))
-            if self._acquired_locks[i][0] == key and self._acquired_locks[i][1] == "S":
-                self._acquired_locks[i] = (key, "X")
-                #print("aftermath " + str(self._acquired_locks[i][1]))
-                return 
+        return self._acquired_locks.get(key)
 
     def perform_get(self, key):
-        """ 
+        """
         Handles the GET request. You should first implement the logic for
         acquiring the shared lock. If the transaction can successfully acquire
         the lock associated with the key, read the value from the store.
@@ -192,103 +298,112 @@ class TransactionHandler:
         the value, returns the value. If the key does not exist, returns 'No
         such key'. If the transaction cannot acquire the lock, returns None,
         and saves the lock that the transaction is waiting to acquire in
-        self._desired_lock.
+        self._desired_lock. A read-only transaction reads its snapshot and never
+        blocks.
         """
-        # Part 1.1: your code here!
-        
-        
-        # Acquire shared lock
-
-        # If doesn't work, put in desired lock!!!!
-
-        if not self.acquire_Slock(key):
-            self._desired_lock = (key, None, "S")
-            #print("get unsuccessful, lock_table = " + str(self._lock_table))
-            return None 
+        if self._snapshot is not None:
+            value = self._store.get_version(key, self._snapshot)
+        elif self.acquire_Slock(key):
+            value = self._store.get(key)
+        else:
+            self._desired_lock += (self.perform_get, (key,))
+            return None
 
-        #print("end of get, lock_table = " + str(self._lock_table))
-        
-        value = self._store.get(key)
         if value is None:
             return 'No such key'
         return value
 
-
-
     def acquire_Slock(self, key):
         """
-        Acquires shared lock, if possible. 
-
-        @return: True if Slock acquired. False if not. 
+        Acquires shared lock on key, after an IS lock on the table, unless the
+        transaction already holds a table lock that covers reading every key.
+        Any lock already held on the key is good enough for a read.
 
+        @return: True if Slock acquired. False if not.
         """
-        # If already have lock, done
-        #print("line 226, lock_table = " + str(self._lock_table))
-        own_lock = self.has_lock(key)
-        if own_lock is not None:
-            print("A")
-            return True
-
-        # No downgrades allowed! 
-
-        # If no one locking it, good.
-        if key not in self._lock_table:
-            print("B")
-            #print("key not in self._lock_table!")
-            self._lock_table[key] = [[(self._xid, "S")], []]
-            self._acquired_locks.append((key, "S"))
-            return True
-        if len(self._lock_table[key][0]) == 0:
-            self._lock_table[key][0] = [(self._xid, "S")]
-            self._acquired_locks.append((key, "S"))
+        if covers(self.has_lock(TABLE), SHARED):
             return True
-
-        # If someone has an exclusive lock on it, off. 
-
-        # curr_queue = []
-        # if key in self._queue_table:
-        #     curr_queue = self._queue_table[key]
-
-        curr_queue = self._lock_table[key][1]
-        if self.exists_Xlock(key):
-            # Put self in queue
-            print("C")
-            #print("lock_table = " + str(self._lock_table))
-            self._lock_table[key][1].append((self._xid, "S"))
-            #print("post, lock_table = " + str(self._lock_table))
+        if not self.acquire_lock(TABLE, INTENTION_SHARED):
             return False
-        
-
-        # Else, everyone on it has a shared lock; join in.
-        #print("everyone has a shared lock; appending " + str((self._xid, "S"))
-        #flag = 0
-        #if key in self._lock_table:
-            #flag = 1
-        #print(flag)
-        self._lock_table[key][0].append((self._xid, "S"))
-        print("D")
-        # self._lock_table[key] = self._lock_table[key] + [(self._xid, "S")]
-        #print("Now lock_table looks like " + str(self._lock_table[key]))
-        self._acquired_locks.append((key, "S"))
-        return True
-        
+        if self.has_lock(key) is None and self.escalate(SHARED):
+            return True
+        return self.acquire_lock(key, SHARED)
 
-    def exists_Xlock(self, key):
-        lock_list = self._lock_table[key][0]
-        #print("lock_list = " + str(lock_list))
-        for i in range(len(lock_list)):
-            if lock_list[i][1] == "X":
-                return True
+    def perform_scan(self, low, high):
+        """
+        Handles the SCAN request, which reads every key between low and high
+        (inclusive) under a single S lock on the table instead of one lock per
+        key. The table lock also keeps other transactions from inserting keys
+        into the range.
+
+        @return: the keys and values in the range, in key order, as
+        'key value key value ...'. If there are none, returns 'No such key'.
+        If the transaction cannot acquire the lock, returns None, and saves
+        the lock that the transaction is waiting to acquire in
+        self._desired_lock.
+        """
+        if self._snapshot is not None:
+            pairs = self._store.scan_version(low, high, self._snapshot)
+        elif self.acquire_lock(TABLE, SHARED):
+            pairs = self._store.scan(low, high)
+        else:
+            self._desired_lock += (self.perform_scan, (low, high))
+            return None
 
-        return False
+        if not pairs:
+            return 'No such key'
+        return ' '.join('%s %s' % pair for pair in pairs)
 
-    
+    def perform_mget(self, keys):
+        """
+        Handles the MGET request, which reads several keys in one step. All of
+        the shared locks are acquired before any key is read; if one of them
+        cannot be acquired, the locks acquired so far are kept, and the whole
+        request runs again once the lock is granted.
+
+        @return: the values of the keys, in order, one per line, with 'No such
+        key' for the keys that do not exist. If the transaction cannot acquire
+        a lock, returns None, and saves the lock that the transaction is
+        waiting to acquire in self._desired_lock.
+        """
+        if self._snapshot is not None:
+            values = [self._store.get_version(key, self._snapshot) for key in keys]
+        else:
+            for key in keys:
+                if not self.acquire_Slock(key):
+                    self._desired_lock += (self.perform_mget, (keys,))
+                    return None
+            values = [self._store.get(key) for key in keys]
+        return '\n'.join('No such key' if value is None else value for value in values)
+
+    def perform_mput(self, pairs):
+        """
+        Handles the MPUT request, which writes a list of (key, value) pairs in
+        one step. All of the exclusive locks are acquired before any key is
+        written, as in perform_mget(), so the request is never half done.
+
+        @return: 'Success' once every pair has been written. If the
+        transaction cannot acquire a lock, returns None, and saves the lock
+        that the transaction is waiting to acquire in self._desired_lock. If
+        the transaction is read-only, returns 'Read-only transaction'.
+        """
+        if self._snapshot is not None:
+            return 'Read-only transaction'
+        for key, _ in pairs:
+            if not self.acquire_Xlock(key):
+                self._desired_lock += (self.perform_mput, (pairs,))
+                return None
+
+        for key, value in pairs:
+            self._undo_log.append((key, self._store.get(key)))
+            self._store.put(key, value)
+        return 'Success'
 
     def release_and_grant_locks(self):
         """
         Releases all locks acquired by the transaction and grants them to the
         next transactions in the queue. This is a helper method that is called
-        during transaction commits or aborts. 
+        during transaction commits or aborts.
 
         Hint: you can use self._acquired_locks to get a list of locks acquired
         by the transaction.
@@ -296,153 +411,89 @@ class TransactionHandler:
 
         @param self: the transaction handler.
         """
+        lock_table = self._lock_table
+        if self._desired_lock is not None:
+            # Aborted while blocked. A lock granted before check_lock() was
+            # called is already in self._acquired_locks.
+            key, lock_type = self._desired_lock[:2]
+            if not self.granted_lock(key, lock_type):
+                entry = lock_table[key]
+                entry.dequeue(self, lock_type)
+                if self._trace is not None:
+                    self._trace(CANCEL, self._xid, key, lock_type)
+                lock_table.stop_waiting(self._xid)
+                for txn, _ in entry.queue:
+                    lock_table.stop_waiting_for(txn._xid, self._xid)
+                self.grant_to_queue(key)
+            self._desired_lock = None
 
-        print("releasing locks")
-        print("prev, lock_table = " + str(self._lock_table))
-        for l in self._acquired_locks:
-            #print("acquired lock = " + str(l))
-             # Part 1.2: your code here!
-            
-            # I...I don't think lock upgrade matters? 
-            key = l[0]
-            lock_type = l[1]
-                                
-            # Gotta delete self from the lock table
-            locks_for_key = self._lock_table[key][0]
-            for i in range(len(locks_for_key)):
-                #print(locks_for_key[i][0])
-                #print(locks_for_key[i][1])
-                if locks_for_key[i][0] == self._xid and locks_for_key[i][1] == lock_type:
-                    #print("xid = " + str(self._xid))
-                    #print("type = " + lock_type)
-                    self._lock_table[key][0].pop(i)
-                    break
-
-
-            # And grant to next in queue.
-            print("about to grant to queue")
-            #print("queue right now is " + str(self._queue_table))
-            self.grant_to_queue(key)
-                   
-            print("granted, lock_table = " + str(self._lock_table))
-
-        self._acquired_locks = []
-
-        # UPDATE SELF.ACQUIREDLOCKS jk no -_____-
-
+        for key in self._acquired_locks:
+            self.release_lock(key)
+        self._acquired_locks = {}
+        lock_table.end_transaction(self._xid)
+        if self._snapshot is not None:
+            self._store.release_snapshot(self._snapshot)
+            self._snapshot = None
 
-    def grant_to_queue(self, key):
-        #print("key = " + key)
-        #print(str(self._queue_table))
-        # If nothing in queue, done. 
-        #if key not in self._queue_table:
-        #print ("KEY EXISTS? " + str((key in self._lock_table)))
-        #print("self._lock_table = " + str(self._lock_table))
-        if len(self._lock_table[key][1]) == 0:
-            print("342")
+    def release_lock(self, key):
+        """
+        Releases this transaction's lock on key and grants it to the queue.
+        """
+        entry = self._lock_table.get(key)
+        if entry is None:
+            # Granted by fast_lock(), and nobody else came
+            del self._lock_table.sole_readers[key]
+            if self._trace is not None:
+                self._trace(RELEASE, self._xid, key)
             return
+        entry.release(self._xid)
+        if self._trace is not None:
+            self._trace(RELEASE, self._xid, key)
+        for txn, _ in entry.queue:
+            self._lock_table.stop_waiting_for(txn._xid, self._xid)
+        self.grant_to_queue(key)
 
-        # If desired_lock gets out of queue, delete desired_lock. 
-
-        # And don't forget to update lock_table, acquired_lock, queue_table.
-
-        # new_acquired_locks = [] 
-        
-        # Def gotta grant to first in queue
-        # Only if existing stuff in locks, allows it tho. 
-        try_more = 0
-        queue = self._lock_table[key][1]
-        #print("queue in grant to queue = " + str(queue))
-        first_in_queue = queue[0]
-        if first_in_queue[1] == "S":
-            print("358")
-            # The first one, must be able to grant S. 
-            self.successful_queue_removal(first_in_queue[0], key, "S", 0)
-            try_more = 1
-        else:
-            print("363")
-            #print("first in queue is X")
-            # Gotta check if can get the X.  
-            if self.queue_acquire_Xlock(key, first_in_queue[0]):
-                print("367")
-                self.successful_queue_removal(first_in_queue[0], key, "X", 0)
-        
-                
-        # If granted to an S lock, can maybe grant more too
-        if try_more:
-            i = 1
-            while i < len(queue) and queue[i][1] == "S":
-                if queue_acquire_Slock(key, queue[i][0]):
-                    self.successful_queue_removal(queue[i][0], key, "S", i)
-                else:
-                    break
-                i = i + 1
-        
-
-
-    
-    def queue_acquire_Xlock(self, key, xid):
-        
-        
-        # No one locking it
-        if key not in self._lock_table or len(self._lock_table[key][0]) == 0:
-            return True
-        
-        # Or you're the only one locking it
-        print("392, lock_table = " + str(self._lock_table))
-        lt_entry = self._lock_table[key][0]
-        #print("len = " + len(lt_entry))
-        #print("curr_id = " + lt_entry[0][0])
-        print("len = " + str(len(lt_entry)))
-        print("xid = " + str(xid))
-        print("lt_entry stuff = " + str(lt_entry[0][0]))
-        if len(lt_entry) == 1 and lt_entry[0][0] == xid:
-            print("396")
-            #print("should be going in here")
-            # Remove the S lock from lock_table. Acquired_locks done later.
-            self._lock_table[key][0] = []
-            return True
-
-        # Can't have someone with an X lock, b/c releasing. 
-
-        # If other shares, no.
-        return False 
-        
-            
-
-    def queue_acquire_Slock(self, key, xid):
-        # If already have lock, I guess you're okay...
-        # Actually, don't think would happen
-        
-        
-        # If no one locking it, good.
-        if key not in self._lock_table or len(self._lock_table[key][0]) == 0:
-            return True
-
-        # If someone has an exclusive lock, no. 
-        if self.exists_Xlock(key):
-            return False
-
-        # Else, everyone has shared lock, join in. 
-        return True 
-         
-            
-
-    def successful_queue_removal(self, xid, key, lock_type, queue_pos):
-        # Add to lock_table
-        self._lock_table[key][0].append((xid, lock_type))
-
-        # Add to new_acquired_locks - jK NO
-        # acquisitions.append((self._xid, lock_type)
-        
-        # Fix queue
-        queue = self._lock_table[key][1]
-        queue.pop(queue_pos)
-        
-        
+    def grant_to_queue(self, key):
+        """
+        Grants the lock on key to the requests in its queue that the
+        scheduler picks: by default, the longest prefix of the queue that is
+        compatible with the holders. The transactions still waiting now also
+        wait for the new holders they conflict with. An entry left with no
+        holders and nobody waiting is removed from the lock table, unless it
+        is the entry of TABLE.
+        """
+        entry = self._lock_table[key]
+        queue = entry.queue
+        scheduler = self._lock_table.scheduler
+        granted = []
+        index = scheduler.next_grant(entry, 0)
+        while index is not None:
+            txn, lock_type = queue.pop(index)
+            self.successful_queue_removal(txn, key, lock_type)
+            granted.append(txn._xid)
+            index = scheduler.next_grant(entry, index)
+        if granted:
+            for txn, lock_type in queue:
+                allowed = COMPATIBLE[lock_type]
+                self._lock_table.wait_for(txn._xid, [xid for xid in granted if entry.mode_of(xid) not in allowed])
+        elif entry.is_unused() and key != TABLE:
+            del self._lock_table[key]
+
+    def successful_queue_removal(self, txn, key, lock_type):
+        """
+        Grants a dequeued request to the waiting transaction txn, and notifies
+        it so that it does not have to poll check_lock().
+        """
+        self._lock_table[key].grant(txn._xid, lock_type)
+        if self._trace is not None:
+            self._trace(GRANT, txn._xid, key, lock_type)
+        self._lock_table.stop_waiting(txn._xid)
+        txn.update_acquired_locks(key, lock_type)
+        if txn._on_grant is not None:
+            txn._on_grant()
 
     def commit(self):
-        """                     
+        """
         Commits the transaction.
 
         Note: This method is already implemented for you, and you only need to
@@ -452,9 +503,24 @@ class TransactionHandler:
 
         @return: returns 'Transaction Completed'
         """
+        if self._trace is not None:
+            self._trace(COMMIT, self._xid, TABLE)
+        if self._undo_log:
+            self._store.commit(self._xid, dict((key, self._store.get(key)) for key, _ in self._undo_log))
         self.release_and_grant_locks()
         return 'Transaction Completed'
 
+    def uncommitted(self):
+        """
+        @return: a dict mapping each key the transaction has written to its
+        committed value (None if the key does not exist), for a checkpoint
+        of the committed state.
+        """
+        before = {}
+        for key, value in self._undo_log:
+            before.setdefault(key, value)
+        return before
+
     def abort(self, mode):
         """
         Aborts the transaction.
@@ -463,115 +529,202 @@ class TransactionHandler:
         implement the subroutine release_locks().
 
         @param self: the transaction handler.
-        @param mode: mode can either be USER or DEADLOCK. If mode == USER, then
-        it means that the abort is issued by the transaction itself (user
+        @param mode: mode can be USER, DEADLOCK or VALIDATION. If mode == USER,
+        then it means that the abort is issued by the transaction itself (user
         abort). If mode == DEADLOCK, then it means that the transaction is
-        aborted by the coordinator due to deadlock (deadlock abort).
+        aborted by the coordinator due to deadlock (deadlock abort). If mode ==
+        VALIDATION, then it means that an optimistic transaction failed
+        validation at commit (see OptimisticTransactionHandler).
 
         @return: if mode == USER, returns 'User Abort'. If mode == DEADLOCK,
-        returns 'Deadlock Abort'.
+        returns 'Deadlock Abort'. If mode == VALIDATION, returns 'Validation
+        Abort'.
         """
+        if self._trace is not None:
+            self._trace(ABORT, self._xid, TABLE)
         while (len(self._undo_log) > 0):
             k,v = self._undo_log.pop()
             self._store.put(k, v)
         self.release_and_grant_locks()
         if (mode == USER):
             return 'User Abort'
+        elif (mode == VALIDATION):
+            return 'Validation Abort'
         else:
             return 'Deadlock Abort'
 
     def check_lock(self):
         """
-        If perform_get() or perform_put() returns None, then the transaction is
-        waiting to acquire a lock. This method is called periodically to check
-        if the lock has been granted due to commit or abort of other
-        transactions. If so, then this method returns the string that would 
-        have been returned by perform_get() or perform_put() if the method had
-        not been blocked. Otherwise, this method returns None.
+        If one of the perform_*() methods returns None, then the transaction
+        is waiting to acquire a lock. Once the lock has been granted due to
+        commit or abort of other transactions, self._on_grant is called, and
+        the server handler calls this method. It may also be called while the
+        lock is still pending. If the lock has been granted,
+        then this method returns the string that would have been returned by
+        the blocked method if it had not been blocked. Otherwise, this method
+        returns None.
 
         As an example, suppose Joe is trying to perform 'GET a'. If Nisha has an
         exclusive lock on key 'a', then Joe's transaction is blocked, and
-        perform_get() returns None. Joe's server handler starts calling
-        check_lock(), which keeps returning None. While this is happening, Joe
+        perform_get() returns None. Joe's server handler goes idle while Joe
         waits patiently for the server to return a response. Eventually, Nisha
-        decides to commit his transaction, releasing his exclusive lock on 'a'.
-        Now, when Joe's server handler calls check_lock(), the transaction
-        checks to make sure that the lock has been acquired and returns the
-        value of 'a'. The server handler then sends the value back to Joe.
-
-        Hint: self._desired_lock contains the lock that the transaction is
-        waiting to acquire.
-        Hint: remember to update the self._acquired_locks list if the lock has
-        been granted.
-        Hint: if the transaction has been granted an exclusive lock due to lock
-        upgrade, remember to clean up the self._acquired_locks list.
-        Hint: remember to update self._undo_log so that we can undo all the
-        changes if the transaction later gets aborted.
+        decides to commit his transaction, releasing his exclusive lock on 'a'
+        and granting it to Joe, which wakes up Joe's server handler. Now, when
+        Joe's server handler calls check_lock(), the transaction checks to make
+        sure that the lock has been acquired and returns the value of 'a'. The
+        server handler then sends the value back to Joe.
+
+        An operation may need more than one lock (the table intention lock and
+        the key lock), so after a grant, we run the blocked method again, which
+        may block on its next lock.
 
         @param self: the transaction handler.
 
         @return: if the lock has been granted, then returns whatever would be
-        returned by perform_get() and perform_put() when the transaction
-        successfully acquired the lock. If the lock has not been granted,
-        returns None.
+        returned by the blocked method when the transaction successfully
+        acquired its locks. If the lock has not been granted, or the method
+        blocked again, returns None.
         """
+        key, lock_type, operation, args = self._desired_lock
+        if not self.granted_lock(key, lock_type):
+            return None
 
-        key = self._desired_lock[0]
-        value = self._desired_lock[1]
-        lock_type = self._desired_lock[2]
-
-
-        if self.granted_lock(key, lock_type):
-            print("granted")
-            # Got the lock! 
-
-
-            # Update self.acquired_locks
-            self.update_acquired_locks(key, lock_type)
-
-            # Can get rid of desired_lock
-            self._desired_lock = None
+        self._desired_lock = None
+        return operation(*args)
 
-            if lock_type == "S":
-                return self.perform_get(key)
-            return self.perform_put(key, value)
+    def granted_lock(self, key, lock_type):
+        return self._lock_table[key].holds(self._xid, lock_type)
 
-        # Know if granted, if now contained in lock_tables. 
-        
-        # Update self.acquired_locks if granted! 
+    def update_acquired_locks(self, key, lock_type):
+        # Queued requests carry the mode the lock is converted to, so the new
+        # mode replaces any lock already held
+        self._acquired_locks[key] = lock_type
+
+
+class OptimisticTransactionHandler(TransactionHandler):
+    """
+    A transaction under optimistic concurrency control, used by the server in
+    optimistic mode instead of TransactionHandler. It takes no locks, so it
+    never waits and never deadlocks.
+
+    Reads go to the store, and the first read of each key records its version
+    (see LockTable.version()) in self._reads. Writes go to a private workspace,
+    self._writes, where the transaction's own reads find them, instead of the
+    store and self._undo_log. A SCAN also records the version of TABLE in
+    self._scan_version, so that a key inserted into or deleted from any range
+    it read is noticed.
+
+    commit() validates that none of those versions has changed, then writes
+    the workspace to the store. The server runs it without interruption, so
+    validation and writing are atomic. If validation fails, the transaction
+    is aborted and commit() returns 'Validation Abort'.
+
+    Read-only transactions read their snapshot, as in TransactionHandler.
+    """
+
+    def __init__(self, lock_table, xid, store, on_grant=None, tracer=None):
+        TransactionHandler.__init__(self, lock_table, xid, store, on_grant, tracer)
+        self._reads = {}
+        self._writes = {}
+        self._scan_version = None
+        self._scanned = False
+        lock_table.start_optimistic(xid)
+
+    def read(self, key):
+        if key in self._writes:
+            return self._writes[key]
+        if key not in self._reads:
+            self._reads[key] = self._lock_table.version(self._xid, key)
+        return self._store.get(key)
+
+    def begin_read_only(self):
+        if self._reads or self._writes or self._scanned:
+            return 'Transaction already started'
+        return TransactionHandler.begin_read_only(self)
 
-        # Possibly clean up, if lock upgrade
+    def perform_get(self, key):
+        if self._snapshot is not None:
+            return TransactionHandler.perform_get(self, key)
+        value = self.read(key)
+        if value is None:
+            return 'No such key'
+        return value
 
-        # Undo
+    def perform_put(self, key, value):
+        if self._snapshot is not None:
+            return 'Read-only transaction'
+        self._writes[key] = value
+        return 'Success'
 
+    def perform_mget(self, keys):
+        if self._snapshot is not None:
+            return TransactionHandler.perform_mget(self, keys)
+        values = [self.read(key) for key in keys]
+        return '\n'.join('No such key' if value is None else value for value in values)
+
+    def perform_mput(self, pairs):
+        if self._snapshot is not None:
+            return 'Read-only transaction'
+        for key, value in pairs:
+            self._writes[key] = value
+        return 'Success'
 
-        # Also, don't forget get rid of desired_lock if good. 
+    def perform_scan(self, low, high):
+        if self._snapshot is not None:
+            return TransactionHandler.perform_scan(self, low, high)
+        lock_table = self._lock_table
+        if not self._scanned:
+            self._scanned = True
+            self._scan_version = lock_table.version(self._xid, TABLE)
+        pairs = dict(self._store.scan(low, high))
+        for key in pairs:
+            if key not in self._writes and key not in self._reads:
+                self._reads[key] = lock_table.version(self._xid, key)
+        for key, value in self._writes.items():
+            if low <= key <= high:
+                pairs[key] = value
+        pairs = sorted(pair for pair in pairs.items() if pair[1] is not None)
+        if not pairs:
+            return 'No such key'
+        return ' '.join('%s %s' % pair for pair in pairs)
 
-        return None 
+    def validate(self):
+        """
+        @return: True if no key the transaction read, and no range it
+        scanned, has been written by a transaction that committed since.
+        """
+        lock_table = self._lock_table
+        for key, version in self._reads.items():
+            if lock_table.version(self._xid, key) != version:
+                return False
+        return not self._scanned or lock_table.version(self._xid, TABLE) == self._scan_version
 
-    def granted_lock(self, key, lock_type):
-        #print("want " + str(key) + ", " + lock_type)
-        lock_list = self._lock_table[key][0]
-        for l in lock_list:
-            #print("lock_list = " + str(l))
-            #print("queue = " + str(self._lock_table[key][1]))
-            if l[0] == self._xid and l[1] == lock_type:
-                #print("true")
-                return True
-        #print("false")
-        return False
+    def commit(self):
+        """
+        Validates the transaction, then writes its workspace to the store.
 
-    def update_acquired_locks(self, key, lock_type):
-        # Only edge case is upgrade, right? 
-        # Because won't go from X to S. If have X, can S. 
+        @return: 'Transaction Completed', or 'Validation Abort' if the
+        transaction failed validation and was aborted.
+        """
+        if not self.validate():
+            return self.abort(VALIDATION)
+        if self._trace is not None:
+            self._trace(COMMIT, self._xid, TABLE)
+        if self._writes:
+            inserted_or_deleted = False
+            store = self._store
+            for key, value in self._writes.items():
+                if (store.get(key) is None) != (value is None):
+                    inserted_or_deleted = True
+                store.put(key, value)
+            self._lock_table.set_versions(list(self._writes) + ([TABLE] if inserted_or_deleted else []))
+            store.commit(self._xid, self._writes)
+        self.release_and_grant_locks()
+        return 'Transaction Completed'
 
-        own_lock = self.has_lock(key) # Old lock
-        if lock_type == "X" and own_lock is not None and own_lock[1] == "S":
-            # Upgrade
-            self.upgrade_lock(key)
-        else:
-            # Just add to acquired_locks
-            self._acquired_locks.append((key, lock_type)) 
+    def abort(self, mode):
+        self._writes = {}
+        return TransactionHandler.abort(self, mode)
 
 
 """
@@ -579,7 +732,11 @@ Part II: Implement deadlock detection method for the transaction coordinator
 
 The transaction coordinator has access to the following object:
 
-self._lock_table: see description from Part I
+self._lock_table: see description from Part I. The waits-for graph in
+self._lock_table.waits_for is kept up to date by the transaction handlers, so
+the coordinator never has to scan the lock table itself. Under the deadlock
+prevention policies (see locktable.py), there is no graph, and the handlers
+choose the transactions to abort as they queue requests.
 """
 
 class TransactionCoordinator:
@@ -589,12 +746,18 @@ class TransactionCoordinator:
 
     def detect_deadlocks(self):
         """
-        Constructs a waits-for graph from the lock table, and runs a cycle
-        detection algorithm to determine if a transaction needs to be aborted.
-        You may choose which one transaction you plan to abort, as long as your
-        choice is deterministic. For example, if transactions 1 and 2 form a
-        cycle, you cannot return transaction 1 sometimes and transaction 2 the
-        other times.
+        Runs a cycle detection algorithm on the waits-for graph to determine
+        if a transaction needs to be aborted. You may choose which one
+        transaction you plan to abort, as long as your choice is deterministic.
+        For example, if transactions 1 and 2 form a cycle, you cannot return
+        transaction 1 sometimes and transaction 2 the other times.
+
+        Removing edges never creates a cycle, so any new cycle must contain an
+        edge added since the last check. We only search from those edges, in
+        the order they were added, and abort the youngest transaction (the
+        largest xid) on the first cycle found. An edge stays pending until it
+        is known not to be on a cycle, so repeated calls return the same
+        victim until it has been aborted.
 
         This method is called periodically to check if any operations of any
         two transactions conflict. If this is true, the transactions are in
@@ -610,8 +773,37 @@ class TransactionCoordinator:
 
         @param self: the transaction coordinator.
 
+        Under a prevention policy, returns the oldest victim chosen by the
+        policy, or the transaction whose lock wait has timed out first.
+
         @return: If there are no cycles in the waits-for graph, returns None.
         Otherwise, returns the xid of a transaction in a cycle.
         """
-        pass # Part 2.1: your code here!
+        lock_table = self._lock_table
+        if lock_table.policy != DETECT:
+            return self.next_victim()
+        waits_for = lock_table.waits_for
+        pending = waits_for.pending
+        while pending:
+            waiter, holder = pending[0]
+            if waits_for.has_edge(waiter, holder):
+                cycle = waits_for.find_path(holder, waiter)
+                if cycle is not None:
+                    return max(cycle)
+            pending.popleft()
+        return None
 
+
+    def next_victim(self):
+        """
+        Returns the next transaction to abort under a deadlock prevention
+        policy, or None.
+        """
+        lock_table = self._lock_table
+        if lock_table.victims:
+            return next(iter(lock_table.victims))
+        if lock_table.waiting_since:
+            xid = next(iter(lock_table.waiting_since))
+            if lock_table.waiting_since[xid] <= lock_table.clock():
+                return xid
+        return None
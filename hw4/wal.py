@@ -0,0 +1,148 @@
+import ast
+import os
+import struct
+import zlib
+
+"""
+On-disk format of the write-ahead log and of checkpoints. Both files are a
+sequence of records. A record is a header, holding the length and CRC-32 of
+the payload, followed by the payload: the repr() of a tuple of strings,
+integers and None, read back with ast.literal_eval(). A record that is cut
+short or fails its checksum marks the end of the file; it can only be the
+last one, torn by a crash in the middle of a write.
+"""
+HEADER = struct.Struct('>II')
+
+def encode_record(obj):
+    payload = repr(obj)
+    if not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+    return HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+def read_records(path):
+    """
+    Generates the records of the file at path, stopping at the first torn
+    record. Generates nothing if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, checksum = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != checksum:
+                return
+            if not isinstance(payload, str):
+                payload = payload.decode('utf-8')
+            yield ast.literal_eval(payload)
+
+def fsync_directory(path):
+    """
+    Makes a rename or file creation in the directory of path durable.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class WriteAheadLog(object):
+    """
+    An append-only redo log of committed transactions. Each commit record is
+    (seq, xid, writes), where seq numbers the commits from 1 and writes is a
+    tuple of (key, value) pairs.
+
+    Records are buffered by append() and written by flush() with a single
+    write and fsync, so that every transaction that commits during one poll
+    of the server shares the cost of one fsync (group commit).
+
+    fsync: if False, flush() only hands the records to the operating system,
+    which survives a crash of the server process but not of the machine.
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self._buffer = []
+        self._file = open(path, 'ab')
+
+    def append(self, seq, xid, writes):
+        self._buffer.append(encode_record((seq, xid, tuple(writes))))
+
+    def pending(self):
+        return len(self._buffer)
+
+    def flush(self):
+        """
+        Makes every appended record durable.
+
+        @return: the number of records written.
+        """
+        if not self._buffer:
+            return 0
+        count = len(self._buffer)
+        self._file.write(b''.join(self._buffer))
+        self._buffer = []
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        return count
+
+    def truncate(self):
+        """
+        Empties the log, once a checkpoint holds all of its records.
+        """
+        self._file.close()
+        self._file = open(self.path, 'wb')
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def replay(self):
+        """
+        Generates the durable commit records, oldest first.
+        """
+        return read_records(self.path)
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+def write_checkpoint(path, seq, items, chunk_size=1000, fsync=True):
+    """
+    Atomically replaces the checkpoint at path with the given (key, value)
+    pairs, the state of the store after commit seq. The first record is
+    (seq,), and each following record is a tuple of up to chunk_size pairs.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_record((seq,)))
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                f.write(encode_record(tuple(chunk)))
+                chunk = []
+        if chunk:
+            f.write(encode_record(tuple(chunk)))
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    if fsync:
+        fsync_directory(path)
+
+def read_checkpoint(path):
+    """
+    @return: (seq, dict of the checkpointed state), or (0, {}) if there is no
+    checkpoint. Checkpoints are written atomically, so they are never torn.
+    """
+    records = read_records(path)
+    for header in records:
+        data = {}
+        for chunk in records:
+            data.update(chunk)
+        return header[0], data
+    return 0, {}